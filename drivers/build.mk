@@ -15,11 +15,11 @@ $(DRIVERS_DIR)/ruby/lib/ql2.pb.rb: $(TOP)/src/rdb_protocol/ql2.proto
 .PHONY: ruby-driver
 ruby-driver: $(DRIVERS_DIR)/ruby/lib/ql2.pb.rb
 
-$(DRIVERS_DIR)/python/rethinkdb/ql2_pb2.py: $(TOP)/src/rdb_protocol/ql2.proto
+$(DRIVERS_DIR)/python/rethinkdb/ql2_pb2.py $(DRIVERS_DIR)/python/rethinkdb/ql2_enums.py: $(TOP)/src/rdb_protocol/ql2.proto
 	$(MAKE) -C $(DRIVERS_DIR)/python
 
 .PHONY: python-driver
-python-driver: $(DRIVERS_DIR)/python/rethinkdb/ql2_pb2.py
+python-driver: $(DRIVERS_DIR)/python/rethinkdb/ql2_pb2.py $(DRIVERS_DIR)/python/rethinkdb/ql2_enums.py
 
 .PHONY: $(DRIVERS_DIR)/all
 ifeq ($(BUILD_DRIVERS), 1)
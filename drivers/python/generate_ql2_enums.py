@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# Generates `rethinkdb/ql2_enums.py` from ql2.proto. It holds the values of
+# every enum in the protocol as attributes of a class named after the
+# message the enum is declared in, like `ql2_pb2` does, so that the driver
+# can use them without importing google.protobuf.
+#
+# Run with:
+#   python generate_ql2_enums.py ql2.proto > rethinkdb/ql2_enums.py
+
+import re
+import sys
+
+token_re = re.compile(r'(message|enum)\s+(\w+)\s*\{|(\w+)\s*=\s*(0x[0-9a-fA-F]+|-?\d+)|(\{)|(\})')
+
+# Returns the top level messages as (name, [(enum value name, value)]) pairs,
+# in the order they are declared
+def parse_messages(source):
+    source = re.sub(r'//[^\n]*', '', source)
+    messages = [ ]
+    scopes = [ ]
+    for match in token_re.finditer(source):
+        (kind, name, value_name, value, other_open, close) = match.groups()
+        if kind is not None:
+            scopes.append((kind, name))
+            if kind == 'message' and len(scopes) == 1:
+                messages.append((name, [ ]))
+        elif value_name is not None:
+            # Field numbers and defaults also look like assignments
+            if len(scopes) == 2 and scopes[-1][0] == 'enum':
+                messages[-1][1].append((value_name, value))
+        elif other_open is not None:
+            scopes.append(('other', None))
+        else:
+            scopes.pop()
+    return messages
+
+def generate(source):
+    lines = ["# Generated from ql2.proto by generate_ql2_enums.py. Do not edit."]
+    for (name, values) in parse_messages(source):
+        lines.extend(["", "class %s(object):" % name])
+        lines.extend("    %s = %s" % value for value in values)
+        if not values:
+            lines.append("    pass")
+    return "\n".join(lines) + "\n"
+
+if __name__ == '__main__':
+    sys.stdout.write(generate(open(sys.argv[1]).read()))
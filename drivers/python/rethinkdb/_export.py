@@ -4,7 +4,7 @@ import signal
 # When running a subprocess, we may inherit the signal handler - remove it
 signal.signal(signal.SIGINT, signal.SIG_DFL)
 
-import sys, os, datetime, time, copy, json, traceback, csv, string
+import sys, os, datetime, time, copy, json, traceback, csv, string, shutil
 import multiprocessing, multiprocessing.queues, subprocess, re, ctypes
 from optparse import OptionParser
 
@@ -35,8 +35,9 @@ def print_export_help():
     print "                                   (required for CSV format)"
     print "  -e [ --export ] (DB | DB.TABLE)  limit dump to the given database or table (may"
     print "                                   be specified multiple times)"
-    print "  --clients NUM                    number of tables to export simultaneously (defaults"
-    print "                                   to 3)"
+    print "  --clients NUM                    number of connections to read tables with (defaults"
+    print "                                   to 3), a large table is split into key ranges read"
+    print "                                   in parallel"
     print ""
     print "EXAMPLES:"
     print "rethinkdb export -c mnemosyne:39500"
@@ -53,6 +54,9 @@ def print_export_help():
     print ""
     print "rethinkdb export --fields id,value -e test.data"
     print "  Export a specific table from a local cluster in JSON format with only the fields 'id' and 'value'."
+    print ""
+    print "rethinkdb export -e test.events --clients 8"
+    print "  Export a large table from a local cluster, reading eight ranges of its primary key at once."
 
 def parse_options():
     parser = OptionParser(add_help_option=False, usage=usage)
@@ -181,91 +185,158 @@ def finalize_directory(base_path, base_path_partial):
     os_call_wrapper(lambda x: os.rename(base_path_partial, x), base_path,
                     "Failed to move temporary directory to output directory (%s): %s")
 
+# Tables with fewer rows than this per client are split into fewer ranges
+split_min_rows = 10000
+
+# Number of primary keys sampled for each range a table is split into
+split_samples = 20
+
 def write_table_metadata(conn, db, table, base_path):
     out = open(base_path + "/%s/%s.info" % (db, table), "w")
     table_info = r.db(db).table(table).info().run(conn)
     out.write(json.dumps(table_info) + "\n")
     out.close()
-
-def read_table_into_queue(conn, db, table, task_queue, progress_info, exit_event):
+    return table_info
+
+# Orders primary keys the way the server does. Only numbers and strings are
+# used to split tables: numbers sort before strings, and strings by their
+# UTF-8 bytes.
+def split_key_order(key):
+    if isinstance(key, (int, long, float)) and not isinstance(key, bool):
+        return (0, key)
+    if isinstance(key, unicode):
+        return (1, key.encode("utf-8"))
+    if isinstance(key, str):
+        return (1, key)
+    return None
+
+# Splits a table into up to `count` ranges of its primary key, using the
+# quantiles of a sample of its keys. A range is a (left, right) pair for
+# `between`, with None for an open end, so together they cover every row
+# whatever the type of its key.
+def get_table_ranges(conn, db, table, primary_key, count):
+    if count < 2:
+        return [(None, None)]
+
+    sample = r.db(db).table(table).sample(count * split_samples)[primary_key].run(conn, time_format="raw")
+    keys = sorted((split_key_order(key), key) for key in sample if split_key_order(key) is not None)
+
+    splits = []
+    for i in xrange(1, count):
+        if len(keys) == 0:
+            break
+        (order, key) = keys[i * len(keys) // count]
+        if len(splits) == 0 or splits[-1][0] != order:
+            splits.append((order, key))
+
+    bounds = [None] + [key for (order, key) in splits] + [None]
+    return zip(bounds[:-1], bounds[1:])
+
+def add_progress(progress_info, rows):
+    with progress_info[0].get_lock():
+        progress_info[0].value += rows
+
+# Writes the rows of a JSON shard. The first shard of a table opens its array,
+# and every row of the others is preceded by a comma, which `merge_shards`
+# drops if no earlier shard had a row.
+def json_writer(out, rows, fields, first_shard, progress_info, exit_event):
+    dumps = r.get_json_codec().dumps
     read_rows = 0
-    for row in r.db(db).table(table).run(conn, time_format="raw"):
+    first = first_shard
+    if first_shard:
+        out.write("[")
+    for row in rows:
         if exit_event.is_set():
             break
-        task_queue.put([row])
+
+        if fields is not None:
+            for item in list(row.iterkeys()):
+                if item not in fields:
+                    del row[item]
+        if first:
+            first = False
+            out.write("\n" + dumps(row))
+        else:
+            out.write(",\n" + dumps(row))
 
         # Update the progress every 20 rows - to reduce locking overhead
         read_rows += 1
         if read_rows % 20 == 0:
-            progress_info[0].value += 20
-    progress_info[0].value += read_rows % 20
+            add_progress(progress_info, 20)
+    add_progress(progress_info, read_rows % 20)
 
-def json_writer(filename, fields, task_queue, error_queue):
-    try:
-        with open(filename, "w") as out:
-            first = True
-            out.write("[")
-            while True:
-                item = task_queue.get()
-                if len(item) != 1:
-                    break
-                row = item[0]
-
-                if fields is not None:
-                    for item in list(row.iterkeys()):
-                        if item not in fields:
-                            del row[item]
-                if first:
-                    first = False
-                    out.write("\n" + json.dumps(row))
-                else:
-                    out.write(",\n" + json.dumps(row))
-            out.write("\n]\n")
-    except:
-        ex_type, ex_class, tb = sys.exc_info()
-        error_queue.put((ex_type, ex_class, traceback.extract_tb(tb)))
+def csv_writer(out, rows, fields, first_shard, progress_info, exit_event):
+    read_rows = 0
+    out_writer = csv.writer(out)
+    if first_shard:
+        out_writer.writerow([s.encode('utf-8') for s in fields])
+
+    for row in rows:
+        if exit_event.is_set():
+            break
 
-def csv_writer(filename, fields, task_queue, error_queue):
+        info = []
+        # If the data is a simple type, just write it directly, otherwise, write it as json
+        for field in fields:
+            if field not in row:
+                info.append(None)
+            elif isinstance(row[field], (int, long, float, complex)):
+                info.append(str(row[field]).encode('utf-8'))
+            elif isinstance(row[field], (str, unicode)):
+                info.append(row[field].encode('utf-8'))
+            else:
+                info.append(json.dumps(row[field]))
+        out_writer.writerow(info)
+
+        read_rows += 1
+        if read_rows % 20 == 0:
+            add_progress(progress_info, 20)
+    add_progress(progress_info, read_rows % 20)
+
+# Reads one range of a table over its own connection and writes it to a shard.
+# The slot in `stream_semaphore` was taken by `export_table` and is given back
+# when the range is done.
+def export_range(host, port, auth_key, db, table, left, right, filename, first_shard, fields, format, error_queue, progress_info, stream_semaphore, exit_event):
     try:
+        conn = r.connect(host, port, auth_key=auth_key)
+        query = r.db(db).table(table)
+        if left is not None or right is not None:
+            query = query.between(left, right)
+        rows = query.run(conn, time_format="raw")
+
         with open(filename, "w") as out:
-            out_writer = csv.writer(out)
-            out_writer.writerow([s.encode('utf-8') for s in fields])
-
-            while True:
-                item = task_queue.get()
-                if len(item) != 1:
-                    break
-                row = item[0]
-                info = []
-                # If the data is a simple type, just write it directly, otherwise, write it as json
-                for field in fields:
-                    if field not in row:
-                        info.append(None)
-                    elif isinstance(row[field], (int, long, float, complex)):
-                        info.append(str(row[field]).encode('utf-8'))
-                    elif isinstance(row[field], (str, unicode)):
-                        info.append(row[field].encode('utf-8'))
-                    else:
-                        info.append(json.dumps(row[field]))
-                out_writer.writerow(info)
+            if format == "json":
+                json_writer(out, rows, fields, first_shard, progress_info, exit_event)
+            elif format == "csv":
+                csv_writer(out, rows, fields, first_shard, progress_info, exit_event)
+            else:
+                raise RuntimeError("unknown format type: %s" % format)
+    except (r.RqlError, r.RqlDriverError) as ex:
+        error_queue.put((RuntimeError, RuntimeError(ex.message), traceback.extract_tb(sys.exc_info()[2])))
     except:
         ex_type, ex_class, tb = sys.exc_info()
         error_queue.put((ex_type, ex_class, traceback.extract_tb(tb)))
+    finally:
+        stream_semaphore.release()
+
+# Appends the other shards of a table to the first, in key order, closes the
+# JSON array and moves the result to the table's file
+def merge_shards(filename, shards, format):
+    with open(shards[0], "a") as out:
+        has_rows = os.path.getsize(shards[0]) > 1
+        for shard in shards[1:]:
+            with open(shard, "r") as data:
+                if format == "json" and not has_rows and os.path.getsize(shard) > 0:
+                    data.read(1) # The comma before its first row
+                    has_rows = True
+                shutil.copyfileobj(data, out)
+            os.remove(shard)
+        if format == "json":
+            out.write("\n]\n")
+    os.rename(shards[0], filename)
 
-def launch_writer(format, directory, db, table, fields, task_queue, error_queue):
-    if format == "json":
-        filename = directory + "/%s/%s.json" % (db, table)
-        return multiprocessing.Process(target=json_writer,
-                                       args=(filename, fields, task_queue, error_queue))
-    elif format == "csv":
-        filename = directory + "/%s/%s.csv" % (db, table)
-        return multiprocessing.Process(target=csv_writer,
-                                       args=(filename, fields, task_queue, error_queue))
-    else:
-        raise RuntimeError("unknown format type: %s" % format)
-
-def export_table(host, port, auth_key, db, table, directory, fields, format, error_queue, progress_info, stream_semaphore, exit_event):
-    writer = None
+def export_table(host, port, auth_key, db, table, directory, fields, format, clients, error_queue, progress_info, stream_semaphore, exit_event):
+    processes = []
 
     try:
         conn = r.connect(host, port, auth_key=auth_key)
@@ -273,26 +344,40 @@ def export_table(host, port, auth_key, db, table, directory, fields, format, err
         table_size = r.db(db).table(table).count().run(conn)
         progress_info[1].value = table_size
         progress_info[0].value = 0
-        write_table_metadata(conn, db, table, directory)
+        table_info = write_table_metadata(conn, db, table, directory)
+
+        count = max(1, min(clients, table_size // split_min_rows))
+        ranges = get_table_ranges(conn, db, table, table_info["primary_key"], count)
+
+        filename = directory + "/%s/%s.%s" % (db, table, format)
+        shards = ["%s.%d" % (filename, i) for i in xrange(len(ranges))]
+
+        for (i, (left, right)) in enumerate(ranges):
+            while not stream_semaphore.acquire(True, 0.1):
+                if exit_event.is_set():
+                    return
+            processes.append(multiprocessing.Process(target=export_range,
+                                                     args=(host, port, auth_key, db, table,
+                                                           left, right, shards[i], i == 0,
+                                                           fields, format, error_queue,
+                                                           progress_info, stream_semaphore,
+                                                           exit_event)))
+            processes[-1].start()
 
-        with stream_semaphore:
-            task_queue = multiprocessing.queues.SimpleQueue()
-            writer = launch_writer(format, directory, db, table, fields, task_queue, error_queue)
-            writer.start()
+        for process in processes:
+            process.join()
 
-            read_table_into_queue(conn, db, table, task_queue, progress_info, exit_event)
+        # The shards are incomplete if the export was stopped
+        if not exit_event.is_set() and error_queue.empty():
+            merge_shards(filename, shards, format)
     except (r.RqlError, r.RqlDriverError) as ex:
         error_queue.put((RuntimeError, RuntimeError(ex.message), traceback.extract_tb(sys.exc_info()[2])))
     except:
         ex_type, ex_class, tb = sys.exc_info()
         error_queue.put((ex_type, ex_class, traceback.extract_tb(tb)))
     finally:
-        if writer is not None and writer.is_alive():
-            task_queue.put(("exit", "event")) # Exit is triggered by sending a message with two objects
-            writer.join()
-        else:
-            error_queue.put((RuntimeError, RuntimeError("writer unexpectedly stopped"),
-                             traceback.extract_tb(sys.exc_info()[2])))
+        for process in processes:
+            process.join()
 
 def abort_export(signum, frame, exit_event, interrupt_event):
     interrupt_event.set()
@@ -349,6 +434,7 @@ def run_clients(options, db_table_set):
                                                            options["directory_partial"],
                                                            options["fields"],
                                                            options["format"],
+                                                           options["clients"],
                                                            error_queue,
                                                            progress_info[-1],
                                                            stream_semaphore,
@@ -402,9 +488,6 @@ def main():
         db_table_set = get_tables(options["host"], options["port"], options["auth_key"], options["tables"])
         del options["tables"] # This is not needed anymore, db_table_set is more useful
 
-        # Determine the actual number of client processes we'll have
-        options["clients"] = min(options["clients"], len(db_table_set))
-
         prepare_directories(options["directory"], options["directory_partial"], db_table_set)
         start_time = time.time()
         run_clients(options, db_table_set)
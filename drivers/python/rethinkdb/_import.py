@@ -1,8 +1,8 @@
 #!/usr/bin/env python
 import signal
 
-import sys, os, datetime, time, copy, json, traceback, csv, cPickle, string
-import multiprocessing, multiprocessing.queues, subprocess, re, ctypes
+import sys, os, datetime, time, copy, json, traceback, csv, string, mmap, math
+import multiprocessing, multiprocessing.queues, subprocess, re, ctypes, Queue
 from optparse import OptionParser
 
 try:
@@ -15,10 +15,11 @@ except ImportError:
 info = "'rethinkdb import` loads data into a RethinkDB cluster"
 usage = "\
   rethinkdb import -d DIR [-c HOST:PORT] [-a AUTH_KEY] [--force]\n\
-      [-i (DB | DB.TABLE)] [--clients NUM]\n\
+      [-i (DB | DB.TABLE)] [--clients NUM] [--readers NUM]\n\
   rethinkdb import -f FILE --table DB.TABLE [-c HOST:PORT] [-a AUTH_KEY]\n\
-      [--force] [--clients NUM] [--format (csv | json)] [--pkey PRIMARY_KEY]\n\
-      [--delimiter CHARACTER] [--custom-header FIELD,FIELD... [--no-header]]"
+      [--force] [--clients NUM] [--readers NUM] [--format (csv | json)] [--pkey PRIMARY_KEY]\n\
+      [--delimiter CHARACTER] [--custom-header FIELD,FIELD... [--no-header]]\n\
+      [--column-types FIELD:TYPE,FIELD:TYPE...] [--infer-types]"
 
 def print_import_help():
     print info
@@ -30,6 +31,8 @@ def print_import_help():
     print "  -a [ --auth ] AUTH_KEY           authorization key for rethinkdb clients"
     print "  --clients NUM_CLIENTS            the number of client connections to use (defaults"
     print "                                   to 8)"
+    print "  --readers NUM_READERS            the number of processes reading each large file with"
+    print "                                   one row per line (defaults to the number of CPUs)"
     print "  --hard-durability                use hard durability writes (slower, but less memory"
     print "                                   consumption on the server)"
     print "  --force                          import data even if a table already exists, and"
@@ -52,6 +55,11 @@ def print_import_help():
     print "  --no-header                      do not read in a header of field names"
     print "  --custom-header FIELD,FIELD...   header to use (overriding file header), must be"
     print "                                   specified if --no-header"
+    print "  --column-types FIELD:TYPE,...    import the given fields as 'number', 'boolean', 'json'"
+    print "                                   or 'string' values, rather than as strings"
+    print "  --infer-types                    import fields whose first 1000 values are all numbers"
+    print "                                   or all booleans as those types (also valid when"
+    print "                                   importing a directory)"
     print ""
     print "EXAMPLES:"
     print ""
@@ -75,6 +83,10 @@ def print_import_help():
     print "  Import data into a local cluster using the named CSV file with no header and instead"
     print "  use the fields 'id', 'name', and 'number', the delimiter is a semicolon (rather than"
     print "  a comma)."
+    print ""
+    print "rethinkdb import -f user_data.csv --table test.users --column-types age:number,active:boolean"
+    print "  Import data into a local cluster using the named CSV file, storing the 'age' and"
+    print "  'active' fields as numbers and booleans instead of strings."
 
 def parse_options():
     parser = OptionParser(add_help_option=False, usage=usage)
@@ -82,6 +94,7 @@ def parse_options():
     parser.add_option("-a", "--auth", dest="auth_key", metavar="AUTHKEY", default="", type="string")
     parser.add_option("--fields", dest="fields", metavar="FIELD,FIELD...", default=None, type="string")
     parser.add_option("--clients", dest="clients", metavar="NUM_CLIENTS", default=8, type="int")
+    parser.add_option("--readers", dest="readers", metavar="NUM_READERS", default=None, type="int")
     parser.add_option("--hard-durability", dest="hard", action="store_true", default=False)
     parser.add_option("--force", dest="force", action="store_true", default=False)
     parser.add_option("--debug", dest="debug", action="store_true", default=False)
@@ -98,6 +111,8 @@ def parse_options():
     parser.add_option("--delimiter", dest="delimiter", metavar="CHARACTER", default = None, type="string")
     parser.add_option("--no-header", dest="no_header", action="store_true", default = False)
     parser.add_option("--custom-header", dest="custom_header", metavar="FIELD,FIELD...", default = None, type="string")
+    parser.add_option("--column-types", dest="column_types", metavar="FIELD:TYPE,FIELD:TYPE...", default = None, type="string")
+    parser.add_option("--infer-types", dest="infer_types", action="store_true", default = False)
     parser.add_option("-h", "--help", dest="help", default=False, action="store_true")
     (options, args) = parser.parse_args()
 
@@ -122,8 +137,14 @@ def parse_options():
     if options.clients < 1:
         raise RuntimeError("Error: --client option too low, must have at least one client connection")
 
+    if options.readers is None:
+        options.readers = multiprocessing.cpu_count()
+    elif options.readers < 1:
+        raise RuntimeError("Error: --readers option too low, must have at least one reader process")
+
     res["auth_key"] = options.auth_key
     res["clients"] = options.clients
+    res["readers"] = options.readers
     res["durability"] = "hard" if options.hard else "soft"
     res["force"] = options.force
     res["debug"] = options.debug
@@ -132,6 +153,8 @@ def parse_options():
     res["delimiter"] = ","
     res["no_header"] = False
     res["custom_header"] = None
+    res["column_types"] = None
+    res["infer_types"] = options.infer_types
 
     if options.directory is not None:
         # Directory mode, verify directory import options
@@ -149,6 +172,8 @@ def parse_options():
             raise RuntimeError("Error: --no-header option is not valid when importing a directory")
         if options.custom_header is not None:
             raise RuntimeError("Error: --custom-header option is not valid when importing a directory")
+        if options.column_types is not None:
+            raise RuntimeError("Error: --column-types option is not valid when importing a directory")
 
         # Verify valid directory option
         dirname = options.directory
@@ -239,6 +264,17 @@ def parse_options():
             if options.no_header == True and options.custom_header is None:
                 raise RuntimeError("Error: Cannot import a CSV file with --no-header and no --custom-header option")
             res["no_header"] = options.no_header
+
+            if options.column_types is not None:
+                res["column_types"] = { }
+                for item in options.column_types.split(","):
+                    field_type = item.rsplit(":", 1)
+                    if len(field_type) != 2:
+                        raise RuntimeError("Error: Invalid 'field:type' format: %s" % item)
+                    if field_type[1] not in csv_column_types:
+                        raise RuntimeError("Error: Unknown column type '%s', valid types are %s" %
+                                           (field_type[1], ", ".join(sorted(csv_column_types))))
+                    res["column_types"][field_type[0]] = field_type[1]
         else:
             if options.delimiter is not None:
                 raise RuntimeError("Error: --delimiter option is only valid for CSV file formats")
@@ -246,6 +282,10 @@ def parse_options():
                 raise RuntimeError("Error: --no-header option is only valid for CSV file formats")
             if options.custom_header is not None:
                 raise RuntimeError("Error: --custom-header option is only valid for CSV file formats")
+            if options.column_types is not None:
+                raise RuntimeError("Error: --column-types option is only valid for CSV file formats")
+            if options.infer_types == True:
+                raise RuntimeError("Error: --infer-types option is only valid for CSV file formats")
 
         res["primary_key"] = options.primary_key
     else:
@@ -253,41 +293,146 @@ def parse_options():
 
     return res
 
+# Batches start at `batch_length_limit` rows or `batch_size_limit` bytes. Each
+#  table's limits then grow while its inserts take less than half of
+#  `batch_target_time` seconds, and shrink when they take more than twice that
+#  or fail, staying within the ranges below.
+batch_length_limit = 200
+batch_size_limit = 500000
+batch_length_range = (10, 20000)
+batch_size_range = (64 * 1024, 16 * 1024 * 1024)
+batch_target_time = 0.5
+
+# The number of batches that may be waiting for each client, past which the
+#  readers wait for the clients to catch up
+client_queue_depth = 4
+
+# The batch limits of a table, shared by its readers and the clients, which
+#  update them after each insert. Also keeps the totals reported at the end.
+class BatchController(object):
+    def __init__(self):
+        self.lock = multiprocessing.Lock()
+        self.limits = multiprocessing.RawArray(ctypes.c_longlong, [batch_length_limit, batch_size_limit])
+        self.totals = multiprocessing.RawArray(ctypes.c_longlong, [0, 0]) # Rows and bytes inserted
+        self.times = multiprocessing.RawArray(ctypes.c_double, [0.0, 0.0]) # Start and last insert
+
+    def get_limits(self):
+        with self.lock:
+            return (self.limits[0], self.limits[1])
+
+    def start(self):
+        with self.lock:
+            self.times[0] = time.time()
+
+    # Halves the limits when an insert fails or is slow, and grows whichever
+    #  limit a quick insert reached by a quarter
+    def record(self, length, size, elapsed, failed):
+        with self.lock:
+            if failed or elapsed > batch_target_time * 2:
+                self.limits[0] = max(batch_length_range[0], self.limits[0] / 2)
+                self.limits[1] = max(batch_size_range[0], self.limits[1] / 2)
+            elif elapsed < batch_target_time / 2:
+                if length >= self.limits[0]:
+                    self.limits[0] = min(batch_length_range[1], self.limits[0] * 5 / 4)
+                if size >= self.limits[1]:
+                    self.limits[1] = min(batch_size_range[1], self.limits[1] * 5 / 4)
+            if not failed:
+                self.totals[0] += length
+                self.totals[1] += size
+                self.times[1] = time.time()
+
+    # Returns the rows and bytes inserted and the time it took
+    def get_totals(self):
+        with self.lock:
+            return (self.totals[0], self.totals[1], max(0.0, self.times[1] - self.times[0]))
+
+# Errors that mean the server rejected a batch for its size, rather than for
+#  one of its rows
+batch_too_large = re.compile("over size limit|too large", re.IGNORECASE)
+
+# Inserts the rows, given as JSON. If the server rejects the batch as too
+#  large, it is retried in halves.
+def insert_batch(conn, db, table, rows, controller, use_upsert, durability):
+    size = sum([len(row) for row in rows])
+    start = time.time()
+    try:
+        # The rows are sent to the server as JSON, without decoding them
+        res = r.db(db).table(table).insert(r.json("[" + ",".join(rows) + "]"),
+                                           durability=durability, upsert=use_upsert).run(conn)
+    except r.RqlRuntimeError as ex:
+        if len(rows) == 1 or batch_too_large.search(ex.message) is None:
+            raise
+        controller.record(len(rows), size, time.time() - start, True)
+        insert_batch(conn, db, table, rows[:len(rows) / 2], controller, use_upsert, durability)
+        insert_batch(conn, db, table, rows[len(rows) / 2:], controller, use_upsert, durability)
+        return
+
+    if res["errors"] > 0:
+        raise RuntimeError("Error when importing into table '%s.%s': %s" %
+                           (db, table, res["first_error"]))
+    controller.record(len(rows), size, time.time() - start, False)
+
 # This is run for each client requested, and accepts tasks from the reader processes
-def client_process(host, port, auth_key, task_queue, error_queue, use_upsert, durability):
+def client_process(host, port, auth_key, task_queue, error_queue, controllers, use_upsert, durability, exit_event):
     try:
         conn = r.connect(host, port, auth_key=auth_key)
-        while True:
-            task = task_queue.get()
-            if len(task) == 3:
-                # Unpickle objects (TODO: super inefficient, would be nice if we could pass down json)
-                objs = [cPickle.loads(obj) for obj in task[2]]
-                res = r.db(task[0]).table(task[1]).insert(objs, durability=durability, upsert=use_upsert).run(conn)
-                if res["errors"] > 0:
-                    raise RuntimeError("Error when importing into table '%s.%s': %s" %
-                                       (task[0], task[1], res["first_error"]))
-            else:
+        while not exit_event.is_set():
+            try:
+                task = task_queue.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            if task == "exit":
                 break
+            (db, table, rows) = task
+            insert_batch(conn, db, table, rows, controllers[(db, table)], use_upsert, durability)
     except (r.RqlError, r.RqlDriverError) as ex:
         error_queue.put((RuntimeError, RuntimeError(ex.message), traceback.extract_tb(sys.exc_info()[2])))
     except:
         ex_type, ex_class, tb = sys.exc_info()
         error_queue.put((ex_type, ex_class, traceback.extract_tb(tb)))
 
-batch_length_limit = 200
-batch_size_limit = 500000
-
 class InterruptedError(Exception):
     def __str__(self):
         return "Interrupted"
 
-# This function is called for each object read from a file by the reader processes
-#  and will push tasks to the client processes on the task queue
-def object_callback(obj, db, table, task_queue, object_buffers, buffer_sizes, fields, exit_event):
-    global batch_size_limit
-    global batch_length_limit
+# Collects the JSON of the rows read for a table and hands them to the client
+#  processes in batches. Blocks while the task queue is full, until the import
+#  is interrupted.
+class Batch(object):
+    def __init__(self, db, table, task_queue, controller, exit_event):
+        self.db = db
+        self.table = table
+        self.task_queue = task_queue
+        self.controller = controller
+        self.exit_event = exit_event
+        self.rows = []
+        self.size = 0
+        (self.length_limit, self.size_limit) = controller.get_limits()
+
+    def add(self, json_str):
+        self.rows.append(json_str)
+        self.size += len(json_str)
+        if len(self.rows) >= self.length_limit or self.size > self.size_limit:
+            self.send()
+
+    def send(self):
+        if len(self.rows) > 0:
+            while True:
+                try:
+                    self.task_queue.put((self.db, self.table, self.rows), timeout=0.1)
+                    break
+                except Queue.Full:
+                    if self.exit_event.is_set():
+                        raise InterruptedError()
+            self.rows = []
+            self.size = 0
+        (self.length_limit, self.size_limit) = self.controller.get_limits()
 
-    if exit_event.is_set():
+# This function is called for each object read from a file by the reader processes
+#  and will push tasks to the client processes on the task queue. `json_str` is
+#  the object's JSON, if the reader has it.
+def object_callback(obj, batch, fields, json_str=None):
+    if batch.exit_event.is_set():
         raise InterruptedError()
 
     if not isinstance(obj, dict):
@@ -298,28 +443,38 @@ def object_callback(obj, db, table, task_queue, object_buffers, buffer_sizes, fi
         for key in list(obj.iterkeys()):
             if key not in fields:
                 del obj[key]
+        json_str = None
 
-    # Pickle the object here because we want an accurate size, and it'll pickle anyway for IPC
-    object_buffers.append(cPickle.dumps(obj))
-    buffer_sizes.append(len(object_buffers[-1]))
-    if len(object_buffers) >= batch_length_limit or sum(buffer_sizes) > batch_size_limit:
-        task_queue.put((db, table, object_buffers))
-        del object_buffers[0:len(object_buffers)]
-        del buffer_sizes[0:len(buffer_sizes)]
+    # Serialize the object here because we want an accurate size, and the client sends it as JSON anyway
+    if json_str is None:
+        json_str = r.get_json_codec().dumps(obj)
+    batch.add(json_str)
     return obj
 
 json_read_chunk_size = 32 * 1024
 json_max_buffer_size = 16 * 1024 * 1024
 
-def read_json_single_object(json_data, file_in, callback):
+# Reads a stream of objects separated by whitespace, which may be a single object
+def read_json_objects(json_data, file_in, callback, progress_info):
     decoder = json.JSONDecoder()
+    offset = 0
     while True:
         try:
-            (obj, offset) = decoder.raw_decode(json_data)
-            json_data = json_data[offset:]
+            offset = json.decoder.WHITESPACE.match(json_data, offset).end()
+            if offset == len(json_data):
+                json_data = file_in.read(json_read_chunk_size)
+                offset = 0
+                if len(json_data) == 0:
+                    break
+                continue
+
+            (obj, offset) = decoder.raw_decode(json_data, idx=offset)
             callback(obj)
-            break
+            progress_info[2].value += 1
         except ValueError:
+            # Only the unread data is kept, rather than slicing it after every object
+            json_data = json_data[offset:]
+            offset = 0
             before_len = len(json_data)
             json_data += file_in.read(json_read_chunk_size)
             if before_len == len(json_data):
@@ -342,9 +497,7 @@ def read_json_array(json_data, file_in, callback, progress_info):
             progress_info[2].value += 1
 
             # Read past whitespace to the next record
-            file_offset += offset
-            json_data = json_data[offset:]
-            offset = json.decoder.WHITESPACE.match(json_data, 0).end()
+            offset = json.decoder.WHITESPACE.match(json_data, offset).end()
 
             if json_data[offset] == ",":
                 # Read past the comma
@@ -353,6 +506,10 @@ def read_json_array(json_data, file_in, callback, progress_info):
                 raise ValueError("Error: JSON format not recognized - expected ',' or ']' after object")
 
         except (ValueError, IndexError):
+            # Only the unread data is kept, rather than slicing it after every object
+            file_offset += offset
+            json_data = json_data[offset:]
+            offset = 0
             before_len = len(json_data)
             json_data += file_in.read(json_read_chunk_size)
             if json_data[offset] == ",":
@@ -365,26 +522,258 @@ def read_json_array(json_data, file_in, callback, progress_info):
     json_data += file_in.read()
     return json_data[offset + 1:]
 
-def json_reader(task_queue, filename, db, table, primary_key, fields, progress_info, exit_event):
-    object_buffers = []
-    buffer_sizes = []
+# Files whose rows start on lines of their own, like those written by
+#  `rethinkdb export`, newline-delimited JSON or CSV, are split into parts of at
+#  least this size, which are read by separate processes
+split_size = 16 * 1024 * 1024
+progress_rows = 100
+json_layout_sample_lines = 100
+
+# Yields the lines starting between `start` and `end` in a memory-mapped file,
+#  cutting the last one at `end`
+def mapped_lines(mm, start, end):
+    mm.seek(start)
+    while mm.tell() < end:
+        line = mm.readline()
+        if mm.tell() > end:
+            line = line[:end - mm.tell()]
+        yield line
+
+# Returns `(in_array, start, end)`, the byte range of the rows in a file with
+#  one row per line and whether they are elements of an array, or None if the
+#  rows are laid out in some other way. Only the first lines are checked, and
+#  `read_json_lines` also reads any later rows that span several lines.
+def json_line_layout(mm):
+    start = json.decoder.WHITESPACE.match(mm, 0).end()
+    end = len(mm)
+    if start == end:
+        return None
+    if mm[start] == "[":
+        in_array = True
+        while mm[end - 1] in " \t\r\n":
+            end -= 1
+        if end - 1 <= start or mm[end - 1] != "]":
+            return None
+        (start, end) = (start + 1, end - 1)
+    elif mm[start] == "{":
+        in_array = False
+    else:
+        return None
+
+    # Don't read what may be the whole file as one line
+    first_line_end = mm.find("\n", start, start + json_max_buffer_size)
+    if first_line_end < 0 and end - start > json_max_buffer_size:
+        return None
+
+    loads = r.get_json_codec().loads
+    lines = mapped_lines(mm, start, end)
+    for i in xrange(json_layout_sample_lines):
+        try:
+            row = lines.next().strip()
+        except StopIteration:
+            break
+        if in_array and row.endswith(","):
+            row = row[:-1]
+        if len(row) > 0:
+            try:
+                loads(row)
+            except ValueError:
+                return None
+    return (in_array, start, end)
+
+# Splits the bytes from `start` to `end` into at most `count` ranges that each
+#  begin at the start of a line
+def split_lines(mm, start, end, count):
+    bounds = [start]
+    for i in xrange(1, count):
+        line_end = mm.find("\n", max(bounds[-1], start + (end - start) * i / count))
+        if line_end < 0 or line_end + 1 >= end:
+            break
+        bounds.append(line_end + 1)
+    bounds.append(end)
+    return zip(bounds[:-1], bounds[1:])
+
+# Whether the line at `offset` is a whole row that starts at the beginning of
+#  the line. Rows nested in a row that spans several lines are indented.
+def json_row_at(mm, offset, in_array):
+    if mm[offset] != "{":
+        return False
+    line_end = mm.find("\n", offset)
+    row = mm[offset:len(mm) if line_end < 0 else line_end].strip()
+    if in_array and row.endswith(","):
+        row = row[:-1]
+    try:
+        return isinstance(r.get_json_codec().loads(row), dict)
+    except ValueError:
+        return False
+
+# Like `split_lines`, but moves each split forward to the next line holding a
+#  whole row, so that no range starts inside a row that spans several lines
+def split_json(mm, start, end, in_array, count):
+    bounds = [start]
+    for (split, split_end) in split_lines(mm, start, end, count)[1:]:
+        while split < end and not json_row_at(mm, split, in_array):
+            line_end = mm.find("\n", split, end)
+            split = end if line_end < 0 else line_end + 1
+        if split <= bounds[-1]:
+            continue
+        if split >= end:
+            break
+        bounds.append(split)
+    bounds.append(end)
+    return zip(bounds[:-1], bounds[1:])
+
+json_string = re.compile(r'"(?:[^"\\]|\\.)*"')
+
+# The number of brackets a line of JSON opens, less the number it closes,
+#  not counting those in strings
+def json_depth_change(line):
+    line = json_string.sub("", line)
+    return line.count("{") + line.count("[") - line.count("}") - line.count("]")
+
+# The number of the line that `offset` is on in a memory-mapped file
+def line_number(mm, offset):
+    lines = 1
+    for pos in xrange(0, offset, split_size):
+        lines += mm[pos:min(pos + split_size, offset)].count("\n")
+    return lines
+
+def json_line_error(mm, offset, message):
+    return RuntimeError("Error: JSON format not recognized on line %d - %s" % (line_number(mm, offset), message))
+
+def add_progress(progress_info, done, rows):
+    with progress_info[0].get_lock():
+        progress_info[0].value += done
+    with progress_info[2].get_lock():
+        progress_info[2].value += rows
+
+# Runs `read_range(mm, start, end, *args)` in a reader process, with `mm` a
+#  memory map of the file
+def range_process(filename, read_range, start, end, args, error_queue):
+    try:
+        with open(filename, "rb") as file_in:
+            mm = mmap.mmap(file_in.fileno(), 0, access=mmap.ACCESS_READ)
+            read_range(mm, start, end, *args)
+    except InterruptedError:
+        pass
+    except:
+        ex_type, ex_class, tb = sys.exc_info()
+        error_queue.put((ex_type, ex_class, traceback.extract_tb(tb), filename))
+
+# Reads each of `ranges` of the file with `read_range` in its own process, or
+#  in this one if there is only one range
+def read_ranges(filename, mm, ranges, read_range, args, error_queue):
+    if len(ranges) == 1:
+        read_range(mm, ranges[0][0], ranges[0][1], *args)
+        return
+
+    procs = [multiprocessing.Process(target=range_process,
+                                     args=(filename, read_range, start, end, args, error_queue))
+             for (start, end) in ranges]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+
+# Reads the rows beginning between `start` and `end`. Most rows are a line
+#  each; a line that isn't a row on its own but opens more brackets than it
+#  closes starts a row that ends on the line where they are all closed.
+def read_json_lines(mm, start, end, in_array, task_queue, controller, db, table, fields, progress_info, exit_event):
+    batch = Batch(db, table, task_queue, controller, exit_event)
+    loads = r.get_json_codec().loads
+    reported = start
+    rows = 0
+    last_row = False
+    offset = start
+
+    # The lines read so far of a row that spans several, and the number of
+    #  brackets they leave open
+    pending = []
+    depth = 0
+
+    for line in mapped_lines(mm, start, end):
+        line_start = offset
+        offset += len(line)
+        line = line.strip()
+        if len(line) == 0:
+            continue
+
+        if len(pending) == 0:
+            row_start = line_start
+            row = line
+        else:
+            pending.append(line)
+            depth += json_depth_change(line)
+            if depth > 0:
+                continue
+            row = "\n".join(pending)
+
+        if last_row:
+            raise json_line_error(mm, row_start, "expected ',' after object")
+        has_comma = in_array and row.endswith(",")
+        json_str = row[:-1] if has_comma else row
+        try:
+            obj = loads(json_str)
+        except ValueError as ex:
+            if len(pending) == 0:
+                depth = json_depth_change(line)
+                if depth > 0:
+                    pending = [line]
+                    continue
+            raise json_line_error(mm, row_start, ex)
+        pending = []
+        if in_array and not has_comma:
+            last_row = True
+
+        object_callback(obj, batch, fields, json_str)
+        rows += 1
+        if rows == progress_rows:
+            add_progress(progress_info, mm.tell() - reported, rows)
+            reported = mm.tell()
+            rows = 0
+
+    if len(pending) > 0:
+        raise json_line_error(mm, row_start, "unexpected end of data")
+    batch.send()
+    add_progress(progress_info, end - reported, rows)
+
+# Returns False if the file isn't laid out with one row per line, otherwise
+#  reads it with up to `readers` processes
+def json_line_reader(task_queue, controller, error_queue, filename, db, table, fields, readers, progress_info, exit_event):
+    with open(filename, "rb") as file_in:
+        if os.fstat(file_in.fileno()).st_size == 0:
+            return False
+        mm = mmap.mmap(file_in.fileno(), 0, access=mmap.ACCESS_READ)
+        layout = json_line_layout(mm)
+        if layout is None:
+            return False
+        (in_array, start, end) = layout
+
+        progress_info[0].value = start
+        ranges = split_json(mm, start, end, in_array, min(readers, (end - start) / split_size + 1))
+        read_ranges(filename, mm, ranges, read_json_lines,
+                    (in_array, task_queue, controller, db, table, fields, progress_info, exit_event), error_queue)
+    return True
+
+def json_reader(task_queue, controller, error_queue, filename, db, table, primary_key, fields, readers, progress_info, exit_event):
+    progress_info[1].value = os.path.getsize(filename)
+    if json_line_reader(task_queue, controller, error_queue, filename, db, table, fields, readers, progress_info, exit_event):
+        progress_info[0].value = progress_info[1].value
+        return
 
     with open(filename, "r") as file_in:
         # Scan to the first '[', then load objects one-by-one
         # Read in the data in chunks, since the json module would just read the whole thing at once
         json_data = file_in.read(json_read_chunk_size)
 
-        callback = lambda x: object_callback(x, db, table, task_queue, object_buffers,
-                                             buffer_sizes, fields, exit_event)
-
-        progress_info[1].value = os.path.getsize(filename)
+        batch = Batch(db, table, task_queue, controller, exit_event)
+        callback = lambda x: object_callback(x, batch, fields)
 
         offset = json.decoder.WHITESPACE.match(json_data, 0).end()
         if json_data[offset] == "[":
             json_data = read_json_array(json_data[offset + 1:], file_in, callback, progress_info)
         elif json_data[offset] == "{":
-            json_data = read_json_single_object(json_data[offset:], file_in, callback)
-            progress_info[2].value = 1
+            json_data = read_json_objects(json_data[offset:], file_in, callback, progress_info)
         else:
             raise RuntimeError("Error: JSON format not recognized - file does not begin with an object or array")
 
@@ -395,26 +784,159 @@ def json_reader(task_queue, filename, db, table, primary_key, fields, progress_i
             json_data = file_in.read(json_read_chunk_size)
 
     progress_info[0].value = progress_info[1].value
+    batch.send()
+
+csv_sample_rows = 1000
+csv_count_chunk_size = 1024 * 1024
+csv_number = re.compile(r"-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?$")
+
+# Numbers are stored as doubles, so larger integers than this would be rounded
+max_exact_integer = 2 ** 53
+
+# Numbers that can't be stored exactly are rejected, rather than rounded, so
+#  that inferred columns holding them, like long IDs, stay strings
+def parse_number(value):
+    match = csv_number.match(value)
+    if match is None:
+        raise ValueError("'%s' is not a number" % value)
+    if match.group(2) is None and match.group(3) is None:
+        number = int(value)
+        if abs(number) > max_exact_integer:
+            raise ValueError("'%s' is too large to be stored exactly as a number" % value)
+        return number
+    number = float(value)
+    if math.isinf(number):
+        raise ValueError("'%s' is out of range for a number" % value)
+    return number
+
+def parse_boolean(value):
+    lower = value.lower()
+    if lower == "true":
+        return True
+    elif lower == "false":
+        return False
+    raise ValueError("'%s' is not a boolean" % value)
+
+def parse_json(value):
+    try:
+        return r.get_json_codec().loads(value)
+    except ValueError:
+        raise ValueError("'%s' is not valid JSON" % value)
 
-    if len(object_buffers) > 0:
-        task_queue.put((db, table, object_buffers))
-
-def csv_reader(task_queue, filename, db, table, primary_key, options, progress_info, exit_event):
-    object_buffers = []
-    buffer_sizes = []
-
-    # Count the lines so we can report progress
-    # TODO: this requires us to make two passes on csv files
-    line_count = 0
-    with open(filename, "r") as file_in:
-        for i, l in enumerate(file_in):
-            pass
-        line_count = i + 1
-
-    progress_info[1].value = line_count
+# The types that CSV fields can be imported as, strings being kept as they are
+csv_column_types = {"string": None, "number": parse_number, "boolean": parse_boolean, "json": parse_json}
 
-    with open(filename, "r") as file_in:
-        reader = csv.reader(file_in, delimiter=options["delimiter"])
+# The type of a sample of values from a column, "number" or "boolean" only if
+#  every value is one
+def infer_column_type(values):
+    for column_type in ["boolean", "number"]:
+        try:
+            for value in values:
+                csv_column_types[column_type](value)
+        except ValueError:
+            continue
+        if len(values) > 0:
+            return column_type
+    return "string"
+
+# Converts a field to its column type. Fields of inferred types that turn out
+#  not to match are imported as strings, since the type comes from a sample.
+def csv_converter(column_type, inferred):
+    parse = csv_column_types[column_type]
+    if parse is None or not inferred:
+        return parse
+    def convert(value):
+        try:
+            return parse(value)
+        except ValueError:
+            return value
+    return convert
+
+def count_quotes(mm, start, end):
+    count = 0
+    for pos in xrange(start, end, csv_count_chunk_size):
+        count += mm[pos:min(pos + csv_count_chunk_size, end)].count('"')
+    return count
+
+# Like `split_lines`, but moves each split forward until it isn't inside a
+#  quoted field, which can hold line breaks. This goes by the number of quotes
+#  before the split, so it relies on quotes only appearing around fields and
+#  doubled inside them, as the csv module writes them.
+def split_csv(mm, start, end, count):
+    bounds = [start]
+    quotes = 0
+    for (split, split_end) in split_lines(mm, start, end, count)[1:]:
+        if split <= bounds[-1]:
+            continue
+        quotes += count_quotes(mm, bounds[-1], split)
+        while quotes % 2 == 1:
+            line_end = mm.find("\n", split, end)
+            if line_end < 0:
+                split = end
+                break
+            quotes += count_quotes(mm, split, line_end + 1)
+            split = line_end + 1
+        if split >= end:
+            break
+        bounds.append(split)
+    bounds.append(end)
+    return zip(bounds[:-1], bounds[1:])
+
+# Reads the rows starting between `start` and `end`. `columns` has the index,
+#  field name, type and whether the type was inferred of each column to import.
+def read_csv_rows(mm, start, end, filename, header_lines, data_start, column_count, columns, delimiter,
+                  task_queue, controller, db, table, progress_info, exit_event):
+    batch = Batch(db, table, task_queue, controller, exit_event)
+    converters = [(index, field, csv_converter(column_type, inferred))
+                  for (index, field, column_type, inferred) in columns]
+    reader = csv.reader(mapped_lines(mm, start, end), delimiter=delimiter)
+    reported = start
+    rows = 0
+
+    def location():
+        if start == data_start:
+            return "line %d" % (header_lines + reader.line_num)
+        return "line %d of the part starting at byte %d" % (reader.line_num, start)
+
+    for row in reader:
+        if len(row) != column_count:
+            raise RuntimeError("Error: File '%s' %s has an inconsistent number of columns" % (filename, location()))
+
+        obj = { }
+        for (index, field, convert) in converters:
+            value = row[index]
+            # Treat empty fields as no entry rather than empty string
+            if len(value) == 0:
+                continue
+            if convert is None:
+                obj[field] = value
+            else:
+                try:
+                    obj[field] = convert(value)
+                except ValueError as ex:
+                    raise RuntimeError("Error: File '%s' %s, field '%s': %s" % (filename, location(), field, ex))
+
+        object_callback(obj, batch, None)
+        rows += 1
+        if rows == progress_rows:
+            add_progress(progress_info, mm.tell() - reported, rows)
+            reported = mm.tell()
+            rows = 0
+
+    batch.send()
+    add_progress(progress_info, end - reported, rows)
+
+# The inferred column types are put on `info_queue` for the parent to print
+#  once the progress bar is done
+def csv_reader(task_queue, controller, error_queue, info_queue, filename, db, table, primary_key, options, progress_info, exit_event):
+    progress_info[1].value = os.path.getsize(filename)
+    if progress_info[1].value == 0:
+        progress_info[0].value = 0
+        return
+
+    with open(filename, "rb") as file_in:
+        mm = mmap.mmap(file_in.fileno(), 0, access=mmap.ACCESS_READ)
+        reader = csv.reader(mapped_lines(mm, 0, len(mm)), delimiter=options["delimiter"])
 
         if not options["no_header"]:
             fields_in = reader.next()
@@ -427,23 +949,38 @@ def csv_reader(task_queue, filename, db, table, primary_key, options, progress_i
         elif options["no_header"]:
             raise RuntimeError("Error: No field name information available")
 
-        for row in reader:
-            file_line = reader.line_num
-            progress_info[0].value = file_line
-            if len(fields_in) != len(row):
-                raise RuntimeError("Error: File '%s' line %d has an inconsistent number of columns" % (filename, file_line))
-            # We import all csv fields as strings (since we can't assume the type of the data)
-            obj = dict(zip(fields_in, row))
-            for key in list(obj.iterkeys()): # Treat empty fields as no entry rather than empty string
-                if len(obj[key]) == 0:
-                    del obj[key]
-            object_callback(obj, db, table, task_queue, object_buffers, buffer_sizes, options["fields"], exit_event)
-            progress_info[2].value += 1
+        header_lines = reader.line_num
+        data_start = mm.tell()
+
+        column_types = { }
+        if options["infer_types"]:
+            sample = [row for (i, row) in zip(xrange(csv_sample_rows), reader)]
+            for (index, field) in enumerate(fields_in):
+                column_types[field] = (infer_column_type([row[index] for row in sample
+                                                          if index < len(row) and len(row[index]) > 0]), True)
+            info_queue.put((db, table, ", ".join(["%s:%s" % (field, column_types[field][0]) for field in fields_in])))
+
+        if options["column_types"] is not None:
+            for (field, column_type) in options["column_types"].iteritems():
+                if field not in fields_in:
+                    raise RuntimeError("Error: Field '%s' given in --column-types is not in the file" % field)
+                column_types[field] = (column_type, False)
+
+        columns = []
+        for (index, field) in enumerate(fields_in):
+            if options["fields"] is None or field in options["fields"]:
+                (column_type, inferred) = column_types.get(field, ("string", False))
+                columns.append((index, field, column_type, inferred))
+
+        progress_info[0].value = data_start
+        ranges = split_csv(mm, data_start, len(mm), min(options["readers"], (len(mm) - data_start) / split_size + 1))
+        read_ranges(filename, mm, ranges, read_csv_rows,
+                    (filename, header_lines, data_start, len(fields_in), columns, options["delimiter"],
+                     task_queue, controller, db, table, progress_info, exit_event), error_queue)
 
-    if len(object_buffers) > 0:
-        task_queue.put((db, table, object_buffers))
+    progress_info[0].value = progress_info[1].value
 
-def table_reader(options, file_info, task_queue, error_queue, progress_info, exit_event):
+def table_reader(options, file_info, task_queue, controller, error_queue, info_queue, progress_info, exit_event):
     try:
         db = file_info["db"]
         table = file_info["table"]
@@ -453,16 +990,23 @@ def table_reader(options, file_info, task_queue, error_queue, progress_info, exi
         if table not in r.db(db).table_list().run(conn):
             r.db(db).table_create(table, primary_key=primary_key).run(conn)
 
+        controller.start()
         if file_info["format"] == "json":
             json_reader(task_queue,
+                        controller,
+                        error_queue,
                         file_info["file"],
                         db, table,
                         primary_key,
                         options["fields"],
+                        options["readers"],
                         progress_info,
                         exit_event)
         elif file_info["format"] == "csv":
             csv_reader(task_queue,
+                       controller,
+                       error_queue,
+                       info_queue,
                        file_info["file"],
                        db, table,
                        primary_key,
@@ -479,18 +1023,13 @@ def table_reader(options, file_info, task_queue, error_queue, progress_info, exi
         ex_type, ex_class, tb = sys.exc_info()
         error_queue.put((ex_type, ex_class, traceback.extract_tb(tb), file_info["file"]))
 
-def abort_import(signum, frame, parent_pid, exit_event, task_queue, clients, interrupt_event):
+# Clients and readers stop by themselves once `exit_event` is set
+def abort_import(signum, frame, parent_pid, exit_event, interrupt_event):
     # Only do the abort from the parent process
     if os.getpid() == parent_pid:
         interrupt_event.set()
         exit_event.set()
 
-        alive_clients = sum([client.is_alive() for client in clients])
-        for i in xrange(alive_clients):
-            # TODO: this could theoretically block indefinitely if
-            #   the queue is full and clients aren't reading
-            task_queue.put("exit")
-
 def print_progress(ratio):
     total_width = 40
     done_width = int(ratio * total_width)
@@ -514,8 +1053,9 @@ def update_progress(progress_info):
 
 def spawn_import_clients(options, files_info):
     # Spawn one reader process for each db.table, as well as many client processes
-    task_queue = multiprocessing.queues.SimpleQueue()
+    task_queue = multiprocessing.Queue(options["clients"] * client_queue_depth)
     error_queue = multiprocessing.queues.SimpleQueue()
+    info_queue = multiprocessing.queues.SimpleQueue()
     exit_event = multiprocessing.Event()
     interrupt_event = multiprocessing.Event()
     errors = []
@@ -523,10 +1063,11 @@ def spawn_import_clients(options, files_info):
     client_procs = []
 
     parent_pid = os.getpid()
-    signal.signal(signal.SIGINT, lambda a,b: abort_import(a, b, parent_pid, exit_event, task_queue, client_procs, interrupt_event))
+    signal.signal(signal.SIGINT, lambda a,b: abort_import(a, b, parent_pid, exit_event, interrupt_event))
 
     try:
         progress_info = [ ]
+        controllers = dict(((file_info["db"], file_info["table"]), BatchController()) for file_info in files_info)
 
         for i in range(options["clients"]):
             client_procs.append(multiprocessing.Process(target=client_process,
@@ -535,8 +1076,10 @@ def spawn_import_clients(options, files_info):
                                                               options["auth_key"],
                                                               task_queue,
                                                               error_queue,
+                                                              controllers,
                                                               options["force"],
-                                                              options["durability"])))
+                                                              options["durability"],
+                                                              exit_event)))
             client_procs[-1].start()
 
         for file_info in files_info:
@@ -547,7 +1090,9 @@ def spawn_import_clients(options, files_info):
                                                         args=(options,
                                                               file_info,
                                                               task_queue,
+                                                              controllers[(file_info["db"], file_info["table"])],
                                                               error_queue,
+                                                              info_queue,
                                                               progress_info[-1],
                                                               exit_event)))
             reader_procs[-1].start()
@@ -558,13 +1103,21 @@ def spawn_import_clients(options, files_info):
             # If an error has occurred, exit out early
             if not error_queue.empty():
                 exit_event.set()
+            if exit_event.is_set():
+                # Readers can't exit while their batches wait to be written to the queue
+                try:
+                    while True:
+                        task_queue.get_nowait()
+                except Queue.Empty:
+                    pass
             reader_procs = [proc for proc in reader_procs if proc.is_alive()]
             update_progress(progress_info)
 
-        # Wait for all clients to finish
-        alive_clients = sum([client.is_alive() for client in client_procs])
-        for i in xrange(alive_clients):
-            task_queue.put("exit")
+        # Wait for all clients to finish, they have already been told to if the import failed
+        if not exit_event.is_set():
+            alive_clients = sum([client.is_alive() for client in client_procs])
+            for i in xrange(alive_clients):
+                task_queue.put("exit")
 
         while len(client_procs) > 0:
             time.sleep(0.1)
@@ -581,6 +1134,14 @@ def spawn_import_clients(options, files_info):
         print ""
         print "%s imported in %s" % (plural(sum([info[2].value for info in progress_info]), "row"),
                                        plural(len(files_info), "table"))
+        for file_info in files_info:
+            (rows, size, elapsed) = controllers[(file_info["db"], file_info["table"])].get_totals()
+            if elapsed > 0:
+                print "  %s.%s: %s in %.1f seconds (%d rows/s, %.2f MB/s)" % \
+                    (file_info["db"], file_info["table"], plural(rows, "row"), elapsed,
+                     rows / elapsed, size / elapsed / (1024 * 1024))
+        while not info_queue.empty():
+            print "  %s.%s: inferred column types %s" % info_queue.get()
     finally:
         signal.signal(signal.SIGINT, signal.SIG_DFL)
 
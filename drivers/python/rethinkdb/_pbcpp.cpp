@@ -1,9 +1,520 @@
-// This is an empty python module. It gets linked to ql2.pb.o, whose functions get
-// exposed and used by the C++ implementation of the google.protobuf package.
+// This module gets linked to ql2.pb.o, whose functions get exposed and used by
+// the C++ implementation of the google.protobuf package.
+//
+// It also decodes responses into Python values without going through
+// protobuf messages. `decode_response` reads the fields of a serialized
+// Response and leaves its datums serialized, since how they are converted
+// depends on the options of the query they answer. They are then converted
+// by `decode_datum`, which does what `Datum.deconstruct` does in Python, or by
+// `join_json`, which joins a batch of R_JSON datums into one JSON array.
 
+#define PY_SSIZE_T_CLEAN
 #include <python2.7/Python.h>
 
+#include <limits.h>
+#include <math.h>
+#include <stdint.h>
+#include <string.h>
+
+// Protobuf wire types
+enum { WIRE_VARINT = 0, WIRE_64BIT = 1, WIRE_BYTES = 2, WIRE_32BIT = 5 };
+
+// Field numbers and enum values from ql2.proto
+enum { RESPONSE_TYPE = 1, RESPONSE_TOKEN = 2, RESPONSE_RESPONSE = 3, RESPONSE_BACKTRACE = 4, RESPONSE_PROFILE = 5 };
+enum { BACKTRACE_FRAMES = 1 };
+enum { FRAME_TYPE = 1, FRAME_POS = 2, FRAME_OPT = 3 };
+enum { DATUM_TYPE = 1, DATUM_R_BOOL = 2, DATUM_R_NUM = 3, DATUM_R_STR = 4, DATUM_R_ARRAY = 5, DATUM_R_OBJECT = 6 };
+enum { ASSOC_PAIR_KEY = 1, ASSOC_PAIR_VAL = 2 };
+enum { R_NULL = 1, R_BOOL = 2, R_NUM = 3, R_STR = 4, R_ARRAY = 5, R_OBJECT = 6, R_JSON = 7 };
+enum { FRAME_TYPE_POS = 1 };
+
+struct reader_t {
+    const unsigned char *pos;
+    const unsigned char *end;
+};
+
+// A field read off the wire. Varints are in `varint`, everything else is the
+// `size` bytes at `data`.
+struct field_t {
+    int number;
+    int wire_type;
+    uint64_t varint;
+    const unsigned char *data;
+    size_t size;
+};
+
+static bool read_varint(reader_t *reader, uint64_t *out) {
+    uint64_t result = 0;
+    for (int shift = 0; shift < 64; shift += 7) {
+        if (reader->pos >= reader->end) {
+            return false;
+        }
+        unsigned char byte = *reader->pos++;
+        result |= static_cast<uint64_t>(byte & 0x7f) << shift;
+        if ((byte & 0x80) == 0) {
+            *out = result;
+            return true;
+        }
+    }
+    return false;
+}
+
+static bool read_bytes(reader_t *reader, size_t size, field_t *field) {
+    if (static_cast<size_t>(reader->end - reader->pos) < size) {
+        return false;
+    }
+    field->data = reader->pos;
+    field->size = size;
+    reader->pos += size;
+    return true;
+}
+
+static bool read_field(reader_t *reader, field_t *field) {
+    uint64_t key;
+    if (!read_varint(reader, &key)) {
+        return false;
+    }
+    field->number = static_cast<int>(key >> 3);
+    field->wire_type = static_cast<int>(key & 7);
+
+    uint64_t size;
+    switch (field->wire_type) {
+    case WIRE_VARINT:
+        return read_varint(reader, &field->varint);
+    case WIRE_64BIT:
+        return read_bytes(reader, 8, field);
+    case WIRE_32BIT:
+        return read_bytes(reader, 4, field);
+    case WIRE_BYTES:
+        if (!read_varint(reader, &size)) {
+            return false;
+        }
+        return read_bytes(reader, size, field);
+    default:
+        return false;
+    }
+}
+
+// The double in a 64-bit field, which is always little-endian on the wire
+static double field_double(const field_t *field) {
+    uint64_t bits = 0;
+    for (int i = 7; i >= 0; --i) {
+        bits = (bits << 8) | field->data[i];
+    }
+    double result;
+    memcpy(&result, &bits, sizeof(result));
+    return result;
+}
+
+static PyObject *field_unicode(const field_t *field) {
+    return PyUnicode_DecodeUTF8(reinterpret_cast<const char *>(field->data), field->size, NULL);
+}
+
+// An int64 field as a Python int, like in a parsed message
+static PyObject *int64_object(int64_t value) {
+    if (value >= LONG_MIN && value <= LONG_MAX) {
+        return PyInt_FromLong(static_cast<long>(value));
+    }
+    return PyLong_FromLongLong(value);
+}
+
+static PyObject *malformed(const char *what) {
+    PyErr_Format(PyExc_ValueError, "Malformed %s in response.", what);
+    return NULL;
+}
+
+// What the conversion of datums calls back into Python for
+struct decode_context_t {
+    PyObject *format_opts;
+    PyObject *convert_pseudotype;
+    PyObject *loads_json;
+};
+
+// Like `num % 1 == 0 and int(num) or num` in Python
+static PyObject *number(double num) {
+    if (isfinite(num) && floor(num) == num) {
+        if (num >= static_cast<double>(LONG_MIN) && num < static_cast<double>(LONG_MAX)) {
+            return PyInt_FromLong(static_cast<long>(num));
+        }
+        return PyLong_FromDouble(num);
+    }
+    return PyFloat_FromDouble(num);
+}
+
+static PyObject *decode_datum_bytes(const unsigned char *data, size_t size, const decode_context_t *context);
+
+static PyObject *decode_array(const unsigned char *data, size_t size, const decode_context_t *context) {
+    PyObject *array = PyList_New(0);
+    if (array == NULL) {
+        return NULL;
+    }
+    reader_t reader = { data, data + size };
+    field_t field;
+    while (reader.pos < reader.end) {
+        if (!read_field(&reader, &field)) {
+            Py_DECREF(array);
+            return malformed("datum");
+        }
+        if (field.number == DATUM_R_ARRAY && field.wire_type == WIRE_BYTES) {
+            PyObject *value = decode_datum_bytes(field.data, field.size, context);
+            if (value == NULL || PyList_Append(array, value) < 0) {
+                Py_XDECREF(value);
+                Py_DECREF(array);
+                return NULL;
+            }
+            Py_DECREF(value);
+        }
+    }
+    return array;
+}
+
+static bool decode_assoc_pair(const field_t *pair, PyObject *obj, const decode_context_t *context) {
+    field_t key = { 0, 0, 0, NULL, 0 };
+    field_t val = { 0, 0, 0, NULL, 0 };
+    reader_t reader = { pair->data, pair->data + pair->size };
+    field_t field;
+    while (reader.pos < reader.end) {
+        if (!read_field(&reader, &field)) {
+            malformed("datum");
+            return false;
+        }
+        if (field.wire_type != WIRE_BYTES) {
+            continue;
+        } else if (field.number == ASSOC_PAIR_KEY) {
+            key = field;
+        } else if (field.number == ASSOC_PAIR_VAL) {
+            val = field;
+        }
+    }
+
+    PyObject *py_key = field_unicode(&key);
+    if (py_key == NULL) {
+        return false;
+    }
+    PyObject *py_val = decode_datum_bytes(val.data, val.size, context);
+    if (py_val == NULL) {
+        Py_DECREF(py_key);
+        return false;
+    }
+    int res = PyDict_SetItem(obj, py_key, py_val);
+    Py_DECREF(py_key);
+    Py_DECREF(py_val);
+    return res == 0;
+}
+
+static PyObject *decode_object(const unsigned char *data, size_t size, const decode_context_t *context) {
+    PyObject *obj = PyDict_New();
+    if (obj == NULL) {
+        return NULL;
+    }
+    reader_t reader = { data, data + size };
+    field_t field;
+    while (reader.pos < reader.end) {
+        if (!read_field(&reader, &field)) {
+            Py_DECREF(obj);
+            return malformed("datum");
+        }
+        if (field.number == DATUM_R_OBJECT && field.wire_type == WIRE_BYTES) {
+            if (!decode_assoc_pair(&field, obj, context)) {
+                Py_DECREF(obj);
+                return NULL;
+            }
+        }
+    }
+
+    // `Datum._convert_pseudotype` returns any other object as it is
+    if (PyDict_GetItemString(obj, "$reql_type$") == NULL) {
+        return obj;
+    }
+    PyObject *converted = PyObject_CallFunctionObjArgs(context->convert_pseudotype, obj, context->format_opts, NULL);
+    Py_DECREF(obj);
+    return converted;
+}
+
+static PyObject *decode_datum_bytes(const unsigned char *data, size_t size, const decode_context_t *context) {
+    // Unset fields have their default values, like in a parsed message
+    int type = R_NULL;
+    bool r_bool = false;
+    double r_num = 0;
+    field_t r_str = { 0, 0, 0, NULL, 0 };
+
+    reader_t reader = { data, data + size };
+    field_t field;
+    while (reader.pos < reader.end) {
+        if (!read_field(&reader, &field)) {
+            return malformed("datum");
+        }
+        if (field.number == DATUM_TYPE && field.wire_type == WIRE_VARINT) {
+            type = static_cast<int>(field.varint);
+        } else if (field.number == DATUM_R_BOOL && field.wire_type == WIRE_VARINT) {
+            r_bool = field.varint != 0;
+        } else if (field.number == DATUM_R_NUM && field.wire_type == WIRE_64BIT) {
+            r_num = field_double(&field);
+        } else if (field.number == DATUM_R_STR && field.wire_type == WIRE_BYTES) {
+            r_str = field;
+        }
+    }
+
+    PyObject *result = NULL;
+    PyObject *json_text;
+    switch (type) {
+    case R_NULL:
+        Py_RETURN_NONE;
+    case R_BOOL:
+        return PyBool_FromLong(r_bool);
+    case R_NUM:
+        return number(r_num);
+    case R_STR:
+        return field_unicode(&r_str);
+    case R_JSON:
+        json_text = field_unicode(&r_str);
+        if (json_text != NULL) {
+            result = PyObject_CallFunctionObjArgs(context->loads_json, json_text, context->format_opts, NULL);
+            Py_DECREF(json_text);
+        }
+        return result;
+    case R_ARRAY:
+        if (Py_EnterRecursiveCall(" while decoding a datum") == 0) {
+            result = decode_array(data, size, context);
+            Py_LeaveRecursiveCall();
+        }
+        return result;
+    case R_OBJECT:
+        if (Py_EnterRecursiveCall(" while decoding a datum") == 0) {
+            result = decode_object(data, size, context);
+            Py_LeaveRecursiveCall();
+        }
+        return result;
+    default:
+        PyErr_Format(PyExc_RuntimeError, "Unknown Datum type %d encountered in response.", type);
+        return NULL;
+    }
+}
+
+// Sets `r_str` to the JSON of an R_JSON datum and returns 1, or returns 0 for
+// other datums and -1 if the datum is malformed
+static int datum_json(const unsigned char *data, size_t size, field_t *r_str) {
+    int type = R_NULL;
+    r_str->data = NULL;
+    r_str->size = 0;
+
+    reader_t reader = { data, data + size };
+    field_t field;
+    while (reader.pos < reader.end) {
+        if (!read_field(&reader, &field)) {
+            malformed("datum");
+            return -1;
+        }
+        if (field.number == DATUM_TYPE && field.wire_type == WIRE_VARINT) {
+            type = static_cast<int>(field.varint);
+        } else if (field.number == DATUM_R_STR && field.wire_type == WIRE_BYTES) {
+            *r_str = field;
+        }
+    }
+    return type == R_JSON ? 1 : 0;
+}
+
+static PyObject *decode_frame(const field_t *frame) {
+    long type = FRAME_TYPE_POS;
+    int64_t pos = 0;
+    field_t opt = { 0, 0, 0, NULL, 0 };
+
+    reader_t reader = { frame->data, frame->data + frame->size };
+    field_t field;
+    while (reader.pos < reader.end) {
+        if (!read_field(&reader, &field)) {
+            return malformed("backtrace");
+        }
+        if (field.number == FRAME_TYPE && field.wire_type == WIRE_VARINT) {
+            type = static_cast<long>(field.varint);
+        } else if (field.number == FRAME_POS && field.wire_type == WIRE_VARINT) {
+            pos = static_cast<int64_t>(field.varint);
+        } else if (field.number == FRAME_OPT && field.wire_type == WIRE_BYTES) {
+            opt = field;
+        }
+    }
+
+    PyObject *py_opt = field_unicode(&opt);
+    if (py_opt == NULL) {
+        return NULL;
+    }
+    return Py_BuildValue("(lNN)", type, int64_object(pos), py_opt);
+}
+
+static bool decode_backtrace(const field_t *backtrace, PyObject *frames) {
+    reader_t reader = { backtrace->data, backtrace->data + backtrace->size };
+    field_t field;
+    while (reader.pos < reader.end) {
+        if (!read_field(&reader, &field)) {
+            malformed("backtrace");
+            return false;
+        }
+        if (field.number == BACKTRACE_FRAMES && field.wire_type == WIRE_BYTES) {
+            PyObject *frame = decode_frame(&field);
+            if (frame == NULL || PyList_Append(frames, frame) < 0) {
+                Py_XDECREF(frame);
+                return false;
+            }
+            Py_DECREF(frame);
+        }
+    }
+    return true;
+}
+
+// decode_response(buf) -> (type, token, datums, frames, profile)
+//
+// `datums` is a list of the serialized datums of the response, `frames` a
+// list of (type, pos, opt) tuples and `profile` the serialized profile datum,
+// or None if there is none.
+static PyObject *decode_response(PyObject *self, PyObject *args) {
+    Py_buffer buf;
+    if (!PyArg_ParseTuple(args, "s*:decode_response", &buf)) {
+        return NULL;
+    }
+
+    long type = 0;
+    int64_t token = 0;
+    PyObject *datums = PyList_New(0);
+    PyObject *frames = PyList_New(0);
+    PyObject *profile = NULL;
+    bool ok = datums != NULL && frames != NULL;
+
+    const unsigned char *data = static_cast<const unsigned char *>(buf.buf);
+    reader_t reader = { data, data + buf.len };
+    field_t field;
+    while (ok && reader.pos < reader.end) {
+        if (!read_field(&reader, &field)) {
+            malformed("response");
+            ok = false;
+        } else if (field.number == RESPONSE_TYPE && field.wire_type == WIRE_VARINT) {
+            type = static_cast<long>(field.varint);
+        } else if (field.number == RESPONSE_TOKEN && field.wire_type == WIRE_VARINT) {
+            token = static_cast<int64_t>(field.varint);
+        } else if (field.wire_type != WIRE_BYTES) {
+            continue;
+        } else if (field.number == RESPONSE_RESPONSE) {
+            PyObject *datum = PyString_FromStringAndSize(reinterpret_cast<const char *>(field.data), field.size);
+            ok = datum != NULL && PyList_Append(datums, datum) == 0;
+            Py_XDECREF(datum);
+        } else if (field.number == RESPONSE_BACKTRACE) {
+            ok = decode_backtrace(&field, frames);
+        } else if (field.number == RESPONSE_PROFILE) {
+            Py_XDECREF(profile);
+            profile = PyString_FromStringAndSize(reinterpret_cast<const char *>(field.data), field.size);
+            ok = profile != NULL;
+        }
+    }
+    PyBuffer_Release(&buf);
+
+    if (!ok) {
+        Py_XDECREF(datums);
+        Py_XDECREF(frames);
+        Py_XDECREF(profile);
+        return NULL;
+    }
+    if (profile == NULL) {
+        Py_INCREF(Py_None);
+        profile = Py_None;
+    }
+    return Py_BuildValue("(lNNNN)", type, int64_object(token), datums, frames, profile);
+}
+
+// decode_datum(datum, format_opts, convert_pseudotype, loads_json) -> value
+//
+// Converts a serialized datum like `Datum.deconstruct` converts a parsed
+// one. Objects with a "$reql_type$" field are passed to
+// `convert_pseudotype(obj, format_opts)` and the JSON of R_JSON datums to
+// `loads_json(json_str, format_opts)`.
+static PyObject *decode_datum(PyObject *self, PyObject *args) {
+    const char *data;
+    Py_ssize_t size;
+    decode_context_t context;
+    if (!PyArg_ParseTuple(args, "s#OOO:decode_datum", &data, &size, &context.format_opts,
+                          &context.convert_pseudotype, &context.loads_json)) {
+        return NULL;
+    }
+    return decode_datum_bytes(reinterpret_cast<const unsigned char *>(data), size, &context);
+}
+
+// json_str(datum) -> the JSON of an R_JSON datum, or None for other datums
+static PyObject *json_str(PyObject *self, PyObject *args) {
+    const char *data;
+    Py_ssize_t size;
+    if (!PyArg_ParseTuple(args, "s#:json_str", &data, &size)) {
+        return NULL;
+    }
+    field_t r_str;
+    int res = datum_json(reinterpret_cast<const unsigned char *>(data), size, &r_str);
+    if (res < 0) {
+        return NULL;
+    } else if (res == 0) {
+        Py_RETURN_NONE;
+    }
+    return field_unicode(&r_str);
+}
+
+// join_json(datums) -> the JSON of a list of R_JSON datums joined into one
+// JSON array, or None if any of them is not R_JSON
+static PyObject *join_json(PyObject *self, PyObject *args) {
+    PyObject *datums;
+    if (!PyArg_ParseTuple(args, "O!:join_json", &PyList_Type, &datums)) {
+        return NULL;
+    }
+
+    Py_ssize_t count = PyList_GET_SIZE(datums);
+    field_t *json_strs = static_cast<field_t *>(PyMem_Malloc(sizeof(field_t) * (count > 0 ? count : 1)));
+    if (json_strs == NULL) {
+        return PyErr_NoMemory();
+    }
+
+    size_t total = 2 + (count > 0 ? count - 1 : 0);
+    for (Py_ssize_t i = 0; i < count; ++i) {
+        PyObject *datum = PyList_GET_ITEM(datums, i);
+        if (!PyString_Check(datum)) {
+            PyMem_Free(json_strs);
+            PyErr_SetString(PyExc_TypeError, "join_json expects a list of serialized datums.");
+            return NULL;
+        }
+        int res = datum_json(reinterpret_cast<const unsigned char *>(PyString_AS_STRING(datum)),
+                             PyString_GET_SIZE(datum), &json_strs[i]);
+        if (res <= 0) {
+            PyMem_Free(json_strs);
+            if (res < 0) {
+                return NULL;
+            }
+            Py_RETURN_NONE;
+        }
+        total += json_strs[i].size;
+    }
+
+    // Joined as UTF-8 and decoded once
+    char *joined = static_cast<char *>(PyMem_Malloc(total));
+    if (joined == NULL) {
+        PyMem_Free(json_strs);
+        return PyErr_NoMemory();
+    }
+    char *pos = joined;
+    *pos++ = '[';
+    for (Py_ssize_t i = 0; i < count; ++i) {
+        if (i > 0) {
+            *pos++ = ',';
+        }
+        memcpy(pos, json_strs[i].data, json_strs[i].size);
+        pos += json_strs[i].size;
+    }
+    *pos++ = ']';
+
+    PyObject *result = PyUnicode_DecodeUTF8(joined, total, NULL);
+    PyMem_Free(joined);
+    PyMem_Free(json_strs);
+    return result;
+}
+
 static PyMethodDef PbMethods[] = {
+    {"decode_response", decode_response, METH_VARARGS, NULL},
+    {"decode_datum", decode_datum, METH_VARARGS, NULL},
+    {"json_str", json_str, METH_VARARGS, NULL},
+    {"join_json", join_json, METH_VARARGS, NULL},
     {NULL, NULL, 0, NULL}
 };
 
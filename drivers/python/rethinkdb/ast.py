@@ -1,4 +1,4 @@
-from . import ql2_pb2 as p
+from . import ql2 as p
 import types
 import sys
 import datetime
@@ -6,95 +6,327 @@ import numbers
 import collections
 import time
 import re
+import struct
 import json as py_json
-from threading import Lock
+import itertools
 from .errors import *
 from . import repl # For the repl connection
+from . import json_codec
+
+# The deepest nesting of lists and dicts accepted when converting Python
+# values. Values are converted without recursion, so any limit works; it
+# mostly guards against cyclic data. Note that the server may still refuse
+# very deep queries unless they are sent as JSON.
+nesting_depth_limit = 20
+
+def set_nesting_depth(limit):
+    global nesting_depth_limit
+    if limit < 1:
+        raise RqlDriverError("The nesting depth limit must be at least 1.")
+    nesting_depth_limit = limit
 
 # This is both an external function and one used extensively
 # internally to convert coerce python values to RQL types
-def expr(val, nesting_depth=20):
+def expr(val, nesting_depth=None):
     '''
         Convert a Python primitive into a RQL primitive value
     '''
+    if nesting_depth is None:
+        nesting_depth = nesting_depth_limit
     if nesting_depth <= 0:
         raise RqlDriverError("Nesting depth limit exceeded")
 
-    if isinstance(val, RqlQuery):
+    if not isinstance(val, (list, dict)):
+        return leaf_term(val)
+
+    # Lists and dicts are converted children first using an explicit stack.
+    # Each frame holds a container, an iterator over the values in it and
+    # the terms for the values converted so far.
+    stack = [(val, container_values(val), [])]
+    while True:
+        (container, values, terms) = stack[-1]
+        for v in values:
+            if len(stack) >= nesting_depth:
+                raise RqlDriverError("Nesting depth limit exceeded")
+            if isinstance(v, (list, dict)):
+                stack.append((v, container_values(v), []))
+                break
+            terms.append(leaf_term(v))
+        else:
+            stack.pop()
+            if isinstance(container, list):
+                term = MakeArray(*terms)
+            else:
+                # MakeObj doesn't take the dict as a keyword args to avoid
+                # conflicting with the `self` parameter.
+                term = MakeObj(dict(zip(container.keys(), terms)))
+            if len(stack) == 0:
+                return term
+            stack[-1][2].append(term)
+
+def container_values(val):
+    if isinstance(val, list):
+        return iter(val)
+    return val.itervalues()
+
+# Converts anything but a list or a dict
+def leaf_term(val):
+    if type(val) in json_scalar_types:
+        return Datum(val)
+    elif isinstance(val, RqlQuery):
         return val
     elif isinstance(val, datetime.datetime) or isinstance(val, datetime.date):
-        if not hasattr(val, 'tzinfo') or not val.tzinfo:
-            raise RqlDriverError("""Cannot convert %s to ReQL time object
-            without timezone information. You can add timezone information with
-            the third party module \"pytz\" or by constructing ReQL compatible
-            timezone values with r.make_timezone(\"[+-]HH:MM\"). Alternatively,
-            use one of ReQL's bultin time constructors, r.now, r.time, or r.iso8601.
-            """ % (type(val).__name__))
-        return ISO8601(val.isoformat())
-    elif isinstance(val, list):
-        val = [expr(v, nesting_depth - 1) for v in val]
-        return MakeArray(*val)
-    elif isinstance(val, dict):
-        # MakeObj doesn't take the dict as a keyword args to avoid
-        # conflicting with the `self` parameter.
-        obj = {}
-        for k in val.keys():
-            obj[k] = expr(val[k], nesting_depth - 1)
-        return MakeObj(obj)
+        return MakeObj(datetime_to_reql_time(val))
     elif isinstance(val, collections.Callable):
         return Func(val)
     else:
         return Datum(val)
 
+# Datetimes are sent as TIME pseudotypes, which the server takes as they are
+# rather than having to parse an ISO 8601 string
+def datetime_to_reql_time(val):
+    if not hasattr(val, 'tzinfo') or val.utcoffset() is None:
+        raise RqlDriverError("""Cannot convert %s to ReQL time object
+        without timezone information. You can add timezone information with
+        the third party module \"pytz\" or by constructing ReQL compatible
+        timezone values with r.make_timezone(\"[+-]HH:MM\"). Alternatively,
+        use one of ReQL's bultin time constructors, r.now, r.time, or r.iso8601.
+        """ % (type(val).__name__))
+
+    offset = val.utcoffset()
+    minutes = offset.days * 1440 + offset.seconds // 60
+    sign = '+' if minutes >= 0 else '-'
+    utc = val.replace(tzinfo=None) - offset
+    return {'$reql_type$': 'TIME',
+            'epoch_time': (utc - naive_epoch).total_seconds(),
+            'timezone': '%s%02d:%02d' % (sign, abs(minutes) // 60, abs(minutes) % 60)}
+
+naive_epoch = datetime.datetime(1970, 1, 1)
+
+# Passed to the JSON codec for the values it cannot encode itself
+def json_default(val):
+    if isinstance(val, datetime.date):
+        return datetime_to_reql_time(val)
+    raise TypeError("%r is not JSON serializable" % (val,))
+
 # Like expr but attempts to serialize as much of the value as JSON
 # as possible.
-def exprJSON(val, nesting_depth=20):
+def exprJSON(val, nesting_depth=None):
+    term = json_term(val, nesting_depth)
+    if term is None:
+        return Json(json_codec.get_json_codec().dumps(val, json_default))
+    return term
+
+# Values of these types are sent as they are by `exprJSON`
+json_scalar_types = frozenset([int, long, float, str, unicode, bool, type(None)])
+
+# Walks `val` once, returning None if all of it can be sent as JSON, or else
+# a query in which every subtree that can be sent as JSON is a single `Json`
+# term (or a `Datum` for scalars) and everything else, like datetimes and
+# queries, goes through `expr`.
+def json_term(val, nesting_depth=None):
+    if nesting_depth is None:
+        nesting_depth = nesting_depth_limit
     if nesting_depth <= 0:
         raise RqlDriverError("Nesting depth limit exceeded")
 
-    if isinstance(val, RqlQuery):
+    if not isinstance(val, (list, dict)):
+        return json_leaf_term(val)
+    elif isinstance(val, dict) and not all_string_keys(val):
+        # Let MakeObj report the bad key
+        return expr(val, nesting_depth)
+
+    # Like `expr`, without recursion. Each frame holds a container, an
+    # iterator over its (key or index, value) pairs and a dict with the terms
+    # for the values that cannot be sent as JSON, or None if there are none.
+    stack = [[val, container_items(val), None]]
+    while True:
+        frame = stack[-1]
+        for (k, v) in frame[1]:
+            if len(stack) >= nesting_depth:
+                raise RqlDriverError("Nesting depth limit exceeded")
+            if isinstance(v, (list, dict)):
+                if isinstance(v, dict) and not all_string_keys(v):
+                    # Let MakeObj report the bad key
+                    term = expr(v, nesting_depth - len(stack))
+                else:
+                    stack.append([v, container_items(v), None, k])
+                    break
+            else:
+                term = json_leaf_term(v)
+            if term is not None:
+                if frame[2] is None:
+                    frame[2] = { }
+                frame[2][k] = term
+        else:
+            stack.pop()
+            term = json_container_term(frame[0], frame[2])
+            if len(stack) == 0:
+                return term
+            if term is not None:
+                if stack[-1][2] is None:
+                    stack[-1][2] = { }
+                stack[-1][2][frame[3]] = term
+
+def container_items(val):
+    if isinstance(val, list):
+        return enumerate(val)
+    return val.iteritems()
+
+def all_string_keys(val):
+    for k in val:
+        if not isinstance(k, types.StringTypes):
+            return False
+    return True
+
+def json_leaf_term(val):
+    if type(val) in json_scalar_types:
+        return None
+    elif isinstance(val, RqlQuery):
         return val
-    elif isJSON(val, nesting_depth):
-        return Json(py_json.dumps(val))
-    elif isinstance(val, dict):
-        copy = val.copy()
-        for k,v in copy.items():
-            copy[k] = exprJSON(v, nesting_depth)
-        return MakeObj(copy)
-    elif isinstance(val, list):
-        copy = []
-        for v in val:
-            copy.append(exprJSON(v, nesting_depth))
-        return MakeArray(*copy)
+    elif isinstance(val, (int, long, float, basestring)):
+        return None
+    elif isinstance(val, datetime.datetime) and val.utcoffset() is not None:
+        # Encoded by `json_default`
+        return None
     else:
         # Default to datum serialization
-        return expr(val, nesting_depth - 1)
+        return leaf_term(val)
+
+# Builds the term for a container given the terms for its values that cannot
+# be sent as JSON
+def json_container_term(val, terms):
+    if terms is None:
+        return None
+    elif isinstance(val, list):
+        return MakeArray(*[terms[i] if i in terms else json_leaf(v) for (i, v) in enumerate(val)])
+    else:
+        obj = { }
+        for (k, v) in val.iteritems():
+            obj[k] = terms[k] if k in terms else json_leaf(v)
+        return MakeObj(obj)
 
-def isJSON(val, nesting_depth=20):
+# The term for a value `json_term` found can be sent as JSON
+def json_leaf(val):
+    if type(val) in json_scalar_types:
+        return Datum(val)
+    return Json(json_codec.get_json_codec().dumps(val, json_default))
+
+def isJSON(val, nesting_depth=None):
+    if nesting_depth is None:
+        nesting_depth = nesting_depth_limit
     if nesting_depth <= 0:
         raise RqlDriverError("Nesting depth limit exceeded")
 
-    if isinstance(val, RqlQuery):
-        return False
-    elif isinstance(val, dict):
-        return all([isinstance(k, types.StringTypes) and isJSON(v, nesting_depth - 1) for k,v in val.items()])
-    elif isinstance(val, list):
-        return all([isJSON(v, nesting_depth - 1) for v in val])
-    elif isinstance(val, (int, float, str, unicode, bool)):
-        return True
-    else:
-        return False
+    stack = [iter([val])]
+    while len(stack) > 0:
+        for v in stack[-1]:
+            if len(stack) > nesting_depth:
+                raise RqlDriverError("Nesting depth limit exceeded")
+            if type(v) in json_scalar_types:
+                continue
+            elif isinstance(v, dict):
+                if not all_string_keys(v):
+                    return False
+                stack.append(v.itervalues())
+                break
+            elif isinstance(v, list):
+                stack.append(iter(v))
+                break
+            elif isinstance(v, RqlQuery) or not isinstance(v, (int, long, float, basestring)):
+                return False
+        else:
+            stack.pop()
+    return True
+
+# Protobuf wire format helpers for `RqlQuery.serialize`, which writes the
+# bytes of a Term directly instead of filling in `ql2_pb2` messages.
+
+_small_varints = [chr(n) for n in xrange(0x80)]
+
+def _varint(n):
+    if n < 0x80:
+        return _small_varints[n]
+    out = []
+    while n > 0x7f:
+        out.append(chr((n & 0x7f) | 0x80))
+        n >>= 7
+    out.append(chr(n))
+    return ''.join(out)
+
+def _key(field, wire_type):
+    return chr((field << 3) | wire_type)
+
+_query_term_key = _key(2, 2)    # Query.query
+_term_type_key = _key(1, 0)     # Term.type
+_term_datum_key = _key(2, 2)    # Term.datum
+_term_args_key = _key(3, 2)     # Term.args
+_term_optargs_key = _key(4, 2)  # Term.optargs
+_pair_key_key = _key(1, 2)      # Term.AssocPair.key
+_pair_val_key = _key(2, 2)      # Term.AssocPair.val
+
+_datum_term_head = _term_type_key + _varint(p.Term.DATUM) + _term_datum_key
+_datum_type_key = _key(1, 0)    # Datum.type
+_datum_null = _datum_type_key + _varint(p.Datum.R_NULL)
+_datum_false = _datum_type_key + _varint(p.Datum.R_BOOL) + _key(2, 0) + _varint(0)
+_datum_true = _datum_type_key + _varint(p.Datum.R_BOOL) + _key(2, 0) + _varint(1)
+_datum_num_head = _datum_type_key + _varint(p.Datum.R_NUM) + _key(3, 1)
+_datum_str_head = _datum_type_key + _varint(p.Datum.R_STR) + _key(4, 2)
+
+# Strings are sent as UTF-8. Like protobuf, reject byte strings that are not.
+def _utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    s.decode('utf-8')
+    return s
+
+def _serialize_str_datum(s):
+    s = _utf8(s)
+    datum = _datum_str_head + _varint(len(s)) + s
+    return _datum_term_head + _varint(len(datum)) + datum
+
+def _add_optarg_body(parts, key, body):
+    key = _utf8(key)
+    pair = ''.join((_pair_key_key, _varint(len(key)), key, _pair_val_key, _varint(len(body)), body))
+    parts.extend((_term_optargs_key, _varint(len(pair)), pair))
+
+# The serialized Term for a node given the serialized bodies of its args
+# followed by those of its optargs, in the order of `keys`
+def _join_term(tt, num_args, keys, bodies):
+    parts = [_term_type_key, _varint(tt)]
+    for body in bodies[:num_args]:
+        parts.extend((_term_args_key, _varint(len(body)), body))
+    for (k, body) in zip(keys, bodies[num_args:]):
+        _add_optarg_body(parts, k, body)
+    return ''.join(parts)
+
+# Queries are built out of a great many small nodes, so every node class
+# defined in this module gets an empty `__slots__` unless it declares its
+# own, and nodes carry no per-instance `__dict__`.
+class RqlQueryMeta(type):
+    def __new__(mcs, name, bases, namespace):
+        if namespace.get('__module__') == __name__ and '__slots__' not in namespace:
+            namespace['__slots__'] = ()
+        return type.__new__(mcs, name, bases, namespace)
+
+# Shared by all the nodes without optional arguments. It must never be
+# modified.
+no_optargs = {}
 
 class RqlQuery(object):
+    __metaclass__ = RqlQueryMeta
+    __slots__ = ('args', 'optargs')
 
     # Instantiate this AST node with the given pos and opt args
     def __init__(self, *args, **optargs):
-        self.args = [expr(e) for e in args]
+        self.args = tuple([expr(e) for e in args])
 
-        self.optargs = {}
+        self.optargs = no_optargs
         for k in optargs.keys():
             if not isinstance(optargs[k], RqlQuery) and optargs[k] == ():
                 continue
+            if self.optargs is no_optargs:
+                self.optargs = {}
             self.optargs[k] = expr(optargs[k])
 
     # Send this query to the server to be executed
@@ -114,17 +346,81 @@ class RqlQuery(object):
     def __repr__(self):
         return "<RqlQuery instance: %s >" % str(self)
 
+    # Set by nodes that serialize and build themselves without looking at
+    # any children, like datums
+    _leaf = False
+
+    # Returns this query serialized as a Term protobuf. This writes the same
+    # bytes as filling in a Term with `build` and serializing it, without
+    # creating any protobuf objects.
+    #
+    # Nodes are visited with an explicit stack rather than by recursion, so
+    # the depth of a query is not limited by Python's recursion limit. Each
+    # frame holds a node's parts so far, where its optargs start in the
+    # parts, its optarg keys and an iterator over its args then optargs.
+    # Leaves are serialized in place; other children get a frame of their
+    # own, whose body is added to the parent once it is complete.
+    def serialize(self):
+        if intern_table is not None:
+            return intern_table.serialize(self)
+
+        stack = [self._serialize_frame()]
+        while True:
+            (parts, args_end, keys, children) = stack[-1]
+            for child in children:
+                if not child._leaf:
+                    stack.append(child._serialize_frame())
+                    break
+                body = child.serialize()
+                if len(parts) < args_end:
+                    parts.extend((_term_args_key, _varint(len(body)), body))
+                else:
+                    key = _utf8(keys[(len(parts) - args_end) // 3])
+                    pair = ''.join((_pair_key_key, _varint(len(key)), key, _pair_val_key, _varint(len(body)), body))
+                    parts.extend((_term_optargs_key, _varint(len(pair)), pair))
+            else:
+                stack.pop()
+                body = ''.join(parts)
+                if len(stack) == 0:
+                    return body
+                (parts, args_end, keys, children) = stack[-1]
+                if len(parts) < args_end:
+                    parts.extend((_term_args_key, _varint(len(body)), body))
+                else:
+                    _add_optarg_body(parts, keys[(len(parts) - args_end) // 3], body)
+
+    def _serialize_frame(self):
+        parts = [_term_type_key, _varint(self.tt)]
+        args_end = 2 + 3 * len(self.args)
+        if len(self.optargs) == 0:
+            return (parts, args_end, (), iter(self.args))
+        keys = self.optargs.keys()
+        return (parts, args_end, keys, iter(self.args + tuple([self.optargs[k] for k in keys])))
+
+    def _intern_frame(self):
+        if len(self.optargs) == 0:
+            return (self, (), iter(self.args), [], [])
+        keys = self.optargs.keys()
+        return (self, keys, iter(self.args + tuple([self.optargs[k] for k in keys])), [], [])
+
     # Compile this query to a binary protobuf buffer
     def build(self, term):
-        term.type = self.tt
-
-        for arg in self.args:
-            arg.build(term.args.add())
+        # Like `serialize`, this uses an explicit stack of (node, term) pairs
+        # still to be filled in
+        stack = [(self, term)]
+        while len(stack) > 0:
+            (node, term) = stack.pop()
+            if node._leaf:
+                node.build(term)
+                continue
 
-        for k in self.optargs.keys():
-            pair = term.optargs.add()
-            pair.key = k
-            self.optargs[k].build(pair.val)
+            term.type = node.tt
+            for arg in node.args:
+                stack.append((arg, term.args.add()))
+            for k in node.optargs.keys():
+                pair = term.optargs.add()
+                pair.key = k
+                stack.append((node.optargs[k], pair.val))
 
     # The following are all operators and methods that operate on
     # Rql queries to build up more complex operations
@@ -505,6 +801,8 @@ def needs_wrap(arg):
     return isinstance(arg, Datum) or isinstance(arg, MakeArray) or isinstance(arg, MakeObj)
 
 class RqlBoolOperQuery(RqlQuery):
+    __slots__ = ('infix',)
+
     def __init__(self, *args, **optargs):
         if 'infix' in optargs:
             self.infix = optargs['infix']
@@ -532,16 +830,14 @@ class RqlBiCompareOperQuery(RqlBiOperQuery):
         RqlBiOperQuery.__init__(self, *args, **optargs)
 
         for arg in args:
-            try:
-                if arg.infix:
-                    err = "Calling '%s' on result of infix bitwise operator:\n" + \
-                          "%s.\n" + \
-                          "This is almost always a precedence error.\n" + \
-                          "Note that `a < b | b < c` <==> `a < (b | b) < c`.\n" + \
-                          "If you really want this behavior, use `.or_` or `.and_` instead."
-                    raise RqlDriverError(err % (self.st, QueryPrinter(self).print_query()))
-            except AttributeError:
-                pass # No infix attribute, so not possible to be an infix bool operator
+            # Only boolean operators have an infix attribute
+            if getattr(arg, 'infix', False):
+                err = "Calling '%s' on result of infix bitwise operator:\n" % self.st + \
+                      "%s.\n" + \
+                      "This is almost always a precedence error.\n" + \
+                      "Note that `a < b | b < c` <==> `a < (b | b) < c`.\n" + \
+                      "If you really want this behavior, use `.or_` or `.and_` instead."
+                raise RqlDriverError(err, self)
 
 class RqlTopLevelQuery(RqlQuery):
     def compose(self, args, optargs):
@@ -560,6 +856,8 @@ class RqlMethodQuery(RqlQuery):
         return T(args[0], '.', self.st, '(', restargs, ')')
 
 class RqlBracketQuery(RqlMethodQuery):
+    __slots__ = ('bracket_operator',)
+
     def __init__(self, *args, **optargs):
         if 'bracket_operator' in optargs:
             self.bracket_operator = optargs['bracket_operator']
@@ -580,10 +878,11 @@ class RqlBracketQuery(RqlMethodQuery):
 class RqlTzinfo(datetime.tzinfo):
 
     def __init__(self, offsetstr):
-        hours, minutes = map(int, offsetstr.split(':'))
+        hours, minutes = map(int, offsetstr.lstrip('+-').split(':'))
+        delta = datetime.timedelta(hours=hours, minutes=minutes)
 
         self.offsetstr = offsetstr
-        self.delta = datetime.timedelta(hours=hours, minutes=minutes)
+        self.delta = -delta if offsetstr.startswith('-') else delta
 
     def __copy__(self):
         return RqlTzinfo(self.offsetstr)
@@ -600,14 +899,32 @@ class RqlTzinfo(datetime.tzinfo):
     def dst(self, dt):
         return datetime.timedelta(0)
 
+# RqlTzinfo objects never change, so times with the same offset share one
+tzinfo_cache = { }
+
+def tzinfo_for_offset(offsetstr):
+    tz = tzinfo_cache.get(offsetstr)
+    if tz is None:
+        if len(tzinfo_cache) > 1000:
+            tzinfo_cache.clear()
+        tz = RqlTzinfo(offsetstr)
+        tzinfo_cache[offsetstr] = tz
+    return tz
+
+utcfromtimestamp = datetime.datetime.utcfromtimestamp
+
 def reql_type_time_to_datetime(obj):
-    if not 'epoch_time' in obj:
+    epoch_time = obj.get('epoch_time')
+    if epoch_time is None:
         raise RqlDriverError('pseudo-type TIME object %s does not have expected field "epoch_time".' % py_json.dumps(obj))
 
-    if 'timezone' in obj:
-        return datetime.datetime.fromtimestamp(obj['epoch_time'], RqlTzinfo(obj['timezone']))
-    else:
-        return datetime.datetime.utcfromtimestamp(obj['epoch_time'])
+    timezone = obj.get('timezone')
+    if timezone is None:
+        return utcfromtimestamp(epoch_time)
+    # The same as `fromtimestamp(epoch_time, tz)`, without calling back into
+    # the tzinfo
+    tz = tzinfo_for_offset(timezone)
+    return (utcfromtimestamp(epoch_time) + tz.delta).replace(tzinfo=tz)
 
 # Python only allows immutable built-in types to be hashed, such as for keys in a dict
 # This means we can't use lists or dicts as keys in grouped data objects, so we convert
@@ -635,10 +952,12 @@ def reql_type_grouped_data_to_object(obj):
 # R_ARRAYs and R_OBJECTs would require verifying that at all nested levels
 # our arrays and objects are composed only of basic types.
 class Datum(RqlQuery):
-    args = []
-    optargs = {}
+    __slots__ = ('data',)
+    _leaf = True
 
     def __init__(self, val):
+        self.args = ()
+        self.optargs = no_optargs
         self.data = val
 
     def build(self, term):
@@ -658,6 +977,26 @@ class Datum(RqlQuery):
         else:
             raise RqlDriverError("Cannot build a query from a %s" % type(self.data).__name__)
 
+    def serialize(self):
+        data = self.data
+        data_type = type(data)
+        # Check the common types first, the abstract base class is slow
+        if data_type is float or data_type is int:
+            datum = _datum_num_head + struct.pack('<d', data)
+        elif data_type is str or data_type is unicode:
+            return _serialize_str_datum(data)
+        elif data == None:
+            datum = _datum_null
+        elif isinstance(data, bool):
+            datum = _datum_true if data else _datum_false
+        elif isinstance(data, numbers.Real):
+            datum = _datum_num_head + struct.pack('<d', data)
+        elif isinstance(data, types.StringTypes):
+            return _serialize_str_datum(data)
+        else:
+            raise RqlDriverError("Cannot build a query from a %s" % type(data).__name__)
+        return _datum_term_head + _varint(len(datum)) + datum
+
     def compose(self, args, optargs):
         return repr(self.data)
 
@@ -683,23 +1022,46 @@ class Datum(RqlQuery):
         # If there was no pseudotype, or the time format is raw, return the original object
         return obj
 
+    # Returns the `object_hook` that converts the pseudotypes in responses
+    # run with `format_opts`. The options are looked at once per response or
+    # batch rather than for every object, since times are by far the most
+    # common pseudotype and a batch can hold a great many of them.
     @staticmethod
-    def _recursively_convert_pseudotypes(obj, format_opts):
-        if isinstance(obj, dict):
-            for (key, value) in obj.iteritems():
-                obj[key] = Datum._recursively_convert_pseudotypes(value, format_opts)
-            obj = Datum._convert_pseudotype(obj, format_opts)
-        elif isinstance(obj, list):
-            for i in xrange(len(obj)):
-                obj[i] = Datum._recursively_convert_pseudotypes(obj[i], format_opts)
-        return obj
-
+    def pseudotype_hook(format_opts):
+        time_format = format_opts.get('time_format')
+        if time_format is not None and time_format != 'native':
+            return lambda obj: Datum._convert_pseudotype(obj, format_opts)
+
+        convert_pseudotype = Datum._convert_pseudotype
+        def hook(obj):
+            reql_type = obj.get('$reql_type$')
+            if reql_type is None:
+                return obj
+            elif reql_type == 'TIME':
+                return reql_type_time_to_datetime(obj)
+            return convert_pseudotype(obj, format_opts)
+        return hook
+
+    # Decodes the JSON of an R_JSON datum
+    @staticmethod
+    def _loads_json(json_str, format_opts):
+        codec = json_codec.get_json_codec()
+        if '$reql_type$' not in json_str:
+            # Nothing to convert, so don't make the codec call back into Python
+            return codec.loads(json_str)
+        # Pseudotypes are converted by the decoder as each object is built
+        return codec.loads(json_str, object_hook=Datum.pseudotype_hook(format_opts))
+
+    # `datum` is either a parsed Datum message or, in responses read by the C
+    # decoder, a serialized one that the decoder converts the same way
     @staticmethod
     def deconstruct(datum, format_opts={}):
+        if datum.__class__ is str:
+            return p.decoder.decode_datum(datum, format_opts, Datum._convert_pseudotype, Datum._loads_json)
+
         d_type = datum.type
         if d_type == p.Datum.R_JSON:
-            obj = py_json.loads(datum.r_str)
-            return Datum._recursively_convert_pseudotypes(obj, format_opts)
+            return Datum._loads_json(datum.r_str, format_opts)
         elif d_type == p.Datum.R_OBJECT:
             obj = { }
             for pair in datum.r_object:
@@ -709,8 +1071,7 @@ class Datum(RqlQuery):
             # be an object or something else. We need a second layer of type switching, this
             # time on an obfuscated field "$reql_type$" rather than the datum type field we
             # already switched on.
-            Datum._convert_pseudotype(obj, format_opts)
-            return obj
+            return Datum._convert_pseudotype(obj, format_opts)
         elif d_type == p.Datum.R_ARRAY:
             array = datum.r_array
             return [Datum.deconstruct(e, format_opts) for e in array]
@@ -733,6 +1094,125 @@ class Datum(RqlQuery):
         else:
             raise RuntimeError("Unknown Datum type %d encountered in response." % datum.type)
 
+    # Decode a list of datums according to `format_opts`. When every datum
+    # was sent as JSON they are joined into one JSON array, so that the codec
+    # is called once for the whole list rather than once per datum.
+    @staticmethod
+    def deconstruct_batch(datums, format_opts={}):
+        deconstruct = Datum.decoder(format_opts)
+        if deconstruct is not Datum.deconstruct:
+            return [deconstruct(datum, format_opts) for datum in datums]
+
+        if len(datums) > 0 and datums[0].__class__ is str:
+            json_str = p.decoder.join_json(datums)
+            if json_str is None:
+                return [deconstruct(datum, format_opts) for datum in datums]
+            return Datum._loads_json(json_str, format_opts)
+
+        json_strs = [ ]
+        for datum in datums:
+            if datum.type != p.Datum.R_JSON:
+                return [deconstruct(datum, format_opts) for datum in datums]
+            json_strs.append(datum.r_str)
+        return Datum._loads_json('[' + ','.join(json_strs) + ']', format_opts)
+
+    # Like `deconstruct`, but JSON objects without pseudotypes are returned as
+    # a `LazyRow` that is only parsed once one of its fields is accessed
+    @staticmethod
+    def deconstruct_lazy(datum, format_opts={}):
+        if datum.__class__ is str:
+            r_str = p.decoder.json_str(datum)
+        elif datum.type == p.Datum.R_JSON:
+            r_str = datum.r_str
+        else:
+            r_str = None
+        if r_str is not None and r_str[:1] == '{' and '$reql_type$' not in r_str:
+            return LazyRow(r_str)
+        return Datum.deconstruct(datum, format_opts)
+
+    # Returns the function used to convert the rows of a result according
+    # to the `decode` run option
+    @staticmethod
+    def decoder(format_opts):
+        decode = format_opts.get('decode')
+        if decode is None or decode == 'eager':
+            return Datum.deconstruct
+        elif decode == 'lazy':
+            return Datum.deconstruct_lazy
+        else:
+            raise RqlDriverError("Unknown decode run option \"%s\"." % decode)
+
+# A read-only mapping over a row sent as JSON that defers parsing it until
+# it is first used. Rows containing pseudotypes are never wrapped in one of
+# these, so there is nothing to convert after parsing.
+#
+# `collections.Mapping` has no `__slots__`, so subclassing it would give
+# every row a `__dict__`. The class is registered as a Mapping instead and
+# provides the methods the Mapping mixin would.
+class LazyRow(object):
+    __slots__ = ['json', 'obj']
+
+    def __init__(self, json_str):
+        self.json = json_str
+        self.obj = None
+
+    def _decode(self):
+        if self.obj is None:
+            self.obj = json_codec.get_json_codec().loads(self.json)
+            self.json = None
+        return self.obj
+
+    def __getitem__(self, key):
+        return self._decode()[key]
+
+    def __iter__(self):
+        return iter(self._decode())
+
+    def __len__(self):
+        return len(self._decode())
+
+    def __contains__(self, key):
+        return key in self._decode()
+
+    def get(self, key, default=None):
+        return self._decode().get(key, default)
+
+    def keys(self):
+        return self._decode().keys()
+
+    def values(self):
+        return self._decode().values()
+
+    def items(self):
+        return self._decode().items()
+
+    def iterkeys(self):
+        return self._decode().iterkeys()
+
+    def itervalues(self):
+        return self._decode().itervalues()
+
+    def iteritems(self):
+        return self._decode().iteritems()
+
+    def __eq__(self, other):
+        if isinstance(other, LazyRow):
+            other = other._decode()
+        elif not isinstance(other, collections.Mapping):
+            return NotImplemented
+        return self._decode() == dict(other.items())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self._decode())
+
+collections.Mapping.register(LazyRow)
+
 class MakeArray(RqlQuery):
     tt = p.Term.MAKE_ARRAY
 
@@ -749,7 +1229,7 @@ class MakeObj(RqlQuery):
     # the `self` parameter. This is not a problem for other RqlQuery sub-
     # classes unless we add a 'self' optional argument to one of them.
     def __init__(self, obj_dict):
-        self.args = []
+        self.args = ()
 
         self.optargs = {}
         for k in obj_dict.keys():
@@ -764,7 +1244,7 @@ class Var(RqlQuery):
     tt = p.Term.VAR
 
     def compose(self, args, optargs):
-        return 'var_'+args[0]
+        return T('var_', args[0])
 
 class JavaScript(RqlTopLevelQuery):
     tt = p.Term.JAVASCRIPT
@@ -779,6 +1259,8 @@ class Default(RqlMethodQuery):
     st = "default"
 
 class ImplicitVar(RqlQuery):
+    # `r.row` is documented by setting its `__doc__`
+    __slots__ = ('__dict__',)
     tt = p.Term.IMPLICIT_VAR
 
     def compose(self, args, optargs):
@@ -1330,28 +1812,213 @@ def func_wrap(val):
     return val
 
 class Func(RqlQuery):
+    __slots__ = ('vrs',)
     tt = p.Term.FUNC
-    lock = Lock()
-    nextVarId = 1
+
+    # Calling `next` on a count is atomic, so threads building queries
+    # don't need a lock to get distinct variable ids
+    var_ids = itertools.count(1)
 
     def __init__(self, lmbd):
+        self.optargs = no_optargs
+
+        key = None
+        if func_cache is not None:
+            key = func_cache_key(lmbd)
+            if key is not None:
+                cached = func_cache.get(key)
+                if cached is not None:
+                    (self.vrs, self.args) = cached
+                    return
+
         vrs = []
         vrids = []
-        for i in range(lmbd.func_code.co_argcount):
-            Func.lock.acquire()
-            var_id = Func.nextVarId
-            Func.nextVarId += 1
-            Func.lock.release()
+        for i in xrange(lmbd.func_code.co_argcount):
+            var_id = next(Func.var_ids)
             vrs.append(Var(var_id))
             vrids.append(var_id)
 
         self.vrs = vrs
-        self.args = [MakeArray(*vrids), expr(lmbd(*vrs))]
-        self.optargs = {}
+        self.args = (MakeArray(*vrids), expr(lmbd(*vrs)))
+        if key is not None:
+            func_cache.put(key, (self.vrs, self.args))
 
     def compose(self, args, optargs):
             return T('lambda ', T(*[v.compose([v.args[0].compose(None, None)], []) for v in self.vrs], intsp=', '), ': ', args[1])
 
+# A bounded cache of built terms. It is shared between threads without a
+# lock: single dict operations are atomic, and when it is full an arbitrary
+# entry is dropped. The hit and miss counts may undercount slightly when
+# several threads use the cache at once.
+class TermCache(object):
+    def __init__(self, size):
+        self.size = size
+        self.entries = { }
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        while len(self.entries) >= self.size:
+            try:
+                self.entries.popitem()
+            except KeyError:
+                break
+        self.entries[key] = value
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
+# Serializes queries so that structurally identical subterms are only
+# serialized once while they stay in the table. Each subterm is keyed by its
+# term type, its optarg names and the keys of its children: the serialized
+# bytes of datums, or the id given to other subterms when they were first
+# interned. Node objects that were already serialized are also remembered,
+# so reused subterms (say a table kept in a global, or the body of a cached
+# lambda) are found without walking them again.
+class InternTable(object):
+    def __init__(self, size):
+        self.terms = TermCache(size)
+        self.nodes = TermCache(size)
+        self.ids = itertools.count(1)
+
+    # The fraction of subterm lookups answered from the table
+    def hit_rate(self):
+        hits = self.terms.hits + self.nodes.hits
+        lookups = hits + self.terms.misses
+        if lookups == 0:
+            return 0.0
+        return float(hits) / lookups
+
+    def __len__(self):
+        return len(self.terms.entries)
+
+    def serialize(self, term):
+        entry = self.nodes.entries.get(id(term))
+        if entry is not None:
+            self.nodes.hits += 1
+            return entry[2]
+
+        # Like `RqlQuery.serialize`, but each frame holds a node, its optarg
+        # keys, an iterator over its children and their keys and bodies
+        stack = [term._intern_frame()]
+        while True:
+            (node, keys, children, child_keys, bodies) = stack[-1]
+            for child in children:
+                if child._leaf:
+                    # Leaves are only serialized if their parent misses.
+                    # Strings, the most common datums, are their own key;
+                    # other leaves use their serialized bytes in a tuple.
+                    if type(child) is Datum and type(child.data) in (str, unicode):
+                        child_keys.append(child.data)
+                    else:
+                        child_keys.append((child.serialize(),))
+                    bodies.append(child)
+                    continue
+                entry = self.nodes.entries.get(id(child))
+                if entry is None:
+                    stack.append(child._intern_frame())
+                    break
+                self.nodes.hits += 1
+                child_keys.append(entry[1])
+                bodies.append(entry[2])
+            else:
+                stack.pop()
+                key = (node.tt, len(node.args)) + tuple(keys) + tuple(child_keys)
+                interned = self.terms.get(key)
+                if interned is None:
+                    bodies = [b if type(b) is str else b.serialize() for b in bodies]
+                    interned = (next(self.ids), _join_term(node.tt, len(node.args), keys, bodies))
+                    self.terms.put(key, interned)
+                else:
+                    # Only nodes seen before are remembered, so the table
+                    # isn't churned by one-off queries. Holding on to the
+                    # node keeps its id from being reused.
+                    self.nodes.put(id(node), (node,) + interned)
+                if len(stack) == 0:
+                    return interned[1]
+                stack[-1][3].append(interned[0])
+                stack[-1][4].append(interned[1])
+
+# The intern table used by `RqlQuery.serialize`, if any. Var ids are part of
+# the keys, so lambdas only share entries when the function cache is on too.
+intern_table = None
+
+def set_intern_table_size(size):
+    global intern_table
+    if size is None or size == 0:
+        intern_table = None
+    elif size < 0:
+        raise RqlDriverError("The intern table size cannot be negative.")
+    else:
+        intern_table = InternTable(size)
+    return intern_table
+
+def get_intern_table():
+    return intern_table
+
+# When enabled, a `Func` reuses the body (and variable ids) built for an
+# earlier lambda with the same code, closure values, default values and
+# referenced globals. It is off by default since a lambda may also depend on
+# state that is not part of that key, like `lambda doc: doc['t'] < time.time()`.
+func_cache = None
+
+def set_func_cache_size(size):
+    global func_cache
+    if size is None or size == 0:
+        func_cache = None
+    elif size < 0:
+        raise RqlDriverError("The function cache size cannot be negative.")
+    else:
+        func_cache = TermCache(size)
+    return func_cache
+
+# Values a lambda can depend on that can safely be part of a cache key:
+# immutable scalars and objects compared by identity
+func_cache_key_types = frozenset([int, long, float, str, unicode, bool, type(None),
+                                  types.ModuleType, types.FunctionType,
+                                  types.BuiltinFunctionType, types.ClassType, type])
+
+# Returns the cache key for a lambda, or None if it cannot be cached
+def func_cache_key(lmbd):
+    values = list(lmbd.func_defaults or ())
+    for cell in lmbd.func_closure or ():
+        try:
+            values.append(cell.cell_contents)
+        except ValueError:
+            # The closure variable has not been assigned yet
+            return None
+
+    # Globals read by the lambda or by lambdas nested in it
+    lmbd_globals = lmbd.func_globals
+    codes = [lmbd.func_code]
+    while len(codes) > 0:
+        code = codes.pop()
+        for name in code.co_names:
+            if name in lmbd_globals:
+                values.append(lmbd_globals[name])
+        codes.extend(c for c in code.co_consts if isinstance(c, types.CodeType))
+
+    key = [lmbd.func_code]
+    for value in values:
+        value_type = type(value)
+        if value_type not in func_cache_key_types:
+            return None
+        # Types are part of the key since `True == 1` and `u'a' == 'a'`
+        key.append(value_type)
+        key.append(value)
+    return tuple(key)
+
 class Asc(RqlTopLevelQuery):
     tt = p.Term.ASC
     st = 'asc'
@@ -1363,3 +2030,161 @@ class Desc(RqlTopLevelQuery):
 class Literal(RqlTopLevelQuery):
     tt = p.Term.LITERAL
     st = 'literal'
+
+# Stands in for a parameter of a prepared query while its term is built. It
+# is sent as a string datum holding a marker that cannot clash with a real
+# string, which is how the parameter is found again in the built protobuf.
+class Placeholder(RqlQuery):
+    __slots__ = ('name', 'marker')
+    _leaf = True
+
+    def __init__(self, name):
+        self.args = ()
+        self.optargs = no_optargs
+        self.name = name
+        self.marker = u'\0$reql_placeholder$%d:%s' % (id(self), name)
+
+    def build(self, term):
+        term.type = p.Term.DATUM
+        term.datum.type = p.Datum.R_STR
+        term.datum.r_str = self.marker
+
+    def serialize(self):
+        return _serialize_str_datum(self.marker)
+
+    def compose(self, args, optargs):
+        return self.name
+
+class _Param(object):
+    def __init__(self, name):
+        self.name = name
+
+    def render(self, values):
+        return values[self.name]
+
+# A serialized message with holes for parameters. `parts` holds static bytes
+# and (key, hole) pairs for the fields that contain a parameter, whose length
+# prefix can only be written once the parameter's value is known.
+class _Template(object):
+    def __init__(self, parts):
+        self.parts = parts
+
+    def render(self, values):
+        out = []
+        for part in self.parts:
+            if isinstance(part, tuple):
+                (key, hole) = part
+                body = hole.render(values)
+                out.append(key)
+                out.append(_varint(len(body)))
+                out.append(body)
+            else:
+                out.append(part)
+        return ''.join(out)
+
+# Returns the serialization of `term` if it contains no parameter, or a
+# template otherwise. Fields are written in field number order, just like
+# `SerializeToString` writes them.
+def _compile_template(term, params):
+    if term.type == p.Term.DATUM and term.datum.type == p.Datum.R_STR and term.datum.r_str in params:
+        return _Param(params[term.datum.r_str])
+
+    head = p.Term()
+    head.type = term.type
+    if term.HasField('datum'):
+        head.datum.CopyFrom(term.datum)
+    parts = [head.SerializeToString()]
+    has_params = False
+
+    for arg in term.args:
+        sub = _compile_template(arg, params)
+        if isinstance(sub, str):
+            parts.append(_term_args_key + _varint(len(sub)) + sub)
+        else:
+            parts.append((_term_args_key, sub))
+            has_params = True
+
+    for pair in term.optargs:
+        sub = _compile_template(pair.val, params)
+        if isinstance(sub, str):
+            parts.append(_term_optargs_key + _varint(pair.ByteSize()) + pair.SerializeToString())
+        else:
+            key = p.Term.AssocPair()
+            key.key = pair.key
+            parts.append((_term_optargs_key, _Template([key.SerializeToString(), (_pair_val_key, sub)])))
+            has_params = True
+
+    if not has_params:
+        return term.SerializeToString()
+    return _Template(parts)
+
+# A query built and serialized once from a function of its parameters, for
+# queries that are run over and over with different values:
+#
+#   get_user = r.prepare(lambda key: r.table('users').get(key))
+#   get_user.bind(key=10).run(conn)
+#
+# Binding a value only serializes that value and splices it into the stored
+# bytes, so nothing else about the query is built again.
+class PreparedQuery(object):
+    def __init__(self, func):
+        code = func.func_code
+        self.params = code.co_varnames[:code.co_argcount]
+
+        placeholders = [Placeholder(name) for name in self.params]
+        self.term = expr(func(*placeholders))
+
+        term = p.Term()
+        self.term.build(term)
+        template = _compile_template(term, dict((ph.marker, ph.name) for ph in placeholders))
+        if isinstance(template, str):
+            template = _Template([template])
+        self.template = template
+
+    def bind(self, *args, **kwargs):
+        if len(args) > len(self.params):
+            raise RqlDriverError("Prepared query takes %d parameters, %d given." % (len(self.params), len(args)))
+        values = dict(zip(self.params, args))
+        for (name, value) in kwargs.iteritems():
+            if name not in self.params:
+                raise RqlDriverError("Prepared query has no parameter \"%s\"." % name)
+            if name in values:
+                raise RqlDriverError("Parameter \"%s\" given more than once." % name)
+            values[name] = value
+
+        datums = { }
+        for name in self.params:
+            if name not in values:
+                raise RqlDriverError("Missing value for parameter \"%s\"." % name)
+            datums[name] = expr(values[name]).serialize()
+        return BoundQuery(self, values, self.template.render(datums))
+
+    def __str__(self):
+        return "prepare(lambda %s: %s)" % (', '.join(self.params), self.term)
+
+    def __repr__(self):
+        return "<PreparedQuery instance: %s >" % str(self)
+
+# A prepared query with values for all of its parameters. It is run like any
+# other query, but its serialized term is already known.
+class BoundQuery(RqlQuery):
+    __slots__ = ('prepared', 'values', 'term_bytes')
+    _leaf = True
+
+    def __init__(self, prepared, values, term_bytes):
+        self.prepared = prepared
+        self.values = values
+        self.term_bytes = term_bytes
+
+        # Error messages and backtraces refer to the prepared term
+        self.args = prepared.term.args
+        self.optargs = prepared.term.optargs
+
+    def build(self, term):
+        term.MergeFromString(self.term_bytes)
+
+    def serialize(self):
+        return self.term_bytes
+
+    def compose(self, args, optargs):
+        return self.prepared.term.compose(args, optargs)
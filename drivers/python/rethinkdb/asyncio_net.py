@@ -0,0 +1,339 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# An event loop based connection. Queries are serialized exactly as they are
+# for `net.Connection` but responses are read by a task on the event loop, so
+# any number of queries can be outstanding at once without blocking a thread.
+#
+# This driver targets Python 2, so the event loop comes from `trollius`, the
+# Python 2 port of asyncio. Coroutines are written in its `yield From(...)` /
+# `raise Return(...)` style.
+
+__all__ = ['connect', 'AsyncConnection', 'AsyncCursor']
+
+import socket
+import struct
+
+try:
+    import trollius as asyncio
+    from trollius import From, Return
+except ImportError:
+    asyncio = None
+
+from rethinkdb import ql2 as p
+
+from rethinkdb.errors import *
+from rethinkdb.ast import Datum
+from rethinkdb.net import Connection, Cursor
+
+if asyncio is None:
+    def connect(host, port, db, auth_key, timeout, loop):
+        raise RqlDriverError("connect_async requires the trollius package. Please install it via `pip install trollius`.")
+
+else:
+    class AsyncCursor(Cursor):
+        def __init__(self, conn, query, term, format_opts, opts):
+            Cursor.__init__(self, conn, query, term, format_opts, opts)
+            self.batch = None
+            self.index = 0
+            self.waiter = None
+
+        def _extend(self, response):
+            Cursor._extend(self, response)
+            self._wake()
+
+        def _wake(self, error=None):
+            if self.waiter is not None and not self.waiter.done():
+                if error is None:
+                    self.waiter.set_result(None)
+                else:
+                    self.waiter.set_exception(error)
+
+        @asyncio.coroutine
+        def _wait(self):
+            self.conn._check_open()
+            self.waiter = asyncio.Future(loop=self.conn._loop)
+            yield From(self.waiter)
+
+        # Resolves to True if `next` can return a row without waiting on the
+        # server and False once the stream is exhausted
+        @asyncio.coroutine
+        def fetch_next(self):
+            while True:
+                if self.batch is not None and self.index < len(self.batch.response):
+                    raise Return(True)
+
+                if len(self.responses) > 0:
+                    self.batch = self.responses.pop(0)
+                    self.index = 0
+                    self._prefetch()
+                    self._check_response(self.batch)
+                elif self.end_flag:
+                    raise Return(False)
+                else:
+                    if self.outstanding_requests == 0:
+                        self.conn._async_continue_cursor(self)
+                        yield From(self.conn._drain())
+                    yield From(self._wait())
+
+        @asyncio.coroutine
+        def next(self):
+            if not (yield From(self.fetch_next())):
+                raise RqlDriverError("No more rows in the cursor.")
+
+            datum = self.batch.response[self.index]
+            self.index += 1
+            raise Return(Datum.decoder(self.format_opts)(datum, self.format_opts))
+
+        def __iter__(self):
+            raise RqlDriverError(
+                "__iter__ called on an AsyncCursor.\n"+
+                "Use `fetch_next` and `next` to iterate over it from a coroutine.")
+
+        @asyncio.coroutine
+        def close(self):
+            if not self.end_flag:
+                self.end_flag = True
+                yield From(self.conn._end_cursor(self))
+
+    class AsyncConnection(Connection):
+        _cursor_class = AsyncCursor
+
+        def __init__(self, host, port, db, auth_key, timeout, loop=None):
+            self.host = host
+            self.next_token = 1
+            self.db = db
+            self.auth_key = auth_key
+            self.timeout = timeout
+            self.cursor_cache = { }
+
+            # Try to convert the port to an integer
+            try:
+              self.port = int(port)
+            except ValueError as err:
+              raise RqlDriverError("Could not convert port %s to an integer." % port)
+
+            self._loop = loop or asyncio.get_event_loop()
+            self._stream_reader = None
+            self._stream_writer = None
+            self._reader_task = None
+            self._reader_error = None
+            self._futures = { }
+            self._drain_lock = asyncio.Lock(loop=self._loop)
+
+        def __enter__(self):
+            raise RqlDriverError("AsyncConnection must be closed with `yield From(conn.close())`.")
+
+        @asyncio.coroutine
+        def reconnect(self, noreply_wait=True):
+            yield From(self.close(noreply_wait))
+
+            try:
+                (self._stream_reader, self._stream_writer) = yield From(asyncio.wait_for(
+                    asyncio.open_connection(self.host, self.port, loop=self._loop),
+                    self.timeout, loop=self._loop))
+            except asyncio.TimeoutError:
+                raise RqlDriverError("Could not connect to %s:%s. Error: timed out" % (self.host, self.port))
+            except Exception as err:
+                raise RqlDriverError("Could not connect to %s:%s. Error: %s" % (self.host, self.port, err))
+
+            self._stream_writer.write(struct.pack("<L", p.VersionDummy.V0_2))
+            self._stream_writer.write(struct.pack("<L", len(self.auth_key)) + str.encode(self.auth_key, 'ascii'))
+            yield From(self._drain())
+
+            # Read out the response from the server, which will be a null-terminated string
+            response = b""
+            try:
+                while True:
+                    char = yield From(asyncio.wait_for(self._stream_reader.readexactly(1), self.timeout, loop=self._loop))
+                    if char == b"\0":
+                        break
+                    response += char
+            except asyncio.TimeoutError:
+                self._stream_writer.close()
+                self._stream_writer = None
+                raise socket.timeout("timed out")
+            except asyncio.IncompleteReadError:
+                response = response or b"connection closed"
+
+            if response != b"SUCCESS":
+                yield From(self.close(noreply_wait=False))
+                raise RqlDriverError("Server dropped connection with message: \"%s\"" % response.strip())
+
+            # Connection is now initialized
+            self._reader_error = None
+            self._reader_task = asyncio.ensure_future(self._reader_loop(), loop=self._loop)
+
+        @asyncio.coroutine
+        def close(self, noreply_wait=True):
+            if self._stream_writer is not None:
+                if noreply_wait and self._reader_task is not None:
+                    yield From(self.noreply_wait())
+                self._stream_writer.close()
+                self._stream_writer = None
+                self._stream_reader = None
+            if self._reader_task is not None:
+                self._reader_task.cancel()
+                self._reader_task = None
+            self._fail_outstanding(RqlDriverError("Connection is closed."))
+            self.cursor_cache = { }
+
+        @asyncio.coroutine
+        def noreply_wait(self):
+            # Construct query
+            query = p.Query()
+            query.type = p.Query.NOREPLY_WAIT
+            query.token = self._next_token()
+
+            # Send the request
+            result = yield From(self._send_query(query, 'noreply_wait'))
+            raise Return(result)
+
+        @asyncio.coroutine
+        def _start(self, term, **global_opt_args):
+            query = self._build_start_query(term, global_opt_args)
+            result = yield From(self._send_query(query, term, global_opt_args))
+            raise Return(result)
+
+        @asyncio.coroutine
+        def run_many(self, terms, **global_opt_args):
+            self._check_open()
+
+            started = self._build_start_queries(terms, global_opt_args)
+            data = ''.join(self._serialize_query(query, term) for (query, term, opts) in started)
+
+            noreply = global_opt_args.get('noreply')
+            futures = [ ]
+            if not noreply:
+                for (query, term, opts) in started:
+                    futures.append(asyncio.Future(loop=self._loop))
+                    self._futures[query.token] = futures[-1]
+            self._stream_writer.write(data)
+            yield From(self._drain())
+            if noreply:
+                raise Return([None] * len(started))
+
+            responses = yield From(asyncio.gather(*futures, loop=self._loop))
+            raise Return(self._process_responses([(response, query, term, opts) for (response, (query, term, opts)) in zip(responses, started)]))
+
+        @asyncio.coroutine
+        def _send_query(self, query, term, opts={}):
+            self._check_open()
+            data = self._serialize_query(query, term)
+
+            future = None
+            if not ('noreply' in opts and opts['noreply']):
+                future = asyncio.Future(loop=self._loop)
+                self._futures[query.token] = future
+
+            self._stream_writer.write(data)
+            yield From(self._drain())
+            if future is None:
+                raise Return(None)
+
+            response = yield From(future)
+            raise Return(self._process_response(response, query, term, opts))
+
+        def _write_query(self, query, term=None):
+            self._check_open()
+            self._stream_writer.write(self._serialize_query(query, term))
+
+        # Waits until the transport has sent enough of what was written that
+        # its buffer is below its limit, so that large queries are only
+        # written as fast as the server reads them. The stream lets only one
+        # coroutine wait at a time.
+        @asyncio.coroutine
+        def _drain(self):
+            with (yield From(self._drain_lock)):
+                self._check_open()
+                try:
+                    yield From(self._stream_writer.drain())
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    raise self._reader_error or RqlDriverError("Connection is closed.")
+
+        def _check_open(self):
+            if self._reader_error is not None:
+                raise self._reader_error
+            if self._stream_writer is None:
+                raise RqlDriverError("Connection is closed.")
+
+        def _async_continue_cursor(self, cursor):
+            if cursor.query.token not in self.cursor_cache:
+                return
+            cursor.outstanding_requests += 1
+
+            query = p.Query()
+            query.type = p.Query.CONTINUE
+            query.token = cursor.query.token
+            self._write_query(query)
+
+        def _continue_cursor(self, cursor):
+            raise RqlDriverError("AsyncCursor can only be read with `fetch_next` and `next`.")
+
+        @asyncio.coroutine
+        def _end_cursor(self, cursor):
+            if cursor.query.token not in self.cursor_cache:
+                return
+            cursor.outstanding_requests += 1
+
+            query = p.Query()
+            query.type = p.Query.STOP
+            query.token = cursor.query.token
+            self._write_query(query)
+            yield From(self._drain())
+
+            while cursor.query.token in self.cursor_cache:
+                yield From(cursor._wait())
+
+        def _close_cursors(self, cursors):
+            for cursor in cursors:
+                asyncio.ensure_future(cursor.close(), loop=self._loop)
+
+        def _fail_outstanding(self, error):
+            futures = self._futures
+            self._futures = { }
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(error)
+            for cursor in self.cursor_cache.values():
+                cursor._wake(error)
+
+        @asyncio.coroutine
+        def _reader_loop(self):
+            try:
+                while True:
+                    response_header = yield From(self._stream_reader.readexactly(4))
+
+                    # The first 4 bytes give the expected length of this response
+                    (response_len,) = struct.unpack("<L", response_header)
+                    response_buf = yield From(self._stream_reader.readexactly(response_len))
+
+                    # Construct response
+                    if p.load_decoder() is not None:
+                        response = p.DecodedResponse(response_buf)
+                    else:
+                        response = p.Response()
+                        response.ParseFromString(response_buf)
+
+                    if response.token in self._futures:
+                        future = self._futures.pop(response.token)
+                        if not future.done():
+                            future.set_result(response)
+                    elif response.token in self.cursor_cache:
+                        self._handle_cursor_response(response)
+                    # Anything else belongs to a cursor that has already
+                    # been closed and is dropped.
+            except asyncio.CancelledError:
+                raise
+            except Exception as err:
+                if not isinstance(err, RqlDriverError):
+                    err = RqlDriverError("Connection is closed.")
+                self._reader_error = err
+                self._fail_outstanding(err)
+
+    @asyncio.coroutine
+    def connect(host, port, db, auth_key, timeout, loop):
+        conn = AsyncConnection(host, port, db, auth_key, timeout, loop)
+        yield From(conn.reconnect(noreply_wait=False))
+        raise Return(conn)
@@ -1,13 +1,29 @@
-from . import ql2_pb2 as p
+from . import ql2 as p
 
+# The query text in an error's message is only formatted when the error is
+# displayed, since errors are often caught and handled without it
 class RqlError(Exception):
     def __init__(self, message, term, frames):
         self.message = message
         self.frames = [frame.pos if frame.type == p.Frame.POS else frame.opt for frame in frames]
-        self.query_printer = QueryPrinter(term, self.frames)
+        self.term = term
+        self._query_printer = None
+        self._backtrace = None
+
+    @property
+    def query_printer(self):
+        if self._query_printer is None:
+            self._query_printer = QueryPrinter(self.term, self.frames)
+        return self._query_printer
+
+    # The query and the carrots pointing at the part that failed
+    def backtrace(self):
+        if self._backtrace is None:
+            self._backtrace = self.query_printer.print_query()+'\n'+self.query_printer.print_carrots()
+        return self._backtrace
 
     def __str__(self):
-        return self.__class__.__name__+": "+self.message+" in:\n"+self.query_printer.print_query()+'\n'+self.query_printer.print_carrots()
+        return self.__class__.__name__+": "+self.message+" in:\n"+self.backtrace()
 
     def __repr__(self):
         return self.__class__.__name__+"("+repr(self.message)+")"
@@ -20,11 +36,21 @@ class RqlCompileError(RqlError):
 
 class RqlRuntimeError(RqlError):
     def __str__(self):
-        return self.message+" in:\n"+self.query_printer.print_query()+'\n'+self.query_printer.print_carrots()
+        return self.message+" in:\n"+self.backtrace()
 
+# If `term` is given, the message has a `%s` where the text of the query goes,
+# which is filled in the first time the message is used.
 class RqlDriverError(Exception):
-    def __init__(self, message):
-        self.message = message
+    def __init__(self, message, term=None):
+        self._message = message
+        self._term = term
+
+    @property
+    def message(self):
+        if self._term is not None:
+            self._message = self._message % QueryPrinter(self._term).print_query()
+            self._term = None
+        return self._message
 
     def __str__(self):
         return self.message
@@ -35,10 +61,14 @@ class QueryPrinter(object):
         self.frames = frames
 
     def print_query(self):
-        return ''.join(self.compose_term(self.root))
+        pieces = []
+        emit(self.compose_term(self.root), pieces, None)
+        return ''.join(pieces)
 
     def print_carrots(self):
-        return ''.join(self.compose_carrots(self.root, self.frames))
+        pieces = []
+        emit(self.compose_carrots(self.root, self.frames), pieces, ' ')
+        return ''.join(pieces)
 
     def compose_term(self, term):
         args = [self.compose_term(a) for a in term.args]
@@ -50,7 +80,7 @@ class QueryPrinter(object):
     def compose_carrots(self, term, frames):
         # This term is the cause of the error
         if len(frames) == 0:
-            return ['^' for i in self.compose_term(term)]
+            return Carrots(self.compose_term(term))
 
         cur_frame = frames[0]
         args = [self.compose_carrots(arg, frames[1:]) if cur_frame == i else self.compose_term(arg) for i,arg in enumerate(term.args)]
@@ -62,24 +92,52 @@ class QueryPrinter(object):
             else:
                 optargs[name] = self.compose_term(term.optargs[name])
 
-        return [' ' if i != '^' else '^' for i in term.compose(args, optargs)]
+        return term.compose(args, optargs)
 
-# This 'enhanced' tuple recursively iterates over it's elements allowing us to
-# construct nested heirarchies that insert subsequences into tree. It's used
-# to construct the query representation used by the pretty printer.
+# Appends the strings making up a composed query to `pieces`. With a `fill`
+# character, each string is replaced by as many of it, and the parts marked
+# with `Carrots` are filled with '^'.
+def emit(composed, pieces, fill):
+    if isinstance(composed, basestring):
+        pieces.append(composed if fill is None else fill * len(composed))
+    elif isinstance(composed, Carrots):
+        emit(composed.composed, pieces, fill and '^')
+    else:
+        composed.emit(pieces, fill)
+
+# Marks the part of a composed query that caused an error
+class Carrots(object):
+    def __init__(self, composed):
+        self.composed = composed
+
+# This 'enhanced' tuple holds the composed parts of a query, with `intsp`
+# between each of them. Nesting them builds the tree used by the pretty
+# printer, which is flattened into one list of strings by `emit`.
 class T(object):
     # N.B Python 2.x doesn't allow keyword default arguments after *seq
     #     In Python 3.x we can rewrite this as `__init__(self, *seq, intsp=''`
     def __init__(self, *seq, **opts):
         self.seq = seq
         self.intsp = opts.pop('intsp', '')
+        if not isinstance(self.intsp, basestring):
+            self.intsp = ''.join(self.intsp)
+
+    def emit(self, pieces, fill):
+        intsp = self.intsp
+        if fill is not None:
+            intsp = fill * len(intsp)
+        first = True
+        for token in self.seq:
+            if first:
+                first = False
+            elif intsp:
+                pieces.append(intsp)
+            if fill is None and type(token) is str:
+                pieces.append(token)
+            else:
+                emit(token, pieces, fill)
 
     def __iter__(self):
-        itr = iter(self.seq)
-        for sub in next(itr):
-            yield sub
-        for token in itr:
-            for sub in self.intsp:
-                yield sub
-            for sub in token:
-                yield sub
+        pieces = []
+        self.emit(pieces, None)
+        return iter(''.join(pieces))
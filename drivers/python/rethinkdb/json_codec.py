@@ -0,0 +1,149 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# The JSON codec used for R_JSON responses and for the JSON sent with
+# `r.json`/`exprJSON` queries. By default the fastest codec found in
+# `detection_order` is used, falling back on the standard library `json`
+# module, and `set_json_codec` replaces it for the whole process.
+
+__all__ = ['JsonCodec', 'set_json_codec', 'get_json_codec']
+
+import json as py_json
+
+from rethinkdb.errors import *
+
+class JsonCodec(object):
+    # `object_hook` says whether `loads` accepts an `object_hook` callback
+    # that it calls on every decoded object, innermost objects first. The
+    # driver uses it to convert pseudotypes while decoding; codecs without
+    # one get a separate pass over the decoded value instead.
+    #
+    # Likewise `make_encoder(default)`, if given, returns a `dumps` function
+    # that calls `default` for values the codec cannot encode, which the
+    # driver uses to send datetimes. Codecs without one get a separate pass
+    # over the value before encoding.
+    def __init__(self, name, loads, dumps, object_hook=False, make_encoder=None):
+        self.name = name
+        self._loads = loads
+        self._dumps = dumps
+        self.object_hook = object_hook
+        self._make_encoder = make_encoder
+        self._encoders = { }
+
+    def loads(self, json_str, object_hook=None):
+        if object_hook is None:
+            return self._loads(json_str)
+        elif self.object_hook:
+            return self._loads(json_str, object_hook=object_hook)
+        else:
+            return apply_object_hook(self._loads(json_str), object_hook)
+
+    def dumps(self, obj, default=None):
+        if default is None:
+            return self._dumps(obj)
+        encode = self._encoders.get(default)
+        if encode is None:
+            if self._make_encoder is None:
+                encode = lambda obj: self._dumps(apply_default(obj, default))
+            else:
+                encode = self._make_encoder(default)
+            self._encoders[default] = encode
+        return encode(obj)
+
+    def __repr__(self):
+        return "<JsonCodec %s>" % self.name
+
+def apply_object_hook(obj, object_hook):
+    if isinstance(obj, dict):
+        for (key, value) in obj.iteritems():
+            obj[key] = apply_object_hook(value, object_hook)
+        return object_hook(obj)
+    elif isinstance(obj, list):
+        for i in xrange(len(obj)):
+            obj[i] = apply_object_hook(obj[i], object_hook)
+    return obj
+
+# Returns a copy of `obj` with every value that isn't plain JSON replaced by
+# the result of `default`
+def apply_default(obj, default):
+    if isinstance(obj, dict):
+        return dict((key, apply_default(value, default)) for (key, value) in obj.iteritems())
+    elif isinstance(obj, (list, tuple)):
+        return [apply_default(value, default) for value in obj]
+    elif obj is None or isinstance(obj, (basestring, int, long, float)):
+        return obj
+    return apply_default(default(obj), default)
+
+# NaN and infinities are written as the standard library's `json` writes
+# them, which simplejson 4 no longer does by default, so that the server
+# reports them in the same way whichever codec is used
+def _make_simplejson():
+    import simplejson
+    return JsonCodec('simplejson', simplejson.loads, lambda obj: simplejson.dumps(obj, allow_nan=True), object_hook=True,
+                     make_encoder=lambda default: simplejson.JSONEncoder(default=default, allow_nan=True).encode)
+
+def _make_ujson():
+    import ujson
+    loads = ujson.loads
+    dumps = ujson.dumps
+    try:
+        # Releases before 2.0 round floats unless asked not to
+        ujson.loads('0.5', precise_float=True)
+        loads = lambda json_str: ujson.loads(json_str, precise_float=True)
+        dumps = lambda obj: ujson.dumps(obj, double_precision=15)
+    except TypeError:
+        pass
+    return JsonCodec('ujson', loads, dumps)
+
+def _make_json():
+    return JsonCodec('json', py_json.loads, py_json.dumps, object_hook=True,
+                     make_encoder=lambda default: py_json.JSONEncoder(default=default).encode)
+
+builtin_codecs = {
+    'simplejson': _make_simplejson,
+    'ujson': _make_ujson,
+    'json': _make_json
+}
+
+# ujson is not in this list because older releases cannot write every double
+# so that it reads back unchanged. It can still be selected explicitly.
+detection_order = ['simplejson', 'json']
+
+def _detect():
+    for name in detection_order:
+        try:
+            return builtin_codecs[name]()
+        except ImportError:
+            pass
+    return _make_json()
+
+# Detected on first use, since importing simplejson takes a while
+current_codec = None
+
+# Select the JSON codec used by the driver. `codec` is either the name of
+# one of the built in codecs ('simplejson', 'ujson' or 'json'), a
+# `JsonCodec`, or any object with `loads` and `dumps` functions. Passing
+# None goes back to the automatically detected codec.
+def set_json_codec(codec):
+    global current_codec
+    if codec is None:
+        current_codec = _detect()
+    elif isinstance(codec, JsonCodec):
+        current_codec = codec
+    elif isinstance(codec, basestring):
+        if codec not in builtin_codecs:
+            raise RqlDriverError("Unknown JSON codec \"%s\"." % codec)
+        try:
+            current_codec = builtin_codecs[codec]()
+        except ImportError:
+            raise RqlDriverError("JSON codec \"%s\" is not installed." % codec)
+    elif hasattr(codec, 'loads') and hasattr(codec, 'dumps'):
+        current_codec = JsonCodec(getattr(codec, '__name__', repr(codec)), codec.loads, codec.dumps)
+    else:
+        raise RqlDriverError("A JSON codec must provide `loads` and `dumps` functions.")
+    return current_codec
+
+def get_json_codec():
+    global current_codec
+    if current_codec is None:
+        current_codec = _detect()
+    return current_codec
@@ -1,25 +1,28 @@
 # Copyright 2010-2012 RethinkDB, all rights reserved.
 
-__all__ = ['connect', 'Connection', 'Cursor', 'protobuf_implementation']
+__all__ = ['connect', 'connect_async', 'Connection', 'MultiplexedConnection', 'QueryFuture', 'Cursor', 'get_protobuf_implementation']
 
+import array
+import collections
 import errno
+import math
+import Queue
 import socket
 import struct
+import threading
+import time
 from os import environ
 
-try:
-    import rethinkdb.pbcpp
-    protobuf_implementation = 'cpp'
-except ImportError:
-    protobuf_implementation = 'python'
-
-from rethinkdb import ql2_pb2 as p
+from rethinkdb import ql2 as p
 
 from rethinkdb import repl # For the repl connection
 from rethinkdb.errors import *
-from rethinkdb.ast import Datum, DB, expr
+from rethinkdb.ast import Datum, DB, expr, _query_term_key, _varint
 
 class Cursor(object):
+    # Upper bound for the prefetch depth picked by `prefetch='auto'`
+    max_prefetch = 16
+
     def __init__(self, conn, query, term, format_opts, opts):
         self.conn = conn
         self.query = query
@@ -29,40 +32,224 @@ class Cursor(object):
         self.responses = [ ]
         self.outstanding_requests = 0
         self.end_flag = False
+        self.final_received = False
+
+        # Raised once the batches already received are read, if the stream
+        # was cut short by the connection closing
+        self.error = None
+
+        # The number of batches to request ahead of the one being read
+        prefetch = opts.get('prefetch', 1)
+        self.adaptive_prefetch = prefetch == 'auto'
+        self.prefetch = 1 if self.adaptive_prefetch else prefetch
+
+        # When the last batch was handed out and how long it took to arrive
+        self.batch_handed_out = None
+        self.batch_waited = 0
 
     def _extend(self, response):
+        # Requests sent ahead of the end of the stream are answered after the
+        # final batch and carry nothing for us
+        if self.final_received:
+            return
+
         self.end_flag = response.type != p.Response.SUCCESS_PARTIAL
+        self.final_received = self.end_flag
         self.responses.append(response)
-
-        if len(self.responses) == 1 and not self.end_flag:
+        self._prefetch()
+
+    # Send CONTINUEs until `prefetch` batches beyond the one currently being
+    # read are either buffered or requested
+    def _prefetch(self):
+        if self.end_flag:
+            return
+        for i in xrange(self.prefetch - len(self.responses) - self.outstanding_requests):
             self.conn._async_continue_cursor(self)
 
+    # Adjust the prefetch depth after reading a batch. If the reader had to
+    # wait for the batch, the round trip is longer than the time it takes to
+    # read `prefetch` batches, so ask for enough extra batches to cover the
+    # wait. If batches are piling up instead, back off by one.
+    def _adapt_prefetch(self, waited, reading_time):
+        if waited > 0:
+            extra = int(math.ceil(waited / max(reading_time, 1e-6)))
+            self.prefetch = min(self.prefetch + extra, self.max_prefetch)
+        elif len(self.responses) > 1 and self.prefetch > 1:
+            self.prefetch -= 1
+
+    def _check_response(self, response):
+        self.conn._check_error_response(response, self.term)
+        if response.type != p.Response.SUCCESS_PARTIAL and response.type != p.Response.SUCCESS_SEQUENCE:
+            raise RqlDriverError("Unexpected response type received for cursor")
+
+    # Take the next batch off the cursor, waiting for it if necessary.
+    # Returns None once the stream is exhausted.
+    def _next_response(self):
+        if self.adaptive_prefetch and self.batch_handed_out is not None and not self.end_flag:
+            self._adapt_prefetch(self.batch_waited, time.time() - self.batch_handed_out)
+
+        waited = 0
+        if len(self.responses) == 0 and not self.end_flag:
+            wait_start = time.time()
+            self.conn._continue_cursor(self)
+            waited = time.time() - wait_start
+
+        if len(self.responses) == 0 and self.end_flag:
+            if self.error is not None:
+                raise self.error
+            return None
+
+        response = self.responses.pop(0)
+        self._prefetch()
+        self._check_response(response)
+
+        self.batch_waited = waited
+        self.batch_handed_out = time.time()
+        return response
+
     def __iter__(self):
         format_opts = self.format_opts
-        deconstruct = Datum.deconstruct
+        deconstruct = Datum.decoder(format_opts)
         while True:
-            if len(self.responses) == 0 and not self.end_flag:
-                self.conn._continue_cursor(self)
-            if len(self.responses) == 1 and not self.end_flag:
-                self.conn._async_continue_cursor(self)
-
-            if len(self.responses) == 0 and self.end_flag:
+            response = self._next_response()
+            if response is None:
                 break
-
-            self.conn._check_error_response(self.responses[0], self.term)
-            if self.responses[0].type != p.Response.SUCCESS_PARTIAL and self.responses[0].type != p.Response.SUCCESS_SEQUENCE:
-                raise RqlDriverError("Unexpected response type received for cursor")
-
-            for datum in self.responses[0].response:
+            for datum in response.response:
                 yield deconstruct(datum, format_opts)
-            del self.responses[0]
+
+    # Returns the rows of the next batch sent by the server as a list, or
+    # None once the cursor is exhausted. Rows sent as JSON are decoded with a
+    # single call to the JSON codec.
+    def next_batch(self):
+        response = self._next_response()
+        if response is None:
+            return None
+        return Datum.deconstruct_batch(response.response, self.format_opts)
+
+    # Read all the remaining rows, one batch at a time
+    def to_list(self):
+        rows = [ ]
+        batch = self.next_batch()
+        while batch is not None:
+            rows.extend(batch)
+            batch = self.next_batch()
+        return rows
+
+    # Read all the remaining rows, which must be objects, into one column per
+    # field in `fields`. Returns a dict from field to column. Columns holding
+    # only numbers are `array.array('d')` buffers, which numpy and friends
+    # can wrap without copying; any other column is a list, with None for
+    # rows missing the field.
+    def to_columns(self, fields):
+        columns = dict((field, array.array('d')) for field in fields)
+        batch = self.next_batch()
+        while batch is not None:
+            for row in batch:
+                if not isinstance(row, collections.Mapping):
+                    raise RqlDriverError("Cursor.to_columns can only read rows that are objects.")
+
+            for field in fields:
+                values = [row.get(field) for row in batch]
+                column = columns[field]
+                if isinstance(column, array.array):
+                    try:
+                        if any(isinstance(value, bool) for value in values):
+                            raise TypeError()
+                        column.extend(array.array('d', values))
+                    except TypeError:
+                        columns[field] = column.tolist() + values
+                else:
+                    column.extend(values)
+            batch = self.next_batch()
+        return columns
 
     def close(self):
         if not self.end_flag:
             self.end_flag = True
             self.conn._end_cursor(self)
 
+# A receive buffer that is reused for the lifetime of a socket. Data is read
+# with `recv_into` as far ahead as the buffer allows, and complete frames are
+# handed out as memoryviews into the buffer rather than copied into new
+# strings. A view is only valid until the next read from the buffer.
+class ReceiveBuffer(object):
+    initial_size = 65536
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.buf = bytearray(self.initial_size)
+        self.start = 0 # Start of the data not yet handed out
+        self.end = 0   # End of the data received so far
+
+    # Make sure at least `needed` unconsumed bytes are in the buffer. Returns
+    # False if the connection was closed first.
+    def _fill(self, needed):
+        if self.start == self.end:
+            self.start = self.end = 0
+
+        if self.start + needed > len(self.buf):
+            available = self.end - self.start
+            if needed > len(self.buf):
+                # Grow geometrically so a run of large frames does not
+                # reallocate every time
+                new_buf = bytearray(max(needed, 2 * len(self.buf)))
+                new_buf[0:available] = self.buf[self.start:self.end]
+                self.buf = new_buf
+            else:
+                self.buf[0:available] = self.buf[self.start:self.end]
+            self.start = 0
+            self.end = available
+
+        view = memoryview(self.buf)
+        while self.end - self.start < needed:
+            received = self.conn._sock_recv_into(view[self.end:])
+            if received == 0:
+                return False
+            self.end += received
+        return True
+
+    # Returns the bytes up to (but not including) `delimiter`
+    def read_until(self, delimiter):
+        searched = 0 # Relative to `start`, which `_fill` may move
+        while True:
+            index = self.buf.find(delimiter, self.start + searched, self.end)
+            if index != -1:
+                data = bytes(self.buf[self.start:index])
+                self.start = index + len(delimiter)
+                return data
+
+            searched = max(0, self.end - self.start - len(delimiter) + 1)
+            if not self._fill(self.end - self.start + 1):
+                raise RqlDriverError("Connection is closed.")
+
+    # Returns a memoryview over the body of the next length-prefixed frame
+    def read_frame(self):
+        if not self._fill(4):
+            raise RqlDriverError("Connection is closed.")
+
+        # The first 4 bytes give the expected length of this response
+        (response_len,) = struct.unpack_from("<L", self.buf, self.start)
+
+        if not self._fill(4 + response_len):
+            raise RqlDriverError("Connection is broken.")
+
+        frame_start = self.start + 4
+        self.start = frame_start + response_len
+        return memoryview(self.buf)[frame_start:self.start]
+
 class Connection(object):
+    # Type of the object returned for sequence responses
+    _cursor_class = Cursor
+
+    # Whether the protobuf library can parse directly from a memoryview
+    _parse_views = True
+
+    # Run options that only affect the driver and are not sent to the server
+    client_opt_args = frozenset(['decode', 'prefetch'])
+
+    # Fields of the `batch_conf` run option understood by the server
+    batch_conf_fields = frozenset(['min_els', 'max_els', 'max_size', 'max_dur', 'first_scaledown'])
+
     def __init__(self, host, port, db, auth_key, timeout):
         self.socket = None
         self.host = host
@@ -97,16 +284,12 @@ class Connection(object):
         except Exception as err:
             raise RqlDriverError("Could not connect to %s:%s. Error: %s" % (self.host, self.port, err))
 
+        self._recv_buffer = ReceiveBuffer(self)
         self._sock_sendall(struct.pack("<L", p.VersionDummy.V0_2))
         self._sock_sendall(struct.pack("<L", len(self.auth_key)) + str.encode(self.auth_key, 'ascii'))
 
         # Read out the response from the server, which will be a null-terminated string
-        response = b""
-        while True:
-            char = self._sock_recv(1)
-            if char == b"\0":
-                break
-            response += char
+        response = self._recv_buffer.read_until(b"\0")
 
         if response != b"SUCCESS":
             self.close(noreply_wait=False)
@@ -130,13 +313,10 @@ class Connection(object):
         self.cursor_cache = { }
 
     def noreply_wait(self):
-        token = self.next_token
-        self.next_token += 1
-
         # Construct query
         query = p.Query()
         query.type = p.Query.NOREPLY_WAIT
-        query.token = token
+        query.token = self._next_token()
 
         # Send the request
         return self._send_query(query, 'noreply_wait')
@@ -148,10 +328,10 @@ class Connection(object):
         repl.default_connection = self
         return self
 
-    def _sock_recv(self, length):
+    def _sock_recv_into(self, buf):
         while True:
             try:
-                return self.socket.recv(length)
+                return self.socket.recv_into(buf)
             except IOError as e:
                 if e.errno != errno.EINTR:
                     raise
@@ -165,15 +345,65 @@ class Connection(object):
                     raise
 
     def _start(self, term, **global_opt_args):
+        query = self._build_start_query(term, global_opt_args)
+        return self._send_query(query, term, global_opt_args)
+
+    # Run several queries at once, sending all of them with a single write,
+    # and return their results in order. The run options apply to every
+    # query. If any query fails, cursors returned by the others are closed
+    # and the error of the first query that failed is raised.
+    def run_many(self, terms, **global_opt_args):
+        if not self.socket:
+            raise RqlDriverError("Connection is closed.")
+
+        started = self._build_start_queries(terms, global_opt_args)
+        self._sock_sendall(''.join(self._serialize_query(query, term) for (query, term, opts) in started))
+        if global_opt_args.get('noreply'):
+            return [None] * len(started)
+
+        responses = self._read_responses([query.token for (query, term, opts) in started])
+        return self._process_responses([(responses[query.token], query, term, opts) for (query, term, opts) in started])
+
+    # Returns a (query, term, run options) triple for each term
+    def _build_start_queries(self, terms, global_opt_args):
+        started = [ ]
+        for term in terms:
+            opts = dict(global_opt_args)
+            started.append((self._build_start_query(term, opts), term, opts))
+        return started
+
+    def _process_responses(self, results):
+        values = [ ]
+        error = None
+        for (response, query, term, opts) in results:
+            try:
+                values.append(self._process_response(response, query, term, opts))
+            except RqlError as err:
+                error = error or err
+                values.append(None)
+
+        if error is not None:
+            self._close_cursors([value for value in values if isinstance(value, Cursor)])
+            raise error
+        return values
+
+    def _close_cursors(self, cursors):
+        for cursor in cursors:
+            cursor.close()
+
+    def _next_token(self):
         token = self.next_token
         self.next_token += 1
+        return token
 
+    def _build_start_query(self, term, global_opt_args):
         # Construct query
         query = p.Query()
         query.type = p.Query.START
-        query.token = token
+        query.token = self._next_token()
 
         # Set global opt args
+        self._check_opt_args(global_opt_args)
 
         # The 'db' option will default to this connection's default
         # if not otherwise specified.
@@ -184,24 +414,40 @@ class Connection(object):
                global_opt_args['db'] = DB(self.db)
 
         for k,v in global_opt_args.items():
+            if k in self.client_opt_args:
+                continue
             pair = query.global_optargs.add()
             pair.key = k
             expr(v).build(pair.val)
 
-        # Compile query to protobuf
-        term.build(query.query)
-        return self._send_query(query, term, global_opt_args)
+        # The term itself is only serialized when the query is written
+        return query
+
+    def _check_opt_args(self, global_opt_args):
+        if 'prefetch' in global_opt_args:
+            prefetch = global_opt_args['prefetch']
+            if prefetch != 'auto' and (not isinstance(prefetch, (int, long)) or isinstance(prefetch, bool) or prefetch < 0):
+                raise RqlDriverError("The prefetch run option must be a non-negative integer or \"auto\".")
+
+        if 'batch_conf' in global_opt_args:
+            batch_conf = global_opt_args['batch_conf']
+            if not isinstance(batch_conf, dict):
+                raise RqlDriverError("The batch_conf run option must be a dict.")
+            for k in batch_conf:
+                if k not in self.batch_conf_fields:
+                    raise RqlDriverError("Unknown batch_conf field \"%s\"." % k)
 
     def _handle_cursor_response(self, response):
         cursor = self.cursor_cache[response.token]
-        cursor._extend(response)
         cursor.outstanding_requests -= 1
+        cursor._extend(response)
 
         if response.type != p.Response.SUCCESS_PARTIAL and cursor.outstanding_requests == 0:
             del self.cursor_cache[response.token]
 
     def _continue_cursor(self, cursor):
-        self._async_continue_cursor(cursor)
+        if cursor.outstanding_requests == 0:
+            self._async_continue_cursor(cursor)
         self._handle_cursor_response(self._read_response(cursor.query.token))
 
     def _async_continue_cursor(self, cursor):
@@ -218,39 +464,23 @@ class Connection(object):
         query = p.Query()
         query.type = p.Query.STOP
         query.token = cursor.query.token
-        self._send_query(cursor.query, cursor.term, async=True)
-        self._handle_cursor_response(self._read_response(cursor.query.token))
+        self._send_query(query, cursor.term, async=True)
+
+        # Batches requested ahead of time are answered before the STOP
+        while cursor.query.token in self.cursor_cache:
+            self._handle_cursor_response(self._read_response(cursor.query.token))
 
     def _read_response(self, token):
         # We may get an async continue result, in which case we save it and read the next response
         while True:
-            response_buf = b''
             try:
-                response_header = b''
-                while len(response_header) < 4:
-                    chunk = self._sock_recv(4)
-                    if len(chunk) == 0:
-                        raise RqlDriverError("Connection is closed.")
-                    response_header += chunk
-
-                # The first 4 bytes give the expected length of this response
-                (response_len,) = struct.unpack("<L", response_header)
-
-                while len(response_buf) < response_len:
-                    chunk = self._sock_recv(response_len - len(response_buf))
-                    if len(chunk) == 0:
-                        raise RqlDriverError("Connection is broken.")
-                    response_buf += chunk
+                response = self._read_frame()
             except KeyboardInterrupt as err:
                 # When interrupted while waiting for a response cancel the outstanding
                 # requests by resetting this connection
                 self.reconnect()
                 raise err
 
-            # Construct response
-            response = p.Response()
-            response.ParseFromString(response_buf)
-
             # Check that this is the response we were expecting
             if response.token == token:
                 return response
@@ -260,6 +490,46 @@ class Connection(object):
                 # This response is corrupted or not intended for us.
                 raise RqlDriverError("Unexpected response received.")
 
+    # Like `_read_response`, for several queries in flight at once. Returns a
+    # dict from token to response.
+    def _read_responses(self, tokens):
+        pending = set(tokens)
+        responses = { }
+        while len(pending) > 0:
+            try:
+                response = self._read_frame()
+            except KeyboardInterrupt as err:
+                self.reconnect()
+                raise err
+
+            if response.token in pending:
+                pending.remove(response.token)
+                responses[response.token] = response
+            elif response.token in self.cursor_cache:
+                self._handle_cursor_response(response)
+            else:
+                raise RqlDriverError("Unexpected response received.")
+        return responses
+
+    # Reads a single length-prefixed response frame off the socket
+    def _read_frame(self):
+        response_buf = self._recv_buffer.read_frame()
+        if p.load_decoder() is not None:
+            return p.DecodedResponse(response_buf)
+
+        # Construct response
+        response = p.Response()
+        if Connection._parse_views:
+            try:
+                response.ParseFromString(response_buf)
+                return response
+            except TypeError:
+                # Older protobuf releases only parse strings
+                Connection._parse_views = False
+                response = p.Response()
+        response.ParseFromString(response_buf.tobytes())
+        return response
+
     def _check_error_response(self, response, term):
         if response.type == p.Response.RUNTIME_ERROR:
             message = Datum.deconstruct(response.response[0])
@@ -282,12 +552,7 @@ class Connection(object):
         if not self.socket:
             raise RqlDriverError("Connection is closed.")
 
-        query.accepts_r_json = True
-
-        # Send protobuf
-        query_protobuf = query.SerializeToString()
-        query_header = struct.pack("<L", len(query_protobuf))
-        self._sock_sendall(query_header + query_protobuf)
+        self._write_query(query, term)
 
         if 'noreply' in opts and opts['noreply']:
             return None
@@ -296,7 +561,29 @@ class Connection(object):
 
         # Get response
         response = self._read_response(query.token)
+        return self._process_response(response, query, term, opts)
+
+    def _write_query(self, query, term=None):
+        self._sock_sendall(self._serialize_query(query, term))
+
+    # Returns the length-prefixed protobuf for this query. The term of a START
+    # query is serialized directly by `RqlQuery.serialize` and goes right
+    # after the query type, which is the first field and takes two bytes, so
+    # the result is the same as serializing a fully built Query.
+    def _serialize_query(self, query, term=None):
+        query.accepts_r_json = True
+
+        query_protobuf = query.SerializeToString()
+        if query.type == p.Query.START:
+            term_protobuf = term.serialize()
+            query_protobuf = ''.join((query_protobuf[:2], _query_term_key, _varint(len(term_protobuf)),
+                                      term_protobuf, query_protobuf[2:]))
+        query_header = struct.pack("<L", len(query_protobuf))
+        return query_header + query_protobuf
 
+    # Converts the response to a START or NOREPLY_WAIT query into the value
+    # returned to the user, raising any error the server reported
+    def _process_response(self, response, query, term, opts):
         self._check_error_response(response, term)
 
         format_opts = {}
@@ -304,10 +591,12 @@ class Connection(object):
             format_opts['time_format'] = opts['time_format']
         if 'group_format' in opts:
             format_opts['group_format'] = opts['group_format']
+        if 'decode' in opts:
+            format_opts['decode'] = opts['decode']
 
         # Sequence responses
         if response.type == p.Response.SUCCESS_PARTIAL or response.type == p.Response.SUCCESS_SEQUENCE:
-            value = Cursor(self, query, term, format_opts, opts)
+            value = self._cursor_class(self, query, term, format_opts, opts)
             self.cursor_cache[query.token] = value
             value._extend(response)
 
@@ -334,5 +623,280 @@ class Connection(object):
             # response.profile does not exist
             return value
 
-def connect(host='localhost', port=28015, db=None, auth_key="", timeout=20):
+# The result of a query submitted on a `MultiplexedConnection`. The response
+# is filled in by the connection's reader thread; `result` blocks until it
+# arrives and converts it exactly like `Connection.run` would.
+class QueryFuture(object):
+    def __init__(self, conn, query, term, opts):
+        self.conn = conn
+        self.query = query
+        self.term = term
+        self.opts = opts
+        self._event = threading.Event()
+        self._response = None
+        self._error = None
+        self._value = None
+        self._processed = False
+
+    def _set_response(self, response):
+        self._response = response
+        self._event.set()
+
+    def _set_error(self, error):
+        self._error = error
+        self._event.set()
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise RqlDriverError("Timed out waiting for a response.")
+        if self._error is not None:
+            raise self._error
+
+        with self.conn._cond:
+            if not self._processed:
+                self._processed = True
+                try:
+                    self._value = self.conn._process_response(self._response, self.query, self.term, self.opts)
+                except Exception as err:
+                    self._error = err
+                    raise
+        return self._value
+
+# A connection that lets many queries be in flight at once. Queries are
+# written to the socket as soon as they are submitted and a single reader
+# thread demultiplexes the responses by token, so it is safe to share one
+# of these between threads.
+class MultiplexedConnection(Connection):
+    def __init__(self, host, port, db, auth_key, timeout):
+        # Nothing writes to the socket while holding `_cond`, and the reader
+        # thread never writes to it, so responses keep being read while a
+        # large query is sent. The CONTINUE and STOP queries of cursors,
+        # which are decided on with `_cond` held, are queued and sent by a
+        # writer thread.
+        self._cond = threading.Condition(threading.RLock())
+        self._send_lock = threading.Lock()
+        self._token_lock = threading.Lock()
+        self._futures = { }
+        self._reader = None
+        self._reader_error = None
+        self._writer = None
+        self._cursor_queries = None
+        Connection.__init__(self, host, port, db, auth_key, timeout)
+
+    def reconnect(self, noreply_wait=True):
+        Connection.reconnect(self, noreply_wait)
+
+        self._reader_error = None
+        self._reader = threading.Thread(target=self._reader_loop, name="rethinkdb-reader")
+        self._reader.daemon = True
+        self._reader.start()
+
+        self._cursor_queries = Queue.Queue()
+        self._writer = threading.Thread(target=self._writer_loop, args=(self._cursor_queries,), name="rethinkdb-writer")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def close(self, noreply_wait=True):
+        if self.socket and noreply_wait:
+            self.noreply_wait()
+        with self._cond:
+            self._end_cursors(RqlDriverError("Connection is closed."))
+        if self._writer is not None:
+            self._cursor_queries.put(None)
+        Connection.close(self, noreply_wait=False)
+
+        for thread in [self._reader, self._writer]:
+            if thread is not None and thread is not threading.current_thread():
+                thread.join()
+        self._reader = None
+        self._writer = None
+
+    def noreply_wait(self):
+        query = p.Query()
+        query.type = p.Query.NOREPLY_WAIT
+        query.token = self._next_token()
+        return self._submit(query, 'noreply_wait', {}).result()
+
+    # Send a query without waiting for its response. Returns a `QueryFuture`,
+    # or None for `noreply` queries.
+    def submit(self, term, **global_opt_args):
+        query = self._build_start_query(term, global_opt_args)
+        return self._submit(query, term, global_opt_args)
+
+    def _next_token(self):
+        with self._token_lock:
+            return Connection._next_token(self)
+
+    def _write_query(self, query, term=None):
+        data = self._serialize_query(query, term)
+        with self._send_lock:
+            self._sock_sendall(data)
+
+    def run_many(self, terms, **global_opt_args):
+        if not self.socket:
+            raise RqlDriverError("Connection is closed.")
+
+        started = self._build_start_queries(terms, global_opt_args)
+        data = ''.join(self._serialize_query(query, term) for (query, term, opts) in started)
+
+        noreply = global_opt_args.get('noreply')
+        futures = [None if noreply else QueryFuture(self, query, term, opts) for (query, term, opts) in started]
+        if not noreply:
+            with self._cond:
+                for future in futures:
+                    self._futures[future.query.token] = future
+
+        with self._send_lock:
+            self._sock_sendall(data)
+        if noreply:
+            return [None] * len(started)
+
+        for future in futures:
+            future._event.wait()
+            if future._error is not None:
+                raise future._error
+        # Held like in `QueryFuture.result`, so that the reader can't extend
+        # the cursors before their first batches are processed
+        with self._cond:
+            return self._process_responses([(future._response, future.query, future.term, future.opts) for future in futures])
+
+    def _start(self, term, **global_opt_args):
+        future = self.submit(term, **global_opt_args)
+        if future is None:
+            return None
+        return future.result()
+
+    def _submit(self, query, term, opts):
+        if not self.socket:
+            raise RqlDriverError("Connection is closed.")
+
+        # Serialize first so that a query that cannot be sent leaves nothing
+        # behind
+        data = self._serialize_query(query, term)
+
+        future = None
+        if not ('noreply' in opts and opts['noreply']):
+            future = QueryFuture(self, query, term, opts)
+            with self._cond:
+                self._futures[query.token] = future
+
+        with self._send_lock:
+            self._sock_sendall(data)
+        return future
+
+    # Queues a CONTINUE or STOP for the writer thread, which sends them in
+    # the order they were queued
+    def _send_cursor_query(self, cursor, query_type):
+        with self._cond:
+            # The reader may have finished this cursor since the caller
+            # last looked at it
+            if cursor.query.token not in self.cursor_cache:
+                return
+            cursor.outstanding_requests += 1
+
+            query = p.Query()
+            query.type = query_type
+            query.token = cursor.query.token
+            self._cursor_queries.put(self._serialize_query(query))
+
+    def _continue_cursor(self, cursor):
+        with self._cond:
+            if cursor.outstanding_requests == 0:
+                self._send_cursor_query(cursor, p.Query.CONTINUE)
+            while len(cursor.responses) == 0 and not cursor.end_flag:
+                self._wait_for_reader()
+
+    def _async_continue_cursor(self, cursor):
+        self._send_cursor_query(cursor, p.Query.CONTINUE)
+
+    def _end_cursor(self, cursor):
+        with self._cond:
+            self._send_cursor_query(cursor, p.Query.STOP)
+            while cursor.query.token in self.cursor_cache:
+                self._wait_for_reader()
+
+    # Must be called with `_cond` held. Ends the cursors that are still
+    # reading with `err` and wakes up the threads waiting on them.
+    def _end_cursors(self, err):
+        for cursor in self.cursor_cache.values():
+            cursor.end_flag = True
+            if not cursor.final_received:
+                cursor.error = err
+        self.cursor_cache = { }
+        self._cond.notify_all()
+
+    # Must be called with `_cond` held
+    def _wait_for_reader(self):
+        if self._reader_error is not None:
+            raise self._reader_error
+        if self._reader is None:
+            raise RqlDriverError("Connection is closed.")
+        self._cond.wait(1)
+
+    # Sends the queued cursor queries, all those waiting in one write, until
+    # the None queued by `close`
+    def _writer_loop(self, queries):
+        try:
+            while True:
+                waiting = [queries.get()]
+                try:
+                    while True:
+                        waiting.append(queries.get_nowait())
+                except Queue.Empty:
+                    pass
+                if None in waiting:
+                    return
+                with self._send_lock:
+                    self._sock_sendall(''.join(waiting))
+        except Exception:
+            # The connection is broken. Shutting it down makes the reader
+            # report that to everyone waiting on it.
+            sock = self.socket
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
+
+    def _reader_loop(self):
+        try:
+            while True:
+                response = self._read_frame()
+                with self._cond:
+                    if response.token in self._futures:
+                        self._futures.pop(response.token)._set_response(response)
+                    elif response.token in self.cursor_cache:
+                        self._handle_cursor_response(response)
+                    # Anything else belongs to a cursor that has already
+                    # been closed and is dropped.
+                    self._cond.notify_all()
+        except Exception as err:
+            if not isinstance(err, RqlDriverError):
+                err = RqlDriverError("Connection is closed.")
+            with self._cond:
+                self._reader_error = err
+                for future in self._futures.values():
+                    future._set_error(err)
+                self._futures = { }
+                self._end_cursors(err)
+
+def connect(host='localhost', port=28015, db=None, auth_key="", timeout=20, multiplex=False):
+    if multiplex:
+        return MultiplexedConnection(host, port, db, auth_key, timeout)
     return Connection(host, port, db, auth_key, timeout)
+
+# Returns a coroutine that resolves to an `AsyncConnection`. The event loop
+# support lives in its own module so that `import rethinkdb` does not need it.
+def connect_async(host='localhost', port=28015, db=None, auth_key="", timeout=20, loop=None):
+    from rethinkdb import asyncio_net
+    return asyncio_net.connect(host, port, db, auth_key, timeout, loop)
+
+# 'cpp' if queries are serialized by the C++ protobuf backend, otherwise
+# 'python'. Loads the protocol messages, since whether the backend can be
+# used is only known once it has been imported.
+def get_protobuf_implementation():
+    p.load()
+    return p.protobuf_implementation
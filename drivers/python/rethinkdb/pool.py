@@ -0,0 +1,166 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+__all__ = ['ConnectionPool']
+
+import collections
+import contextlib
+import socket
+import threading
+import time
+
+from rethinkdb.errors import *
+from rethinkdb.net import Connection
+
+# A thread safe pool of connections spread round-robin over one or more
+# servers of a cluster. Connections are handed out with `checkout` and
+# returned with `checkin` (or borrowed for a `with` block using
+# `connection`). Closed connections are reconnected lazily on their next
+# checkout, and connections that have been idle longer than
+# `idle_check_interval` seconds are probed before being handed out.
+class ConnectionPool(object):
+    def __init__(self, hosts=['localhost:28015'], db=None, auth_key="", timeout=20,
+                 min_size=0, max_size=10, idle_check_interval=30):
+        if max_size < 1 or min_size > max_size:
+            raise RqlDriverError("ConnectionPool needs 0 <= min_size <= max_size and max_size >= 1.")
+
+        self.hosts = [self._parse_host(host) for host in hosts]
+        if len(self.hosts) == 0:
+            raise RqlDriverError("ConnectionPool must be given at least one host.")
+
+        self.db = db
+        self.auth_key = auth_key
+        self.timeout = timeout
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_check_interval = idle_check_interval
+
+        self._cond = threading.Condition()
+        self._idle = collections.deque() # (connection, time it was checked in)
+        self._size = 0
+        self._next_host = 0
+        self._closed = False
+
+        for conn in [self.checkout() for i in xrange(min_size)]:
+            self.checkin(conn)
+
+    @staticmethod
+    def _parse_host(host):
+        if isinstance(host, tuple):
+            return host
+        host_port = host.split(":")
+        if len(host_port) == 1:
+            return (host_port[0], 28015)
+        if len(host_port) != 2:
+            raise RqlDriverError("Invalid 'host:port' format: %s" % host)
+        return tuple(host_port)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    # Borrow a connection for the duration of a `with` block
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        conn = self.checkout(timeout)
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+
+    def checkout(self, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RqlDriverError("Connection pool is closed.")
+                if len(self._idle) > 0:
+                    (conn, checked_in) = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    conn = None
+                    break
+
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise RqlDriverError("Timed out waiting for a connection from the pool.")
+                self._cond.wait(remaining)
+
+        try:
+            if conn is not None:
+                try:
+                    if conn.socket is None:
+                        conn.reconnect(noreply_wait=False)
+                    elif time.time() - checked_in > self.idle_check_interval:
+                        self._probe(conn)
+                    return conn
+                except Exception:
+                    conn.close(noreply_wait=False)
+
+            # Open a fresh connection, possibly to another host if the one
+            # this connection used is down
+            return self._open()
+        except Exception:
+            self._discard()
+            raise
+
+    def checkin(self, conn):
+        conn.db = self.db
+        with self._cond:
+            if self._closed:
+                self._size -= 1
+                conn.close(noreply_wait=False)
+            else:
+                # Most recently used connections are handed out first since
+                # they are the least likely to need a probe
+                self._idle.append((conn, time.time()))
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle = self._idle
+            self._idle = collections.deque()
+            self._size -= len(idle)
+            self._cond.notify_all()
+
+        for (conn, checked_in) in idle:
+            conn.close(noreply_wait=False)
+
+    # The number of connections currently open or being opened, and how many
+    # of those are idle in the pool
+    def size(self):
+        with self._cond:
+            return (self._size, len(self._idle))
+
+    def _discard(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    # Open a new connection, trying each host once starting from the next one
+    # in round-robin order
+    def _open(self):
+        with self._cond:
+            start = self._next_host
+            self._next_host = (self._next_host + 1) % len(self.hosts)
+
+        last_error = None
+        for i in xrange(len(self.hosts)):
+            (host, port) = self.hosts[(start + i) % len(self.hosts)]
+            try:
+                return Connection(host, port, self.db, self.auth_key, self.timeout)
+            except (RqlDriverError, socket.error) as err:
+                last_error = err
+        raise last_error
+
+    # A NOREPLY_WAIT is a full round trip that needs no query to be built, so
+    # it makes a cheap liveness check. Dead connections are reconnected.
+    def _probe(self, conn):
+        try:
+            conn.noreply_wait()
+        except Exception:
+            conn.reconnect(noreply_wait=False)
@@ -0,0 +1,102 @@
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# The protocol messages, loaded on first use. Importing `ql2_pb2` imports
+# google.protobuf, which takes longer than the rest of the driver put
+# together, while building and serializing queries only needs the values of
+# the protocol's enums. Those come from `ql2_enums`, which is generated from
+# ql2.proto next to `ql2_pb2`, and the message classes are only loaded the
+# first time one is used, usually when a connection reads its first response.
+#
+# `p.Term.FUNC`, `p.Query()` and `p.Term.AssocPair` work the same whether `p`
+# is this module or `ql2_pb2`.
+
+import collections
+import imp
+import os
+
+try:
+    from rethinkdb import ql2_enums
+except ImportError:
+    ql2_enums = None
+
+# 'cpp' if the C++ protobuf backend is installed, which `load` then uses
+try:
+    imp.find_module('_pbcpp', [os.path.dirname(__file__)])
+    protobuf_implementation = 'cpp'
+except ImportError:
+    protobuf_implementation = 'python'
+
+ql2_pb2 = None
+
+def load():
+    global ql2_pb2, protobuf_implementation
+    if ql2_pb2 is None:
+        if protobuf_implementation == 'cpp':
+            try:
+                import rethinkdb.pbcpp
+            except ImportError:
+                protobuf_implementation = 'python'
+        from rethinkdb import ql2_pb2 as pb
+        ql2_pb2 = pb
+    return ql2_pb2
+
+# The `_pbcpp` extension if it was built with its response decoder, which
+# is looked for the first time a response is read
+decoder = False
+
+def load_decoder():
+    global decoder
+    if decoder is False:
+        try:
+            from rethinkdb import _pbcpp
+            decoder = _pbcpp if hasattr(_pbcpp, 'decode_response') else None
+        except ImportError:
+            decoder = None
+    return decoder
+
+DecodedBacktrace = collections.namedtuple('DecodedBacktrace', ['frames'])
+DecodedFrame = collections.namedtuple('DecodedFrame', ['type', 'pos', 'opt'])
+
+# A Response read by the C decoder. The datums in `response` and `profile`
+# are left serialized, and converted by `Datum.deconstruct` once the options
+# of the query they answer are known.
+class DecodedResponse(object):
+    __slots__ = ('type', 'token', 'response', 'backtrace', 'profile')
+
+    def __init__(self, buf):
+        (self.type, self.token, self.response, frames, profile) = load_decoder().decode_response(buf)
+        self.backtrace = DecodedBacktrace([DecodedFrame(*frame) for frame in frames])
+        # An unset profile is an empty datum, which is null
+        self.profile = '' if profile is None else profile
+
+# Stands in for a message class. The enum values are set on it from the
+# start; anything else loads the protobuf module.
+class LazyMessage(object):
+    def __init__(self, name, values):
+        self.__dict__.update(values)
+        self._name = name
+        self._message = None
+
+    def _load(self):
+        if self._message is None:
+            self._message = getattr(load(), self._name)
+        return self._message
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __repr__(self):
+        return "<LazyMessage %s>" % self._name
+
+if ql2_enums is None:
+    # Nothing to stand in with, so this is just `ql2_pb2`
+    for (name, message) in vars(load()).items():
+        if isinstance(message, type):
+            globals()[name] = message
+else:
+    for (name, values) in vars(ql2_enums).items():
+        if isinstance(values, type):
+            globals()[name] = LazyMessage(name, [(k, v) for (k, v) in vars(values).items() if not k.startswith('_')])
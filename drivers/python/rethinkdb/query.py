@@ -1,5 +1,5 @@
 from .ast import *
-from . import ql2_pb2 as p
+from . import ql2 as p
 import datetime
 
 """
@@ -14,6 +14,9 @@ def js(js_str, timeout=()):
 def error(*msg):
     return UserError(*msg)
 
+def prepare(func):
+    return PreparedQuery(func)
+
 def do(arg0, *args):
     args = [arg0]+[x for x in args]
     return FunCall(func_wrap(args[-1]), *args[:-1])
@@ -150,7 +153,7 @@ november    = type('', (RqlTimeName,), {'tt': p.Term.NOVEMBER, 'st': 'november'}
 december    = type('', (RqlTimeName,), {'tt': p.Term.DECEMBER, 'st': 'december'})()
 
 def make_timezone(tzstring):
-    return RqlTzinfo(tzstring)
+    return tzinfo_for_offset(tzstring)
 
 # Merge values
 def literal(val=()):
@@ -0,0 +1,90 @@
+#!/usr/bin/python
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# Measures how long `import rethinkdb` takes in a new interpreter, which is
+# most of the startup cost of short-lived scripts that run a few queries.
+# Like `python -X importtime` in Python 3.7, it also lists the modules loaded
+# by the import with the time spent in each one alone and including the
+# modules it imported.
+#
+# Run with:
+#   python driver_import.py [runs]
+
+import subprocess
+import sys
+import time
+
+driver_path = "../../drivers/python"
+
+# Run in a new interpreter by `import_times`. Prints one line per module as
+# `self cumulative name`, in microseconds, most expensive first.
+child_source = r"""
+import __builtin__, sys, time
+sys.path.insert(0, %r)
+
+real_import = __builtin__.__import__
+children = [(0.0, set())]
+times = [ ]
+
+# Python 2 records failed implicit relative imports as None
+def loaded_modules():
+    return set(name for (name, module) in sys.modules.items() if module is not None)
+
+def timed_import(name, *args, **kwargs):
+    before = loaded_modules()
+    children.append((0.0, set()))
+    start = time.time()
+    try:
+        return real_import(name, *args, **kwargs)
+    finally:
+        total = time.time() - start
+        (children_time, children_modules) = children.pop()
+        new = loaded_modules() - before
+        own = new - children_modules
+        (parent_time, parent_modules) = children[-1]
+        children[-1] = (parent_time + total, parent_modules | new)
+        if len(own) > 0:
+            times.append((total - children_time, total, ",".join(sorted(own))))
+
+__builtin__.__import__ = timed_import
+import rethinkdb
+__builtin__.__import__ = real_import
+
+for (own, total, name) in sorted(times, key=lambda t: -t[1]):
+    print int(own * 1000000), int(total * 1000000), name
+""" % driver_path
+
+# Wall clock time of running `source` in a new interpreter, best of `runs`
+def run_time(source, runs):
+    best = None
+    for i in xrange(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, "-c", source])
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def import_times():
+    output = subprocess.check_output([sys.executable, "-c", child_source])
+    return [(int(own), int(total), name) for (own, total, name) in [line.split(" ", 2) for line in output.splitlines()]]
+
+# Modules that `import rethinkdb` should not load
+deferred_modules = ['google.protobuf', 'simplejson', 'rethinkdb.ql2_pb2']
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    interpreter = run_time("pass", runs)
+    driver = run_time("import sys; sys.path.insert(0, %r); import rethinkdb" % driver_path, runs)
+    print "interpreter startup       %7.1f ms" % (interpreter * 1000)
+    print "import rethinkdb          %7.1f ms" % ((driver - interpreter) * 1000)
+
+    loaded = subprocess.check_output([sys.executable, "-c",
+        "import sys; sys.path.insert(0, %r); import rethinkdb; print ' '.join(sys.modules)" % driver_path]).split()
+    for name in deferred_modules:
+        print "%-25s %s" % (name, "loaded" if name in loaded else "not loaded")
+
+    print
+    print "%10s | %10s | %s" % ("self [us]", "cumulative", "imported module")
+    for (own, total, name) in import_times():
+        print "%10d | %10d | %s" % (own, total, name)
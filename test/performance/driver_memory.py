@@ -0,0 +1,55 @@
+#!/usr/bin/python
+# Copyright 2010-2014 RethinkDB, all rights reserved.
+
+# Measures how much memory the Python driver spends on the nodes of a query's
+# AST. Only the nodes themselves and the containers holding their arguments
+# are counted, not the Python values wrapped in `Datum` leaves.
+#
+# Run with:
+#   python driver_memory.py
+
+import sys
+from sys import path
+
+path.insert(0, "../../drivers/python")
+
+import rethinkdb as r
+from rethinkdb.ast import RqlQuery
+
+def docs(n):
+    return [{'id': i, 'name': 'user%d' % i, 'tags': ['a', 'b'], 'score': i / 3.0} for i in xrange(n)]
+
+queries = [
+    ("expr of 1000 documents", lambda: r.expr(docs(1000))),
+    ("chained table query", lambda: r.table('t').filter({'a': 1}).pluck('a', 'b').order_by('a').limit(10)),
+    ("point read", lambda: r.table('t').get(10)),
+    ("map/reduce with lambdas", lambda: r.table('t').map(lambda x: x['a'] + x['b'] * 2).reduce(lambda a, b: a + b)),
+]
+
+# Returns (number of nodes, bytes used by the nodes and their containers)
+def footprint(root):
+    seen = set()
+    nodes = 0
+    size = 0
+    stack = [root]
+    while len(stack) > 0:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        nodes += 1
+
+        for obj in [node, getattr(node, '__dict__', None), node.args, node.optargs]:
+            if obj is not None and id(obj) not in seen:
+                if obj is not node:
+                    seen.add(id(obj))
+                size += sys.getsizeof(obj)
+
+        stack.extend(arg for arg in node.args if isinstance(arg, RqlQuery))
+        stack.extend(arg for arg in node.optargs.values() if isinstance(arg, RqlQuery))
+    return (nodes, size)
+
+if __name__ == '__main__':
+    for (name, build) in queries:
+        (nodes, size) = footprint(build())
+        print "%-28s %7d nodes %10d bytes %7.1f bytes/node" % (name, nodes, size, float(size) / nodes)
@@ -7,6 +7,7 @@ import socket
 import threading
 import SocketServer
 import datetime
+import json
 from sys import argv
 from subprocess import Popen
 from time import sleep, time
@@ -304,6 +305,37 @@ class TestConnection(TestWithConnection):
             r.RqlDriverError, "Connection is closed",
             r.expr(1).run)
 
+    def test_large_response(self):
+        # Responses bigger than the initial receive buffer must still be
+        # read whole, including several in a row
+        c = r.connect(port=self.port)
+        for size in [100000, 1000000, 10]:
+            self.assertEqual(r.expr('x' * size).run(c), 'x' * size)
+
+    def test_prepared_query(self):
+        c = r.connect(port=self.port)
+        add = r.prepare(lambda x, y: r.expr({'sum': r.expr(x) + y, 'y': y}))
+        self.assertEqual(add.bind(1, 2).run(c), {'sum': 3, 'y': 2})
+        self.assertEqual(add.bind(y=[3], x=[1, 2]).run(c), {'sum': [1, 2, 3], 'y': [3]})
+
+        self.assertRaises(r.RqlDriverError, add.bind, 1)
+        self.assertRaises(r.RqlDriverError, add.bind, 1, 2, z=3)
+        self.assertRaisesRegexp(
+            r.RqlRuntimeError, "Expected type NUMBER but found STRING",
+            add.bind(1, 'a').run, c)
+
+    def test_run_many(self):
+        c = r.connect(port=self.port)
+        results = c.run_many([r.expr(i) for i in xrange(0, 50)] + [r.db_list()])
+        self.assertEqual(results[:50], range(0, 50))
+        self.assertTrue('test' in results[50])
+
+        self.assertRaisesRegexp(
+            r.RqlRuntimeError, "first",
+            c.run_many, [r.expr(1), r.error("first"), r.error("second")])
+        self.assertEqual(c.run_many([]), [])
+        self.assertEqual(r.expr(1).run(c), 1)
+
     def test_port_conversion(self):
         c = r.connect(port=str(self.port))
         r.expr(1).run(c)
@@ -314,6 +346,137 @@ class TestConnection(TestWithConnection):
             "Could not convert port abc to an integer.",
             lambda: r.connect(port='abc'))
 
+class TestMultiplexedConnection(TestWithConnection):
+    def test_submit(self):
+        c = r.connect(port=self.port, multiplex=True)
+        futures = [c.submit(r.expr(i)) for i in xrange(0, 100)]
+        self.assertEqual([f.result() for f in futures], range(0, 100))
+
+    def test_run_many(self):
+        c = r.connect(port=self.port, multiplex=True)
+        self.assertEqual(c.run_many([r.expr(i) for i in xrange(0, 50)]), range(0, 50))
+        self.assertRaisesRegexp(
+            r.RqlRuntimeError, "first",
+            c.run_many, [r.expr(1), r.error("first"), r.error("second")])
+
+    def test_shared_between_threads(self):
+        c = r.connect(port=self.port, multiplex=True)
+        r.db('test').table_create('t1').run(c)
+        r.table('t1').insert([{'id':i} for i in xrange(0, 100)]).run(c)
+
+        results = []
+        def worker(n):
+            for i in xrange(0, 20):
+                results.append(r.table('t1').get(n).run(c)['id'])
+            results.append(len(list(r.table('t1').run(c))))
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in xrange(0, 10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(sorted(results), sorted([n for n in xrange(0, 10) for i in xrange(0, 20)] + [100] * 10))
+
+    def test_runtime_error(self):
+        c = r.connect(port=self.port, multiplex=True)
+        future = c.submit(r.error('foo'))
+        self.assertRaisesRegexp(r.RqlRuntimeError, "foo", future.result)
+
+    def test_close_fails_outstanding(self):
+        c = r.connect(port=self.port, multiplex=True)
+        future = c.submit(r.js('while(true);', timeout=0.5))
+        c.close(noreply_wait=False)
+        self.assertRaisesRegexp(r.RqlDriverError, "Connection is closed.", future.result)
+
+class TestAsyncConnection(TestWithConnection):
+    def setUp(self):
+        try:
+            import trollius
+        except ImportError:
+            self.skipTest("trollius is not installed")
+        self.asyncio = trollius
+        TestWithConnection.setUp(self)
+
+    def run_coroutine(self, coro):
+        return self.asyncio.get_event_loop().run_until_complete(coro)
+
+    def test_run(self):
+        From, Return = self.asyncio.From, self.asyncio.Return
+
+        @self.asyncio.coroutine
+        def body():
+            c = yield From(r.connect_async(port=self.port))
+            results = yield From(self.asyncio.gather(*[r.expr(i).run(c) for i in xrange(0, 100)]))
+            yield From(c.close())
+            raise Return(results)
+
+        self.assertEqual(self.run_coroutine(body()), range(0, 100))
+
+    def test_cursor(self):
+        From, Return = self.asyncio.From, self.asyncio.Return
+
+        @self.asyncio.coroutine
+        def body():
+            c = yield From(r.connect_async(port=self.port))
+            yield From(r.db('test').table_create('t1').run(c))
+            yield From(r.table('t1').insert([{'id':i} for i in xrange(0, 1000)]).run(c))
+
+            ids = []
+            cursor = yield From(r.table('t1').run(c))
+            while (yield From(cursor.fetch_next())):
+                row = yield From(cursor.next())
+                ids.append(row['id'])
+            yield From(c.close())
+            raise Return(ids)
+
+        self.assertEqual(sorted(self.run_coroutine(body())), range(0, 1000))
+
+    def test_runtime_error(self):
+        From = self.asyncio.From
+
+        @self.asyncio.coroutine
+        def body():
+            c = yield From(r.connect_async(port=self.port))
+            yield From(r.error('foo').run(c))
+
+        self.assertRaisesRegexp(r.RqlRuntimeError, "foo", self.run_coroutine, body())
+
+class TestConnectionPool(TestWithConnection):
+    def test_checkout_checkin(self):
+        pool = r.ConnectionPool(hosts=['localhost:%d' % self.port], min_size=2, max_size=2)
+        self.assertEqual(pool.size(), (2, 2))
+
+        c1 = pool.checkout()
+        c2 = pool.checkout()
+        self.assertEqual(pool.size(), (2, 0))
+        self.assertRaisesRegexp(
+            r.RqlDriverError, "Timed out waiting for a connection from the pool.",
+            pool.checkout, 0.1)
+
+        pool.checkin(c1)
+        with pool.connection() as c:
+            self.assertIs(c, c1)
+            self.assertEqual(r.expr(1).run(c), 1)
+        pool.checkin(c2)
+
+        pool.close()
+        self.assertEqual(pool.size(), (0, 0))
+
+    def test_lazy_reconnect(self):
+        pool = r.ConnectionPool(hosts=['localhost:%d' % self.port], max_size=1, idle_check_interval=0)
+        with pool.connection() as c:
+            c.close()
+        with pool.connection() as c:
+            self.assertEqual(r.expr(1).run(c), 1)
+        pool.close()
+
+    def test_skips_dead_hosts(self):
+        pool = r.ConnectionPool(hosts=['localhost:11221', 'localhost:%d' % self.port])
+        with pool.connection() as c:
+            self.assertEqual(c.port, self.port)
+        pool.close()
+
 class TestShutdown(TestWithConnection):
     def test_shutdown(self):
         c = r.connect(port=self.port)
@@ -335,6 +498,37 @@ class TestPrinting(unittest.TestCase):
         self.assertEqual(str(r.db('db1').table('tbl1').map(lambda x: x)),
                             "r.db('db1').table('tbl1').map(lambda var_1: var_1)")
 
+class TestJsonCodec(TestWithConnection):
+    def tearDown(self):
+        r.set_json_codec(None)
+        TestWithConnection.tearDown(self)
+
+    def runTest(self):
+        c = r.connect(port=self.port)
+        r.db('test').table_create('t1').run(c)
+
+        calls = []
+        class CountingCodec(object):
+            @staticmethod
+            def loads(s):
+                calls.append('loads')
+                return json.loads(s)
+
+            @staticmethod
+            def dumps(obj):
+                calls.append('dumps')
+                return json.dumps(obj)
+
+        r.set_json_codec(CountingCodec)
+        time1 = datetime.datetime.fromtimestamp(1375115782.24, r.ast.RqlTzinfo('+00:00'))
+        r.table('t1').insert({'id':0, 'time':r.epoch_time(1375115782.24).in_timezone('+00:00')}).run(c)
+        r.table('t1').insert([{'id':1}]).run(c)
+        self.assertEqual(list(r.table('t1').order_by('id').run(c)), [{'id':0, 'time':time1}, {'id':1}])
+        self.assertIn('loads', calls)
+        self.assertIn('dumps', calls)
+
+        self.assertRaisesRegexp(r.RqlDriverError, 'Unknown JSON codec "foo".', r.set_json_codec, 'foo')
+
 class TestBatching(TestWithConnection):
     def runTest(self):
         c = r.connect(port=self.port)
@@ -407,8 +601,12 @@ if __name__ == '__main__':
     suite.addTest(loader.loadTestsFromTestCase(TestTimeout))
     suite.addTest(loader.loadTestsFromTestCase(TestAuthConnection))
     suite.addTest(loader.loadTestsFromTestCase(TestConnection))
+    suite.addTest(loader.loadTestsFromTestCase(TestMultiplexedConnection))
+    suite.addTest(loader.loadTestsFromTestCase(TestAsyncConnection))
+    suite.addTest(loader.loadTestsFromTestCase(TestConnectionPool))
     suite.addTest(loader.loadTestsFromTestCase(TestShutdown))
     suite.addTest(TestPrinting())
+    suite.addTest(TestJsonCodec())
     suite.addTest(TestBatching())
     suite.addTest(TestGroupWithTimeKey())
 
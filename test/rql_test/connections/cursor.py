@@ -2,6 +2,7 @@
 # Tests the driver cursor API
 ###
 
+import array
 import unittest
 from os import getenv
 from sys import path, argv, exit
@@ -29,6 +30,47 @@ class TestCursor(unittest.TestCase):
 
         self.assertEqual(i, num_rows)
 
+    def test_lazy_decode(self):
+        c = r.connect(port=port)
+        ids = set()
+        for row in r.table('test').run(c, decode='lazy'):
+            self.assertEqual(len(row['nums']), 500)
+            ids.add(row['id'])
+        self.assertEqual(ids, set(xrange(0, num_rows)))
+
+        row = r.table('test').get(0).run(c, decode='lazy')
+        self.assertEqual(row, {'id': 0, 'nums': range(0, 500)})
+
+    def test_prefetch(self):
+        c = r.connect(port=port)
+        for prefetch in [0, 1, 4, 'auto']:
+            ids = set(row['id'] for row in r.table('test').run(c, prefetch=prefetch))
+            self.assertEqual(ids, set(xrange(0, num_rows)))
+
+        # A smaller batch size only means more round trips
+        cur = r.table('test').run(c, prefetch=2, batch_conf={'max_els': 10})
+        self.assertEqual(len(list(cur)), num_rows)
+
+        self.assertRaises(r.RqlDriverError, r.table('test').run, c, prefetch=-1)
+        self.assertRaises(r.RqlDriverError, r.table('test').run, c, batch_conf={'max_rows': 10})
+
+    def test_bulk(self):
+        c = r.connect(port=port)
+        batch = r.table('test').run(c).next_batch()
+        self.assertTrue(0 < len(batch) <= num_rows)
+        self.assertEqual(len(batch[0]['nums']), 500)
+
+        rows = r.table('test').run(c).to_list()
+        self.assertEqual(sorted(row['id'] for row in rows), range(0, num_rows))
+
+        cur = r.table('test').run(c)
+        columns = cur.to_columns(['id', 'nums', 'missing'])
+        self.assertEqual(type(columns['id']), array.array)
+        self.assertEqual(sorted(columns['id']), range(0, num_rows))
+        self.assertEqual(len(columns['nums']), num_rows)
+        self.assertEqual(columns['missing'], [None] * num_rows)
+        self.assertEqual(cur.next_batch(), None)
+
     def test_close(self):
         # This excercises a code path at the root of #650
         self.cur.close()
@@ -0,0 +1,139 @@
+###
+# Tests how `rethinkdb import` reads files, without inserting the rows. Does
+# not need a server.
+###
+
+import ctypes
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+from sys import path, exit
+path.insert(0, "../../drivers/python")
+
+import rethinkdb as r
+from rethinkdb import _import
+
+# Rows with nested objects and arrays, and brackets in strings
+def make_rows(count):
+    return [{"id": i, "name": "row {%d] [" % i, "nested": {"a": [i, {"b": "x"}], "c": {}}}
+            for i in xrange(count)]
+
+class TestJsonFiles(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.split_size = _import.split_size
+
+    def tearDown(self):
+        _import.split_size = self.split_size
+        shutil.rmtree(self.directory)
+
+    def write(self, text):
+        filename = os.path.join(self.directory, "table.json")
+        with open(filename, "w") as out:
+            out.write(text)
+        return filename
+
+    # Reads a file with `json_reader`, returning the rows that were queued for
+    # the clients
+    def read(self, filename, readers=1):
+        manager = multiprocessing.Manager()
+        task_queue = manager.Queue()
+        error_queue = manager.Queue()
+        progress_info = (multiprocessing.Value(ctypes.c_longlong, -1),
+                         multiprocessing.Value(ctypes.c_longlong, 0),
+                         multiprocessing.Value(ctypes.c_longlong, 0))
+        _import.json_reader(task_queue, _import.BatchController(), error_queue, filename,
+                            "test", "table", "id", None, readers, progress_info,
+                            multiprocessing.Event())
+        if not error_queue.empty():
+            raise error_queue.get()[1]
+
+        rows = [ ]
+        while not task_queue.empty():
+            rows.extend(json.loads(row) for row in task_queue.get()[2])
+        self.assertEqual(progress_info[2].value, len(rows))
+        return sorted(rows, key=lambda row: row["id"])
+
+    def one_per_line(self, rows):
+        return ",\n".join(json.dumps(row) for row in rows)
+
+    def pretty(self, rows):
+        return ",\n".join(json.dumps(row, indent=4) for row in rows)
+
+    def test_one_per_line(self):
+        rows = make_rows(300)
+        filename = self.write("[\n" + self.one_per_line(rows) + "\n]\n")
+        self.assertEqual(self.read(filename), rows)
+
+    def test_mixed_layout(self):
+        # The rows past the lines sampled to pick the layout span several lines
+        rows = make_rows(400)
+        text = "[\n" + ",\n".join([self.one_per_line(rows[:150]), self.pretty(rows[150:200]),
+                                   self.one_per_line(rows[200:300]), self.pretty(rows[300:])]) + "\n]\n"
+        filename = self.write(text)
+        self.assertEqual(self.read(filename), rows)
+
+    def test_mixed_layout_in_ranges(self):
+        # Splits that fall inside a row that spans several lines move past it
+        rows = make_rows(1000)
+        text = "[\n" + ",\n".join([self.one_per_line(rows[:150])] +
+                                  [self.pretty(rows[i:i + 10]) + ",\n" + self.one_per_line(rows[i + 10:i + 50])
+                                   for i in xrange(150, 1000, 50)]) + "\n]\n"
+        filename = self.write(text)
+        _import.split_size = 4096
+        self.assertEqual(self.read(filename, readers=4), rows)
+
+    def test_objects_on_lines(self):
+        rows = make_rows(300)
+        text = "\n".join(json.dumps(row) for row in rows[:200]) + "\n" + \
+               "\n".join(json.dumps(row, indent=2) for row in rows[200:]) + "\n"
+        filename = self.write(text)
+        self.assertEqual(self.read(filename), rows)
+
+    def test_errors(self):
+        rows = make_rows(200)
+        lines = [json.dumps(row) + "," for row in rows]
+
+        # A row that doesn't parse is reported with its line
+        bad = list(lines)
+        bad[150] = '{"id": 150, "name": x},'
+        with self.assertRaisesRegexp(RuntimeError, "line 152"):
+            self.read(self.write("[\n" + "\n".join(bad) + "\n{}\n]\n"))
+
+        # So is one that never ends
+        bad = list(lines)
+        bad[160] = '{"id": 160, "nested": {'
+        with self.assertRaisesRegexp(RuntimeError, "line 162"):
+            self.read(self.write("[\n" + "\n".join(bad) + "\n{}\n]\n"))
+
+        with self.assertRaisesRegexp(RuntimeError, "line 183 - expected ','"):
+            self.read(self.write("[\n" + "\n".join(lines[:180]) + "\n{}\n{}\n]\n"))
+
+class TestCsvTypes(unittest.TestCase):
+    def test_numbers(self):
+        self.assertEqual(_import.parse_number("-12"), -12)
+        self.assertEqual(_import.parse_number("1.5e3"), 1500.0)
+        self.assertEqual(_import.parse_number(str(2 ** 53)), 2 ** 53)
+        for value in ["12345678901234567891", str(-2 ** 53 - 1), "1e400", "-1e400", "012", "1.", "x"]:
+            self.assertRaises(ValueError, _import.parse_number, value)
+
+    def test_inferred(self):
+        # Long IDs would lose digits as numbers, so they stay strings
+        self.assertEqual(_import.infer_column_type(["1", "12345678901234567891"]), "string")
+        self.assertEqual(_import.infer_column_type(["1", "2.5"]), "number")
+        convert = _import.csv_converter("number", True)
+        self.assertEqual(convert("12345678901234567891"), "12345678901234567891")
+        self.assertRaises(ValueError, _import.csv_converter("number", False), "12345678901234567891")
+
+if __name__ == '__main__':
+    suite = unittest.TestSuite()
+    loader = unittest.TestLoader()
+    suite.addTest(loader.loadTestsFromTestCase(TestJsonFiles))
+    suite.addTest(loader.loadTestsFromTestCase(TestCsvTypes))
+    res = unittest.TextTestRunner(verbosity=2).run(suite)
+
+    if not res.wasSuccessful():
+        exit(1)
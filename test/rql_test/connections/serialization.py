@@ -0,0 +1,445 @@
+###
+# Tests how queries are built and serialized. Checks that queries serialized
+# directly by `RqlQuery.serialize` are byte for byte the same as queries
+# built with protobuf messages, for every query in the polyglot tests. Does
+# not need a server.
+###
+
+import collections
+import datetime
+import json
+import os
+import unittest
+import yaml
+from sys import path, exit
+path.insert(0, "../../drivers/python")
+
+import rethinkdb as r
+from rethinkdb import ql2_pb2 as p
+
+try:
+    import pytz
+except ImportError:
+    pytz = None
+
+src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.pardir, 'src')
+
+# Returns the Python source of every query and definition in a test, as
+# (kind, source) pairs
+def test_sources(test):
+    sources = [ ]
+    definition = test.get('def')
+    if isinstance(definition, dict):
+        definition = definition.get('py', definition.get('cd'))
+    query = test.get('py', test.get('cd'))
+    if isinstance(query, dict):
+        query = query.get('cd')
+
+    for (kind, code) in [('def', definition), ('query', query)]:
+        if code is None:
+            continue
+        if not isinstance(code, list):
+            code = [code]
+        sources.extend((kind, unicode(c)) for c in code)
+    return sources
+
+def corpus_queries():
+    for (root, dirs, files) in os.walk(src_dir):
+        for name in sorted(files):
+            if not name.endswith('.yaml'):
+                continue
+            group = yaml.safe_load(open(os.path.join(root, name)))
+            scope = {'r': r, 'datetime': datetime, 'pytz': pytz}
+            for test in group.get('tests') or []:
+                if not isinstance(test, dict):
+                    continue
+                for (kind, source) in test_sources(test):
+                    source = source.replace('null', 'None')
+                    try:
+                        if kind == 'def':
+                            exec(source, scope)
+                        else:
+                            yield (name, source, r.expr(eval(source, scope)))
+                    except Exception:
+                        # Tests of errors raised while building queries
+                        pass
+
+def protobuf_serialize(query):
+    term = p.Term()
+    query.build(term)
+    return term.SerializeToString()
+
+class TestSerialization(unittest.TestCase):
+    def assertSameSerialization(self, query, description):
+        try:
+            expected = protobuf_serialize(query)
+        except Exception as err:
+            self.assertRaises(type(err), query.serialize)
+            return
+        self.assertEqual(query.serialize(), expected, description)
+
+    def test_corpus(self):
+        count = 0
+        for (name, source, query) in corpus_queries():
+            self.assertSameSerialization(query, "%s: %s" % (name, source))
+            count += 1
+        self.assertTrue(count > 1000)
+
+    def test_datums(self):
+        for value in [None, True, False, 0, -1, 2 ** 62, 1.5, float('inf'), -0.0,
+                      '', 'abc', u'\xe9\u4e2d', 'x' * 300, [1, [2, 'a']], {'a': {'b': None}}]:
+            self.assertSameSerialization(r.expr(value), repr(value))
+
+        self.assertRaises(UnicodeDecodeError, r.expr('\xff').serialize)
+        self.assertRaises(r.RqlDriverError, r.expr(object()).serialize)
+
+    def test_start_query(self):
+        conn = r.Connection.__new__(r.Connection)
+        conn.db = 'test'
+        conn.next_token = 5
+
+        term = r.table('t').get_all(1, 2, index='a').limit(10)
+        query = conn._build_start_query(term, {'use_outdated': True})
+        data = conn._serialize_query(query, term)
+
+        expected = p.Query()
+        expected.type = p.Query.START
+        expected.token = 5
+        expected.accepts_r_json = True
+        term.build(expected.query)
+        for pair in query.global_optargs:
+            expected.global_optargs.add().CopyFrom(pair)
+        self.assertEqual(data[4:], expected.SerializeToString())
+
+class TestExprJSON(unittest.TestCase):
+    def test_plain_json(self):
+        docs = [{'id': i, 'tags': ['a', None], 'obj': {'x': 1.5, 'y': True}} for i in xrange(0, 10)]
+        term = r.table('t').insert(docs).args[1]
+        self.assertEqual(type(term), r.ast.Json)
+        self.assertEqual(json.loads(term.args[0].data), docs)
+
+    def test_fallback(self):
+        docs = [{'id': 0}, {'id': 1, 'tags': ['a'], 'n': r.expr(1) + 1}]
+        term = r.ast.exprJSON(docs)
+        self.assertEqual(type(term), r.ast.MakeArray)
+        self.assertEqual(type(term.args[0]), r.ast.Json)
+        self.assertEqual(type(term.args[1]), r.ast.MakeObj)
+        self.assertEqual(type(term.args[1].optargs['tags']), r.ast.Json)
+        self.assertEqual(type(term.args[1].optargs['id']), r.ast.Datum)
+        self.assertEqual(type(term.args[1].optargs['n']), r.ast.Add)
+
+        self.assertRaises(r.RqlDriverError, r.ast.exprJSON, {1: 2})
+
+    def test_non_finite(self):
+        # Every codec sends NaN and infinities for the server to reject
+        tz = r.make_timezone('00:00')
+        for name in ['simplejson', 'json']:
+            try:
+                r.set_json_codec(name)
+            except r.RqlDriverError:
+                continue
+            try:
+                for doc in [{'a': float('nan')}, {'a': float('-inf'), 't': datetime.datetime(2014, 1, 1, tzinfo=tz)}]:
+                    data = r.table('t').insert([doc]).args[1].args[0].data
+                    self.assertTrue('NaN' in data or '-Infinity' in data, name)
+            finally:
+                r.set_json_codec(None)
+
+    def test_lazy_row(self):
+        row = r.ast.LazyRow('{"id": 0, "tags": ["a", null]}')
+        self.assertFalse(hasattr(row, '__dict__'))
+        self.assertTrue(isinstance(row, collections.Mapping))
+        self.assertEqual(row, {'id': 0, 'tags': ['a', None]})
+        self.assertNotEqual(row, {'id': 1})
+        self.assertEqual(row.get('x', 1), 1)
+        self.assertEqual(dict(row.iteritems()), {'id': 0, 'tags': ['a', None]})
+
+class TestTimes(unittest.TestCase):
+    def test_send(self):
+        tz = r.make_timezone('-07:30')
+        time = datetime.datetime(2014, 1, 1, 12, 0, 0, 123456, tzinfo=tz)
+        expected = {'$reql_type$': 'TIME', 'epoch_time': 1388604600.123456, 'timezone': '-07:30'}
+
+        term = r.expr(time)
+        self.assertEqual(type(term), r.ast.MakeObj)
+        self.assertEqual(dict((k, v.data) for (k, v) in term.optargs.items()), expected)
+
+        # Times are sent as part of the JSON
+        term = r.ast.exprJSON([{'at': time}])
+        self.assertEqual(type(term), r.ast.Json)
+        self.assertEqual(json.loads(term.args[0].data), [{'at': expected}])
+
+        for value in [datetime.datetime(2014, 1, 1), datetime.date(2014, 1, 1)]:
+            self.assertRaises(r.RqlDriverError, r.expr, value)
+            self.assertRaises(r.RqlDriverError, r.ast.exprJSON, [value])
+
+    def test_receive(self):
+        rows = ['{"at": {"$reql_type$": "TIME", "epoch_time": 1388604600.5, "timezone": "%s"}}' % tz
+                for tz in ['-07:30', '+02:00', '-07:30']]
+        datums = [p.Datum(type=p.Datum.R_JSON, r_str=row) for row in rows]
+        times = [row['at'] for row in r.ast.Datum.deconstruct_batch(datums)]
+
+        self.assertEqual(times[0], times[2])
+        self.assertEqual(times[0].utcoffset(), -datetime.timedelta(hours=7, minutes=30))
+        self.assertEqual(times[0].isoformat(), '2014-01-01T12:00:00.500000-07:30')
+        self.assertEqual(times[1].isoformat(), '2014-01-01T21:30:00.500000+02:00')
+        self.assertTrue(times[0].tzinfo is times[2].tzinfo)
+        self.assertTrue(times[0].tzinfo is r.make_timezone('-07:30'))
+
+        raw = r.ast.Datum.deconstruct_batch(datums, {'time_format': 'raw'})
+        self.assertEqual(raw[1], json.loads(rows[1]))
+
+class TestNesting(unittest.TestCase):
+    def tearDown(self):
+        r.set_nesting_depth(20)
+
+    def test_depth_limit(self):
+        cyclic = { }
+        cyclic['a'] = [cyclic]
+        for convert in [r.expr, r.ast.exprJSON, r.ast.isJSON]:
+            self.assertRaises(r.RqlDriverError, convert, cyclic)
+            self.assertRaises(r.RqlDriverError, convert, [[1]], 2)
+        r.expr([[1]], 3)
+        self.assertRaises(r.RqlDriverError, r.set_nesting_depth, 0)
+
+    def test_deep_values(self):
+        value = None
+        for i in xrange(0, 2000):
+            value = [{'a': value}, 1]
+        self.assertRaises(r.RqlDriverError, r.expr, value)
+
+        # Neither conversion nor serialization recurses per level
+        r.set_nesting_depth(5000)
+        query = r.expr(value)
+        self.assertEqual(type(query), r.ast.MakeArray)
+        self.assertTrue(r.ast.isJSON(value))
+        self.assertEqual(query.serialize(), protobuf_serialize(query))
+
+class TestFuncCache(unittest.TestCase):
+    def tearDown(self):
+        r.set_func_cache_size(0)
+
+    def build(self, value):
+        return r.table('t').filter(lambda doc: doc['a'] > value)
+
+    def test_disabled(self):
+        self.assertNotEqual(self.build(1).serialize(), self.build(1).serialize())
+
+    def test_reuse(self):
+        cache = r.set_func_cache_size(10)
+        first = self.build(1)
+        self.assertEqual(first.serialize(), self.build(1).serialize())
+        self.assertEqual(cache.hits, 1)
+
+        # Closure values and their types are part of the key
+        self.assertNotEqual(first.serialize(), self.build(2).serialize())
+        self.build(True)
+        self.assertEqual(type(self.build(True).args[1].args[1].args[1].data), bool)
+        self.assertEqual(len(cache.entries), 3)
+
+        # Lambdas closing over queries are not cached
+        query = r.expr(1)
+        r.expr(1).do(lambda x: x + query)
+        self.assertEqual(len(cache.entries), 3)
+
+    def test_bounded(self):
+        cache = r.set_func_cache_size(2)
+        for i in xrange(0, 10):
+            self.build(i)
+        self.assertEqual(len(cache.entries), 2)
+
+class TestInternTable(unittest.TestCase):
+    def tearDown(self):
+        r.set_intern_table_size(0)
+
+    def test_corpus(self):
+        table = r.set_intern_table_size(100000)
+        queries = [(query, protobuf_serialize(query)) for (name, source, query) in corpus_queries()]
+        for i in xrange(0, 2):
+            for (query, expected) in queries:
+                self.assertEqual(query.serialize(), expected)
+        self.assertTrue(table.hit_rate() > 0.5)
+
+    def test_similar_datums(self):
+        r.set_intern_table_size(100)
+        for values in [(0.0, -0.0), (1, True), (0, False), ('a', u'\xe9'), (None, 'None')]:
+            for value in values:
+                query = r.expr([value]).append(value)
+                self.assertEqual(query.serialize(), protobuf_serialize(query), repr(value))
+
+    def test_hit_rate(self):
+        table = r.set_intern_table_size(100)
+        users = r.db('app').table('users')
+        users.get(1).serialize()
+        self.assertEqual(table.hit_rate(), 0.0)
+        r.db('app').table('users').get(2).serialize()
+        self.assertAlmostEqual(table.hit_rate(), 2.0 / 6)
+        self.assertTrue(r.get_intern_table() is table)
+
+        # Nodes already seen are found without walking them again
+        users.get(3).serialize()
+        users.get(3).serialize()
+        self.assertEqual(table.nodes.hits, 1)
+
+    def test_bounded(self):
+        table = r.set_intern_table_size(5)
+        for i in xrange(0, 100):
+            r.db('app').table('t%d' % i).serialize()
+        self.assertTrue(len(table) <= 5)
+
+class TestErrorFormatting(unittest.TestCase):
+    def test_backtrace(self):
+        query = r.expr([1]).filter(lambda x: x['a'] == 1)
+        var = 'var_%d' % query.args[1].vrs[0].args[0].data
+        frames = [p.Frame(type=p.Frame.POS, pos=1), p.Frame(type=p.Frame.POS, pos=1)]
+        err = r.RqlRuntimeError('Boom', query, frames)
+        self.assertTrue(err._backtrace is None)
+
+        text = "r.expr([1]).filter(lambda %s: (%s['a'] == r.expr(1)))" % (var, var)
+        carrots = ' ' * text.index('(%s[' % var) + '^' * len("(%s['a'] == r.expr(1))" % var) + ' '
+        self.assertEqual(str(err), 'Boom in:\n' + text + '\n' + carrots)
+        self.assertTrue(err.backtrace() is err.backtrace())
+
+    def test_infix_comparison(self):
+        try:
+            (r.expr(1) | 2) < 3
+            self.fail('No error')
+        except r.RqlDriverError as err:
+            self.assertTrue(err._term is not None)
+            self.assertTrue('(r.expr(1) | r.expr(2)) < r.expr(3)' in err.message)
+            self.assertTrue(err._term is None)
+
+class TestProtocol(unittest.TestCase):
+    def test_enums(self):
+        from rethinkdb import ql2
+        for message in [p.VersionDummy, p.Query, p.Frame, p.Response, p.Datum, p.Term]:
+            lazy = getattr(ql2, message.DESCRIPTOR.name)
+            for enum in message.DESCRIPTOR.enum_types:
+                for value in enum.values:
+                    self.assertEqual(getattr(lazy, value.name), value.number, value.name)
+
+    def test_messages(self):
+        from rethinkdb import ql2
+        self.assertTrue(ql2.Term.AssocPair is p.Term.AssocPair)
+        self.assertEqual(ql2.Frame(type=ql2.Frame.OPT, opt='a'), p.Frame(type=p.Frame.OPT, opt='a'))
+
+    def test_docs(self):
+        # Attached whenever the driver is imported, not only interactively
+        self.assertTrue(r.RqlQuery.filter.__doc__)
+        self.assertTrue(r.connect.__doc__)
+
+    def test_protobuf_implementation(self):
+        # Read after loading the messages, which may fall back on 'python'
+        from rethinkdb import ql2
+        self.assertTrue(r.get_protobuf_implementation() in ('cpp', 'python'))
+        self.assertEqual(r.get_protobuf_implementation(), ql2.protobuf_implementation)
+
+# Builds a Datum message holding `value` out of R_ARRAYs and R_OBJECTs
+def native_datum(value, datum=None):
+    datum = datum or p.Datum()
+    if isinstance(value, dict):
+        datum.type = p.Datum.R_OBJECT
+        for (key, val) in value.items():
+            pair = datum.r_object.add()
+            pair.key = key
+            native_datum(val, pair.val)
+    elif isinstance(value, list):
+        datum.type = p.Datum.R_ARRAY
+        for val in value:
+            native_datum(val, datum.r_array.add())
+    elif isinstance(value, basestring):
+        datum.type = p.Datum.R_STR
+        datum.r_str = value
+    elif isinstance(value, bool):
+        datum.type = p.Datum.R_BOOL
+        datum.r_bool = value
+    elif value is None:
+        datum.type = p.Datum.R_NULL
+    else:
+        datum.type = p.Datum.R_NUM
+        datum.r_num = value
+    return datum
+
+# The value with the type of everything in it, so that 1 and 1.0 differ
+def typed(value):
+    if isinstance(value, (dict, frozenset)):
+        items = value.items() if isinstance(value, dict) else value
+        return (type(value), frozenset((typed(k), typed(v)) for (k, v) in items))
+    elif isinstance(value, (list, tuple)):
+        return (type(value), tuple(typed(v) for v in value))
+    elif isinstance(value, datetime.datetime):
+        return (type(value), value.isoformat())
+    return (type(value), repr(value))
+
+class TestResponseDecoding(unittest.TestCase):
+    time = {'$reql_type$': 'TIME', 'epoch_time': 1388604600.5, 'timezone': '-07:30'}
+    grouped = {'$reql_type$': 'GROUPED_DATA', 'data': [[[1, 'a'], 2], [{'k': None}, 3]]}
+    values = [None, True, False, 0.0, -0.0, 2.5, 3.0, 2.0 ** 70, u'', u'\xe9\u4e2d',
+              [1, [2.5, u'a']], {'a': {'b': None}, 'c': [time]}, time, grouped]
+
+    def setUp(self):
+        from rethinkdb import ql2
+        self.ql2 = ql2
+        if ql2.load_decoder() is None:
+            self.skipTest('The C decoder is not built')
+
+    def response(self, datums):
+        response = p.Response(type=p.Response.SUCCESS_SEQUENCE, token=2 ** 40)
+        for datum in datums:
+            response.response.add().CopyFrom(datum)
+        return (response, self.ql2.DecodedResponse(response.SerializeToString()))
+
+    def assertSameValues(self, datums):
+        (parsed, decoded) = self.response(datums)
+        self.assertEqual(decoded.type, parsed.type)
+        self.assertEqual(decoded.token, parsed.token)
+        for format_opts in [{}, {'time_format': 'raw'}, {'group_format': 'raw'}, {'decode': 'lazy'}]:
+            deconstruct = r.ast.Datum.decoder(format_opts)
+            expected = [deconstruct(datum, format_opts) for datum in parsed.response]
+            values = [deconstruct(datum, format_opts) for datum in decoded.response]
+            self.assertEqual(typed([dict(v) if isinstance(v, r.ast.LazyRow) else v for v in values]),
+                             typed([dict(v) if isinstance(v, r.ast.LazyRow) else v for v in expected]))
+            self.assertEqual(typed(r.ast.Datum.deconstruct_batch(decoded.response, format_opts)),
+                             typed(r.ast.Datum.deconstruct_batch(parsed.response, format_opts)))
+
+    def test_native(self):
+        self.assertSameValues([native_datum(value) for value in self.values + [float('inf'), float('nan')]])
+        self.assertSameValues([p.Datum(), p.Datum(type=p.Datum.R_NUM), p.Datum(type=p.Datum.R_STR)])
+
+    def test_json(self):
+        datums = [p.Datum(type=p.Datum.R_JSON, r_str=json.dumps(value)) for value in self.values]
+        self.assertSameValues(datums)
+        self.assertSameValues(datums[:3] + [native_datum([1, self.time])])
+
+    def test_errors(self):
+        response = p.Response(type=p.Response.RUNTIME_ERROR, token=1)
+        response.response.add().CopyFrom(native_datum(u'Boom'))
+        response.backtrace.frames.add(type=p.Frame.POS, pos=1)
+        response.backtrace.frames.add(type=p.Frame.OPT, opt='index')
+        response.profile.CopyFrom(native_datum([{'duration': 1.5}]))
+        decoded = self.ql2.DecodedResponse(response.SerializeToString())
+
+        self.assertEqual(r.RqlRuntimeError('', None, decoded.backtrace.frames).frames, [1, u'index'])
+        self.assertEqual(r.ast.Datum.deconstruct(decoded.profile), [{'duration': 1.5}])
+        self.assertEqual(r.ast.Datum.deconstruct(self.ql2.DecodedResponse('').profile), None)
+
+        # A datum of type 100
+        self.assertRaises(RuntimeError, r.ast.Datum.deconstruct, '\x08\x64')
+        self.assertRaises(ValueError, self.ql2.DecodedResponse, response.SerializeToString()[:-1])
+
+if __name__ == '__main__':
+    suite = unittest.TestSuite()
+    loader = unittest.TestLoader()
+    suite.addTest(loader.loadTestsFromTestCase(TestSerialization))
+    suite.addTest(loader.loadTestsFromTestCase(TestExprJSON))
+    suite.addTest(loader.loadTestsFromTestCase(TestTimes))
+    suite.addTest(loader.loadTestsFromTestCase(TestNesting))
+    suite.addTest(loader.loadTestsFromTestCase(TestFuncCache))
+    suite.addTest(loader.loadTestsFromTestCase(TestInternTable))
+    suite.addTest(loader.loadTestsFromTestCase(TestErrorFormatting))
+    suite.addTest(loader.loadTestsFromTestCase(TestProtocol))
+    suite.addTest(loader.loadTestsFromTestCase(TestResponseDecoding))
+    res = unittest.TextTestRunner(verbosity=2).run(suite)
+
+    if not res.wasSuccessful():
+        exit(1)